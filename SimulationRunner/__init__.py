@@ -1,3 +1,3 @@
 """This package contains modules to automate running
 various different types of simulation."""
-__all__ = ["simulation", "neutrinosimulation", "lyasimulation","clusters"]
+__all__ = ["simulation", "neutrinosimulation", "lyasimulation","clusters","paramfile","lineartheory","kgrid","classtune","surrogate","instrument","build","orchestrator","localrunner","catalogue","suitestate","verify","archive","layout","planner","nubudget"]
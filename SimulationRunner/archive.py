@@ -0,0 +1,249 @@
+"""Module to compact the directories of finished simulations, so a suite fits in its disc quota.
+
+A retention policy decides what to keep: by default, the last snapshot, the snapshots nearest
+some chosen redshifts and their FOF tables. Everything else that can be regenerated is dropped:
+the other snapshots, the ICs, restart files and the copied binaries and TREECOOL files.
+Each kept snapshot is written to a compressed tar file next to it, in parallel threads,
+and the archive is read back and compared with the snapshot before anything is deleted.
+The Header of each archived snapshot is left in place, with a file ARCHIVE naming the archive,
+so the status checks in remake and the snapshot catalogue still see the final redshift.
+
+Progress is recorded in archive_manifest.json in each simulation directory, which lists
+every archive with its size and checksum and every deleted path. If compaction is interrupted,
+running it again skips the work already done."""
+import os
+import os.path
+import glob
+import re
+import json
+import shutil
+import hashlib
+import tarfile
+import concurrent.futures
+from . import remake
+
+MANIFEST = "archive_manifest.json"
+#Name of the file left in an archived snapshot, containing the archive file name.
+ARCHIVE_MARKER = "ARCHIVE"
+
+#Compression codecs: (tarfile mode, suffix)
+CODECS = {"gz": ("w:gz", ".tar.gz"), "bz2": ("w:bz2", ".tar.bz2"), "xz": ("w:xz", ".tar.xz"), "none": ("w", ".tar")}
+
+class RetentionPolicy(object):
+    """What to keep of a finished simulation.
+
+    Init parameters:
+    keep_redshifts - keep the snapshots nearest these redshifts (within tol).
+    keep_last - keep the last snapshot.
+    keep_pig - keep the FOF tables of kept snapshots.
+    keep_ics - keep the ICs.
+    drop - other paths, relative to the simulation directory, to delete. These may be glob patterns.
+    """
+    def __init__(self, keep_redshifts=(), keep_last=True, keep_pig=True, keep_ics=False, tol=0.01,
+                 drop=("MP-Gadget", "MP-GenIC", "TREECOOL", "output/RESTART", "output/restartfiles")):
+        self.keep_redshifts = list(keep_redshifts)
+        self.keep_last = keep_last
+        self.keep_pig = keep_pig
+        self.keep_ics = keep_ics
+        self.tol = tol
+        self.drop = list(drop)
+
+    def plan(self, simdir, output_file="output"):
+        """Decide what to do with a simulation. Returns (archive, delete): the snapshot directories
+        to archive and the paths to delete, both relative to simdir and sorted."""
+        outdir = os.path.join(simdir, output_file)
+        snaps = {}
+        for name in (os.listdir(outdir) if os.path.isdir(outdir) else []):
+            match = re.match(r"^(PART|PIG)_([0-9]{3})$", name)
+            if match is not None:
+                snaps[os.path.join(output_file, name)] = (match.group(1), int(match.group(2)))
+        parts = {num: ss for (ss, (kind, num)) in snaps.items() if kind == "PART"}
+        keep = set()
+        if self.keep_last and parts:
+            keep.add(max(parts))
+        for zz in self.keep_redshifts:
+            nearest = None
+            for (num, ss) in parts.items():
+                try:
+                    dz = abs(remake._get_redshift_snapshot(os.path.join(simdir, ss)) - zz)
+                except (IOError, TypeError):
+                    continue
+                if dz <= self.tol and (nearest is None or dz < nearest[0]):
+                    nearest = (dz, num)
+            if nearest is not None:
+                keep.add(nearest[1])
+        archive = []
+        delete = []
+        for (ss, (kind, num)) in snaps.items():
+            if num in keep and (kind == "PART" or self.keep_pig):
+                archive.append(ss)
+            else:
+                delete.append(ss)
+        icdir = os.path.join(simdir, "ICS")
+        if os.path.isdir(icdir):
+            for name in os.listdir(icdir):
+                (archive if self.keep_ics else delete).append(os.path.join("ICS", name))
+        for pattern in self.drop:
+            for path in _glob(simdir, pattern):
+                delete.append(path)
+        return sorted(archive), sorted(set(delete))
+
+def _glob(simdir, pattern):
+    """Paths relative to simdir matching a glob pattern."""
+    return [os.path.relpath(pp, simdir) for pp in glob.glob(os.path.join(simdir, pattern))]
+
+def _files(bigdir):
+    """Every file in a directory tree, relative to the parent of the directory, sorted."""
+    parent = os.path.dirname(bigdir)
+    files = []
+    for (dirpath, _, filenames) in os.walk(bigdir):
+        files += [os.path.relpath(os.path.join(dirpath, ff), parent) for ff in filenames]
+    return sorted(files)
+
+def _sha256(fileobj, chunksize=2**22):
+    """sha256 hex digest of an open file, read in chunks."""
+    digest = hashlib.sha256()
+    while True:
+        chunk = fileobj.read(chunksize)
+        if not chunk:
+            return digest.hexdigest()
+        digest.update(chunk)
+
+def compress(bigdir, archive, codec="gz"):
+    """Write a directory to a compressed tar file, via a temporary file so a partial archive is never left under the final name."""
+    tmpfile = archive+".tmp"
+    with tarfile.open(tmpfile, CODECS[codec][0]) as tar:
+        tar.add(bigdir, arcname=os.path.basename(bigdir))
+    os.replace(tmpfile, archive)
+
+def verify_archive(bigdir, archive):
+    """Check that a tar file contains exactly the files of a directory, with the same contents.
+    Returns a list of problems, which is empty if the archive is good."""
+    parent = os.path.dirname(bigdir)
+    expected = _files(bigdir)
+    problems = []
+    try:
+        with tarfile.open(archive, "r:*") as tar:
+            members = {mm.name: mm for mm in tar.getmembers() if mm.isfile()}
+            if sorted(members) != expected:
+                return ["Archive "+archive+" has "+str(len(members))+" files, expected "+str(len(expected))]
+            for name in expected:
+                with open(os.path.join(parent, name), 'rb') as src:
+                    if _sha256(src) != _sha256(tar.extractfile(members[name])):
+                        problems.append("Archive "+archive+" differs from "+name)
+    except (tarfile.TarError, EOFError, OSError) as err:
+        problems.append("Could not read archive "+archive+": "+str(err))
+    return problems
+
+def _archive_task(simdir, snap, codec):
+    """Compress and verify one snapshot. Run in a worker thread; the compression libraries release the GIL."""
+    bigdir = os.path.join(simdir, snap)
+    archive = bigdir + CODECS[codec][1]
+    #An archive left by an interrupted run is checked, and rewritten if it is bad.
+    problems = verify_archive(bigdir, archive) if os.path.exists(archive) else None
+    if problems is None or problems:
+        compress(bigdir, archive, codec)
+        problems = verify_archive(bigdir, archive)
+    with open(archive, 'rb') as afile:
+        sha = _sha256(afile)
+    return {"archive": os.path.relpath(archive, simdir), "files": len(_files(bigdir)), "bytes": _disc_usage(bigdir),
+            "compressed": os.path.getsize(archive), "sha256": sha, "verified": not problems, "problems": problems}
+
+def load_manifest(simdir):
+    """The archive manifest of a simulation, or an empty one."""
+    try:
+        with open(os.path.join(simdir, MANIFEST), 'r') as mfile:
+            return json.load(mfile)
+    except FileNotFoundError:
+        return {"archives": {}, "deleted": [], "complete": False}
+
+def _save_manifest(simdir, manifest):
+    """Write the manifest atomically."""
+    mfile = os.path.join(simdir, MANIFEST)
+    with open(mfile+".tmp", 'w') as out:
+        json.dump(manifest, out, indent=1)
+    os.replace(mfile+".tmp", mfile)
+
+def _disc_usage(path):
+    """Size in bytes of a file or directory tree."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum([os.path.getsize(os.path.join(os.path.dirname(path), ff)) for ff in _files(path)])
+
+def _strip(simdir, snap, archive):
+    """Replace an archived snapshot by its Header and a marker naming the archive."""
+    bigdir = os.path.join(simdir, snap)
+    with open(os.path.join(bigdir, ARCHIVE_MARKER), 'w') as marker:
+        marker.write(os.path.basename(archive)+"\n")
+    for name in os.listdir(bigdir):
+        path = os.path.join(bigdir, name)
+        if name not in ("Header", ARCHIVE_MARKER) and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif name not in ("Header", ARCHIVE_MARKER):
+            os.remove(path)
+
+def _finish(simdir, plan, manifest):
+    """Once every kept snapshot is archived and verified, delete the archived data and the dropped paths."""
+    (archive, delete) = plan
+    if not all([manifest["archives"].get(ss, {}).get("verified") for ss in archive]):
+        return False
+    #Save the list of what will be deleted first, so an interrupted deletion is known about.
+    manifest["deleted"] = sorted(set(manifest["deleted"] + delete))
+    manifest.setdefault("deleted_bytes", sum([_disc_usage(os.path.join(simdir, dd)) for dd in delete if os.path.exists(os.path.join(simdir, dd))]))
+    _save_manifest(simdir, manifest)
+    for ss in archive:
+        if not os.path.exists(os.path.join(simdir, ss, ARCHIVE_MARKER)):
+            _strip(simdir, ss, manifest["archives"][ss]["archive"])
+    for dd in delete:
+        path = os.path.join(simdir, dd)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+    manifest["complete"] = True
+    _save_manifest(simdir, manifest)
+    return True
+
+def compact_suite(rundir, policy=None, codec="gz", threads=4, endz=2.01, output_file="output", dry_run=False, state=None):
+    """Compact every simulation in a suite which check_status reports complete.
+    policy is a RetentionPolicy (by default, keep only the last snapshot and its FOF table).
+    threads is the number of snapshots compressed at once.
+    state is passed to remake.check_status.
+    If dry_run is True, nothing is written and the plan is returned as a dictionary of simdir -> (archive, delete).
+    Otherwise returns a dictionary of simdir -> manifest."""
+    if policy is None:
+        policy = RetentionPolicy()
+    if codec not in CODECS:
+        raise ValueError("Unknown codec "+codec+", not one of "+str(sorted(CODECS)))
+    (outputs, completes, _) = remake.check_status(rundir, output_file=output_file, endz=endz, state=state)
+    plans = {}
+    manifests = {}
+    for (simdir, cc) in zip(outputs, completes):
+        simdir = os.path.normpath(simdir)
+        if not cc:
+            continue
+        manifests[simdir] = load_manifest(simdir)
+        if manifests[simdir]["complete"]:
+            continue
+        (archive, delete) = policy.plan(simdir, output_file)
+        #Snapshots archived by an interrupted run have only their Header left; do not archive them again.
+        archive = [ss for ss in archive if ss in manifests[simdir]["archives"] or not os.path.exists(os.path.join(simdir, ss, ARCHIVE_MARKER))]
+        plans[simdir] = (archive, delete)
+    if dry_run:
+        return plans
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        futures = {}
+        for (simdir, (archive, _)) in plans.items():
+            manifests[simdir]["codec"] = codec
+            for ss in archive:
+                if not manifests[simdir]["archives"].get(ss, {}).get("verified"):
+                    futures[pool.submit(_archive_task, simdir, ss, codec)] = (simdir, ss)
+        #Record each archive as soon as it is done, so an interrupted run can resume.
+        for future in concurrent.futures.as_completed(futures):
+            (simdir, ss) = futures[future]
+            manifests[simdir]["archives"][ss] = future.result()
+            _save_manifest(simdir, manifests[simdir])
+    for (simdir, plan) in plans.items():
+        if not _finish(simdir, plan, manifests[simdir]):
+            print("ERROR: archives failed verification, nothing deleted in ",simdir)
+    return manifests
@@ -0,0 +1,105 @@
+"""Module to build MP-Gadget safely when several suites or workers build at the same time.
+
+Each build happens in a private copy of the MP-Gadget source tree, so builds with different
+Options.mk files cannot overwrite each other. The binaries are stored in a cache shared between suites,
+keyed by a hash of the MP-Gadget git revision (and any uncommitted changes and untracked files), the Options.mk file and
+the cluster compiler flags. Identical configurations are then compiled once. A lock file for each key
+makes concurrent builds of the same configuration wait for the first to finish rather than duplicate it.
+The lock uses flock, which on some parallel filesystems needs the flock mount option."""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+#Binaries built by MP-Gadget's make, relative to the source tree.
+GADGET_BINARIES = ("gadget/MP-Gadget", "genic/MP-GenIC")
+
+def cache_dir():
+    """Directory for the build cache: $SIMRUNNER_BUILD_CACHE if set, otherwise in ~/.cache."""
+    cdir = os.environ.get("SIMRUNNER_BUILD_CACHE")
+    if not cdir:
+        cdir = "~/.cache/SimulationRunner/gadget-builds"
+    return os.path.expanduser(cdir)
+
+def build_key(gadget_dir, options, optimize):
+    """Hash identifying a build: the git revision of the source tree, a hash of any uncommitted changes
+    and untracked source files, the contents of Options.mk and the compiler flags.
+    The revision is read afresh each time, not from the memo in utils.get_git_hash,
+    as the source tree may be updated while a long-running process builds from it."""
+    sha = hashlib.sha256()
+    sha.update(subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=gadget_dir))
+    sha.update(subprocess.check_output(["git", "diff", "HEAD"], cwd=gadget_dir))
+    untracked = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard", "-z"], cwd=gadget_dir)
+    for fname in sorted(untracked.split(b"\0")):
+        if not fname:
+            continue
+        sha.update(fname)
+        with open(os.path.join(gadget_dir, fname.decode()), 'rb') as ufile:
+            sha.update(ufile.read())
+    sha.update(options.encode())
+    sha.update(optimize.encode())
+    return sha.hexdigest()
+
+@contextlib.contextmanager
+def _locked(lockfile):
+    """Hold an exclusive lock on a file."""
+    with open(lockfile, 'w') as lfile:
+        fcntl.flock(lfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lfile, fcntl.LOCK_UN)
+
+def gadget_build(gadget_dir, gadget_config, optimize, cachedir=None, make=("make", "-j")):
+    """Build MP-Gadget with an Options.mk file, or reuse a cached build of the same configuration.
+    Arguments:
+        gadget_dir - MP-Gadget source tree. It is not modified.
+        gadget_config - Options.mk file to build with.
+        optimize - the compiler flags, which are also in Options.mk but are included in the key explicitly.
+        cachedir - build cache directory, by default from cache_dir().
+        make - command to run the build.
+    Returns the directory containing the built binaries, at the same relative paths as in
+    the source tree, and the output of make (None if the build was cached)."""
+    if cachedir is None:
+        cachedir = cache_dir()
+    os.makedirs(cachedir, exist_ok=True)
+    with open(gadget_config, 'r') as cfile:
+        options = cfile.read()
+    key = build_key(gadget_dir, options, optimize)
+    artifact = os.path.join(cachedir, key)
+    #The artifact directory is only renamed into place once complete, so if it exists it can be used.
+    if os.path.isdir(artifact):
+        return artifact, None
+    with _locked(artifact+".lock"):
+        #Someone else may have finished the build while we waited for the lock.
+        if os.path.isdir(artifact):
+            return artifact, None
+        workdir = tempfile.mkdtemp(dir=cachedir, prefix=key[:16]+".build.")
+        try:
+            srcdir = os.path.join(workdir, "src")
+            #Object files may have been compiled with other options, so are not copied.
+            shutil.copytree(gadget_dir, srcdir, symlinks=True, ignore=shutil.ignore_patterns(".git", "*.o", "*.a", "Options.mk", *[os.path.basename(bb) for bb in GADGET_BINARIES]))
+            shutil.copy(gadget_config, os.path.join(srcdir, "Options.mk"))
+            try:
+                output = subprocess.check_output(list(make), cwd=srcdir, universal_newlines=True, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                print(e.output)
+                raise
+            outdir = os.path.join(workdir, "artifact")
+            for binary in GADGET_BINARIES:
+                if os.path.exists(os.path.join(srcdir, binary)):
+                    os.makedirs(os.path.dirname(os.path.join(outdir, binary)), exist_ok=True)
+                    shutil.copy2(os.path.join(srcdir, binary), os.path.join(outdir, binary))
+            if not os.path.exists(os.path.join(outdir, GADGET_BINARIES[0])):
+                raise RuntimeError("Build of "+gadget_dir+" did not produce "+GADGET_BINARIES[0]+"\n"+output)
+            with open(os.path.join(outdir, "build.json"), 'w') as bfile:
+                json.dump({"gadget_dir": gadget_dir, "gadget_git": subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=gadget_dir, universal_newlines=True), "optimize": optimize, "options": options, "make_output": output}, bfile)
+            os.rename(outdir, artifact)
+        finally:
+            shutil.rmtree(workdir)
+    return artifact, output
@@ -4,35 +4,60 @@ import argparse
 import os
 import scipy.interpolate as interp
 import numpy as np
-import matplotlib
-matplotlib.use("PDF")
-import matplotlib.pyplot as plt
-from nbodykit.lab import BigFileCatalog,FFTPower
+#matplotlib and nbodykit are slow to import and only needed
+#when actually checking ICs, so they are imported by the functions that use them.
+
+def _modecount_edges(logkk, modes, minmodes, mdlogk):
+    """Find the edges of bins which each contain at least minmodes modes and span at least mdlogk in log k.
+    Bins start at index 1 and the partial bin at the end is discarded, as for the original loop.
+    Each bin boundary is found with a binary search on the cumulative mode count and on log k,
+    so the cost is one searchsorted per bin rather than a python iteration per mode.
+    Returns the start index of each bin, with the end of the last bin appended."""
+    nk = np.size(logkk)
+    cummodes = np.cumsum(modes)
+    edges = [1]
+    istart = 1
+    while istart < nk - 1:
+        #Last mode in the bin: the first at which we have enough modes and have moved far enough in k.
+        jmodes = np.searchsorted(cummodes, cummodes[istart-1] + minmodes, side='left')
+        jlogk = np.searchsorted(logkk, mdlogk+logkk[istart], side='left')
+        iend = max(jmodes, jlogk, istart) + 1
+        if iend > nk - 1:
+            break
+        edges.append(iend)
+        istart = iend
+    return np.array(edges)
 
 def modecount_rebin(kk, pk, modes, pkc, minmodes=250, ndesired=200):
-    """Rebins a power spectrum so that there are sufficient modes in each bin"""
+    """Rebins a power spectrum so that there are sufficient modes in each bin.
+    pk may be a single power spectrum or a 2D array of spectra, one per row,
+    which share the k bins and mode counts, for example one for each particle species.
+    In that case pkc is a list of reference power spectrum functions, one for each row.
+    kk must be sorted."""
     assert np.all(kk) > 0
     logkk=np.log10(kk)
+    assert np.all(np.diff(logkk) >= 0)
     mdlogk = (np.max(logkk) - np.min(logkk))/ndesired
-    istart=iend=1
-    count=0
-    pk_div = pk /pkc(kk)
-    k_list=[kk[0]]
-    pk_list=[pk_div[0]]
-    targetlogk=mdlogk+logkk[istart]
-    while iend < np.size(logkk)-1:
-        count+=modes[iend]
-        iend+=1
-        if count >= minmodes and logkk[iend-1] >= targetlogk:
-            pk1 = np.sum(modes[istart:iend]*pk_div[istart:iend])/count
-            kk1 = np.sum(modes[istart:iend]*kk[istart:iend])/count
-            k_list.append(kk1)
-            pk_list.append(pk1)
-            istart=iend
-            targetlogk=mdlogk+logkk[istart]
-            count=0
-    k_list = np.array(k_list)
-    pk_list = np.array(pk_list) * pkc(k_list)
+    pk = np.asarray(pk)
+    batch = np.ndim(pk) == 2
+    pks = np.atleast_2d(pk)
+    pkcs = pkc if batch else [pkc,]
+    assert len(pkcs) == np.shape(pks)[0]
+    pk_div = np.array([pp/cc(kk) for (pp, cc) in zip(pks, pkcs)])
+    edges = _modecount_edges(logkk, modes, minmodes, mdlogk)
+    if np.size(edges) > 1:
+        #reduceat sums from each edge to the next: drop the sum from the last edge to the end.
+        counts = np.add.reduceat(modes, edges)[:-1]
+        kk1 = np.add.reduceat(modes*kk, edges)[:-1]/counts
+        pk1 = np.add.reduceat(modes*pk_div, edges, axis=1)[:,:-1]/counts
+    else:
+        kk1 = np.array([])
+        pk1 = np.zeros((np.shape(pks)[0], 0))
+    k_list = np.concatenate([[kk[0],], kk1])
+    pk_list = np.concatenate([pk_div[:,:1], pk1], axis=1)
+    pk_list = np.array([pp*cc(k_list) for (pp, cc) in zip(pk_list, pkcs)])
+    if not batch:
+        pk_list = pk_list[0]
     return (k_list, pk_list)
 
 class CLASSPowerSpectrum(object):
@@ -65,13 +90,22 @@ class CLASSPowerSpectrum(object):
             return self.dpk
         return self.dtk[species]
 
+def _check_range(kk_ic, npart):
+    """Indices of the range of k in which the IC power is checked:
+    between 1/4 the box and 1/4 the nyquist frequency."""
+    mink = np.min(kk_ic)
+    imax = np.searchsorted(kk_ic, npart*mink/4)
+    imin = np.searchsorted(kk_ic, mink*4)
+    return imin, imax
+
 def plot_ic_power(kk_ic, Pk_ic, Pk_camb, npart, sp=1, outdir="."):
     """Make the plot"""
+    import matplotlib
+    matplotlib.use("PDF")
+    import matplotlib.pyplot as plt
     #Make some useful figures
     #Check that they agree between 1/4 the box and 1/4 the nyquist frequency
-    mink = np.min(kk_ic)
-    imax = np.searchsorted(kk_ic, npart*mink/4)
-    imin = np.searchsorted(kk_ic, mink*4)
+    (imin, imax) = _check_range(kk_ic, npart)
     plt.semilogx(kk_ic, Pk_ic/Pk_camb,linewidth=2)
     plt.semilogx([kk_ic[0]*0.9,kk_ic[-1]*1.1], [0.95,0.95], ls="--",linewidth=2)
     plt.semilogx([kk_ic[0]*0.9,kk_ic[-1]*1.1], [1.05,1.05], ls="--",linewidth=2)
@@ -88,9 +122,41 @@ def plot_ic_power(kk_ic, Pk_ic, Pk_camb, npart, sp=1, outdir="."):
     error = Pk_ic[imin:imax]/Pk_camb[imin:imax] -1
     return error
 
-def check_ic_power_spectra(genicfileout, camb_zstr, outdir=".", accuracy=0.07, m_nu=0):
+def save_ic_power(kk_ic, Pk_ic, Pk_camb, npart, sp=1, outdir="."):
+    """Save the rebinned IC power, the reference power and the error to ICS/PK-IC-<sp>.npz,
+    instead of plotting them. The plots can be made later with render_ic_power.
+    Returns the error in the checked range, as plot_ic_power does."""
+    (imin, imax) = _check_range(kk_ic, npart)
+    error = Pk_ic[imin:imax]/Pk_camb[imin:imax] -1
+    np.savez(os.path.join(outdir,"ICS/PK-IC-"+str(sp)+".npz"), k=kk_ic, pk_ic=Pk_ic, pk_camb=Pk_camb, error=error, npart=npart, sp=sp)
+    return error
+
+def render_ic_power(npzfile):
+    """Make the plots for IC power saved by save_ic_power. The plots go next to the saved file.
+    Returns the name of the file."""
+    diag = np.load(npzfile)
+    outdir = os.path.dirname(os.path.dirname(os.path.abspath(npzfile)))
+    plot_ic_power(diag['k'], diag['pk_ic'], diag['pk_camb'], npart=int(diag['npart']), sp=int(diag['sp']), outdir=outdir)
+    return npzfile
+
+def render_suite_ic_power(rundir, nproc=None):
+    """Make the IC power plots for every simulation in a suite which saved them with save_ic_power,
+    using nproc processes (by default one per CPU). Meant to be run on a login or analysis node.
+    Returns the list of rendered files."""
+    import glob
+    import multiprocessing
+    npzfiles = sorted(glob.glob(os.path.join(os.path.expanduser(rundir), "*", "ICS", "PK-IC-*.npz")))
+    if not npzfiles:
+        return []
+    with multiprocessing.Pool(nproc) as pool:
+        return pool.map(render_ic_power, npzfiles)
+
+def check_ic_power_spectra(genicfileout, camb_zstr, outdir=".", accuracy=0.07, m_nu=0, headless=False):
     """Generate the power spectrum for each particle type from the generated simulation files
-    and check that it matches the input. This is a consistency test on each simulation output."""
+    and check that it matches the input. This is a consistency test on each simulation output.
+    If headless is True, the power spectra are saved to .npz files rather than plotted,
+    so that matplotlib is not needed."""
+    from nbodykit.lab import BigFileCatalog,FFTPower
     #Generate power spectra
     output = os.path.join(outdir, genicfileout)
     #Now check that they match what we put into the simulation, from CAMB
@@ -109,7 +175,9 @@ def check_ic_power_spectra(genicfileout, camb_zstr, outdir=".", accuracy=0.07, m
     npart = int(np.round(np.cbrt(cats[1].attrs['TotNumPart'][1])))
     assert npart > 0
     cambpow = CLASSPowerSpectrum(matterpow, transfer,omega0=omega0, omegab=omegab, omeganu=m_nu/93.14/hubble**2)
-    for sp in cats.keys():
+    species = list(cats.keys())
+    power = {}
+    for sp in species:
         #GenPK output is at PK-[nu,by,DM]-basename(genicfileout)
         cats[sp].to_mesh(Nmesh=npart*2, window='cic', compensated=True, interlaced=True)
         pk = FFTPower(cats[sp], mode='1d', Nmesh=npart*2, dk=5.0e-6)
@@ -120,17 +188,29 @@ def check_ic_power_spectra(genicfileout, camb_zstr, outdir=".", accuracy=0.07, m
         Pk_ic = pk.power['power'][1:].real/1e9
         modes_ic = pk.power['modes'][1:]
         ii = np.isfinite(kk_ic)
-        kk_ic = kk_ic[ii]
-        Pk_ic = Pk_ic[ii]
-        #Load the power spectrum. Note that DM may be total.
-        ccsp = sp
-        if len(cats) == 1:
-            ccsp = -1
-            if m_nu > 0:
-                ccsp = 3
-        Pk_camb = cambpow.get_class_power(species=ccsp)
-        (kk_ic, Pk_ic) = modecount_rebin(kk_ic, Pk_ic, modes_ic[ii], Pk_camb, ndesired=npart//2)
-        error = plot_ic_power(kk_ic, Pk_ic, Pk_camb(kk_ic), sp=sp, npart=npart, outdir=outdir)
+        power[sp] = (kk_ic[ii], Pk_ic[ii], modes_ic[ii])
+    #Load the power spectrum. Note that DM may be total.
+    if len(cats) == 1:
+        ccsp = -1
+        if m_nu > 0:
+            ccsp = 3
+        Pk_camb = {species[0]: cambpow.get_class_power(species=ccsp)}
+    else:
+        Pk_camb = {sp: cambpow.get_class_power(species=sp) for sp in species}
+    #All species are binned on the same mesh, so usually share k bins and mode counts.
+    #In that case rebin them all in one call.
+    (kk_ic, _, modes_ic) = power[species[0]]
+    if all([np.array_equal(power[sp][0], kk_ic) and np.array_equal(power[sp][2], modes_ic) for sp in species]):
+        (kk_reb, Pk_reb) = modecount_rebin(kk_ic, np.array([power[sp][1] for sp in species]), modes_ic, [Pk_camb[sp] for sp in species], ndesired=npart//2)
+        rebinned = {sp: (kk_reb, Pk_reb[i]) for (i, sp) in enumerate(species)}
+    else:
+        rebinned = {sp: modecount_rebin(power[sp][0], power[sp][1], power[sp][2], Pk_camb[sp], ndesired=npart//2) for sp in species}
+    for sp in species:
+        (kk_ic, Pk_ic) = rebinned[sp]
+        if headless:
+            error = save_ic_power(kk_ic, Pk_ic, Pk_camb[sp](kk_ic), sp=sp, npart=npart, outdir=outdir)
+        else:
+            error = plot_ic_power(kk_ic, Pk_ic, Pk_camb[sp](kk_ic), sp=sp, npart=npart, outdir=outdir)
         #Don't worry too much about one failing mode.
         if np.size(np.where(error > accuracy)) > 3:
             raise RuntimeError("Pk accuracy check failed for "+str(sp)+". Max error: "+str(np.max(error)))
@@ -140,5 +220,6 @@ if __name__ == "__main__":
     parser.add_argument('genicfile', type=str, help='File with generated ICs')
     parser.add_argument('--czstr', type=str, help='Redshift string used in class files',required=True)
     parser.add_argument('--mnu', default=0, type=float,help='Sum of neutrino masses',required=False)
+    parser.add_argument('--headless', action='store_true', help='Save the power spectra to npz files instead of plotting them')
     args = parser.parse_args()
-    check_ic_power_spectra(args.genicfile, camb_zstr = args.czstr, m_nu=args.mnu)
+    check_ic_power_spectra(args.genicfile, camb_zstr = args.czstr, m_nu=args.mnu, headless=args.headless)
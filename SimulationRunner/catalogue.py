@@ -0,0 +1,213 @@
+"""Module for a persistent catalogue of every snapshot, FOF table and IC set in a suite.
+
+Finding snapshots by globbing and parsing each BigFile header is repeated by every status check.
+Here the headers are parsed once and stored in an SQLite database in the run directory,
+with the redshift, particle counts, number of FOF groups, size on disc and modification time.
+Updates are incremental: only output directories whose modification time changed are listed,
+and only new or changed snapshots (and the last snapshot of each simulation, which may still be
+being written) are parsed again. Queries like 'all z=3 snapshots in the suite' are then an indexed lookup."""
+import os
+import os.path
+import re
+import sqlite3
+import json
+
+#Kinds of directory in the catalogue: (name of the kind, subdirectory of the simulation, regex for the directory name)
+KINDS = (("PART", "output", re.compile(r"^PART_([0-9]{3})$")),
+         ("PIG", "output", re.compile(r"^PIG_([0-9]{3})$")),
+         ("ICS", "ICS", re.compile(r"^(.+)$")))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (path TEXT PRIMARY KEY, sim TEXT, kind TEXT, snapnum INTEGER,
+    redshift REAL, time REAL, npart TEXT, ntotal INTEGER, ngroups INTEGER, size INTEGER, mtime REAL);
+CREATE INDEX IF NOT EXISTS snapshots_redshift ON snapshots (kind, redshift);
+CREATE INDEX IF NOT EXISTS snapshots_sim ON snapshots (sim, kind, snapnum);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL);
+"""
+
+def read_header(snapdir):
+    """Read the attributes of a BigFile snapshot header, Header/attr-v2, into a dictionary of lists of values."""
+    attrs = {}
+    with open(os.path.join(snapdir, "Header", "attr-v2"), 'r') as fh:
+        for line in fh:
+            (name, _, humane) = line.partition("#HUMANE [")
+            if not humane:
+                continue
+            values = humane.rsplit("]", 1)[0].split()
+            try:
+                attrs[name.split()[0]] = [float(vv) for vv in values]
+            except ValueError:
+                continue
+    return attrs
+
+def block_rows(blockdir):
+    """Number of rows in a BigFile block, from the sizes of its files in the block header."""
+    rows = 0
+    with open(os.path.join(blockdir, "header"), 'r') as fh:
+        for line in fh:
+            match = re.match(r"^[0-9A-Fa-f]{6}\s*:\s*([0-9]+)\s*:", line)
+            if match is not None:
+                rows += int(match.group(1))
+    return rows
+
+def _disc_usage(path):
+    """Total size in bytes of the files in a directory tree."""
+    total = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        for fname in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fname)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+def _snapshot_mtime(snapdir):
+    """Latest modification time of a snapshot directory and its immediate subdirectories (the blocks),
+    which changes when any block is written."""
+    mtime = os.stat(snapdir).st_mtime
+    with os.scandir(snapdir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+def scan_snapshot(snapdir, kind):
+    """Parse a snapshot directory into a catalogue entry. Returns None if it has no header yet."""
+    try:
+        attrs = read_header(snapdir)
+    except FileNotFoundError:
+        return None
+    time = attrs.get("Time", [None])[0]
+    npart = [int(nn) for nn in attrs.get("TotNumPart", [])]
+    ngroups = None
+    if kind == "PIG":
+        try:
+            ngroups = block_rows(os.path.join(snapdir, "FOFGroups", "Mass"))
+        except FileNotFoundError:
+            pass
+    return {"redshift": 1./time - 1 if time else None, "time": time, "npart": npart, "ntotal": sum(npart),
+            "ngroups": ngroups, "size": _disc_usage(snapdir), "mtime": _snapshot_mtime(snapdir)}
+
+class Catalogue(object):
+    """Catalogue of the snapshots in a run directory, containing one simulation per subdirectory.
+
+    Init parameters:
+    rundir - directory containing the simulations.
+    dbfile - SQLite database file. By default, .snapshot_catalogue.sqlite in rundir.
+    """
+    def __init__(self, rundir, dbfile=None):
+        self.rundir = os.path.realpath(os.path.expanduser(rundir))
+        if dbfile is None:
+            dbfile = os.path.join(self.rundir, ".snapshot_catalogue.sqlite")
+        self.dbfile = dbfile
+        self._db = sqlite3.connect(dbfile, timeout=60)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+    def update(self):
+        """Bring the catalogue up to date with the disc. Returns the number of entries added, changed or removed."""
+        changed = 0
+        with self._db:
+            dirs = {row["path"]: row["mtime"] for row in self._db.execute("SELECT path, mtime FROM dirs")}
+            #Catalogued entries, grouped by the directory containing them.
+            known = {}
+            for row in self._db.execute("SELECT path, sim, kind, snapnum, mtime FROM snapshots"):
+                known.setdefault(os.path.dirname(row["path"]), {})[row["path"]] = row
+            sims = sorted([entry.name for entry in os.scandir(self.rundir) if entry.is_dir() and not entry.name.startswith(".")])
+            for sim in sims:
+                for subdir in sorted(set([kk[1] for kk in KINDS])):
+                    path = os.path.join(self.rundir, sim, subdir)
+                    changed += self._update_dir(sim, subdir, dirs.get(path), known.pop(path, {}))
+            #Anything left is in a directory which no longer exists.
+            for gone in known.values():
+                changed += self._delete(gone)
+        return changed
+
+    def _delete(self, paths):
+        """Remove entries from the catalogue."""
+        self._db.executemany("DELETE FROM snapshots WHERE path = ?", [(pp,) for pp in paths])
+        return len(paths)
+
+    def _update_dir(self, sim, subdir, dir_mtime, known):
+        """Update the entries in one output directory of a simulation.
+        dir_mtime is the modification time of the directory when it was last listed, and known its catalogued entries."""
+        path = os.path.join(self.rundir, sim, subdir)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return self._delete(list(known))
+        if dir_mtime == mtime:
+            #No snapshots were added or removed: only check the last of each kind, which may still be being written.
+            last = {}
+            for row in known.values():
+                if row["snapnum"] >= last.get(row["kind"], (-1, None))[0]:
+                    last[row["kind"]] = (row["snapnum"], row["path"])
+            return self._scan(sim, [(known[pp]["kind"], known[pp]["snapnum"], pp) for (_, pp) in last.values()], known)[0]
+        candidates = []
+        for entry in os.scandir(path):
+            if not entry.is_dir():
+                continue
+            for (kind, ksub, regex) in KINDS:
+                match = regex.match(entry.name)
+                if ksub == subdir and match is not None:
+                    snapnum = int(match.group(1)) if kind != "ICS" else 0
+                    candidates.append((kind, snapnum, entry.path))
+                    break
+        changed = self._delete(list(set(known) - set([cc[2] for cc in candidates])))
+        (nscan, incomplete) = self._scan(sim, candidates, known)
+        #If a snapshot has no header yet, list the directory again next time so it is found when the header is written.
+        if not incomplete:
+            self._db.execute("INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)", (path, mtime))
+        return changed + nscan
+
+    def _scan(self, sim, candidates, known):
+        """Parse the candidate snapshots which are new or have changed since they were catalogued.
+        Returns the number of entries changed and whether any candidate had no header yet."""
+        changed = 0
+        incomplete = False
+        for (kind, snapnum, snapdir) in candidates:
+            try:
+                if snapdir in known and known[snapdir]["mtime"] == _snapshot_mtime(snapdir):
+                    continue
+            except FileNotFoundError:
+                continue
+            entry = scan_snapshot(snapdir, kind)
+            if entry is None:
+                incomplete = True
+                continue
+            self._db.execute("INSERT OR REPLACE INTO snapshots VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                             (snapdir, sim, kind, snapnum, entry["redshift"], entry["time"], json.dumps(entry["npart"]),
+                              entry["ntotal"], entry["ngroups"], entry["size"], entry["mtime"]))
+            changed += 1
+        return changed, incomplete
+
+    def _rows(self, query, args):
+        """Run a query and convert the rows to dictionaries."""
+        rows = []
+        for row in self._db.execute(query, args):
+            row = dict(row)
+            row["npart"] = json.loads(row["npart"])
+            rows.append(row)
+        return rows
+
+    def find(self, redshift=None, tol=0.01, kind="PART", sim=None):
+        """Find catalogued snapshots of a kind ('PART', 'PIG' or 'ICS'), optionally near a redshift and for one simulation.
+        Returns a list of dictionaries, sorted by simulation and snapshot number."""
+        query = "SELECT * FROM snapshots WHERE kind = ?"
+        args = [kind]
+        if redshift is not None:
+            query += " AND redshift BETWEEN ? AND ?"
+            args += [redshift - tol, redshift + tol]
+        if sim is not None:
+            query += " AND sim = ?"
+            args.append(sim)
+        return self._rows(query+" ORDER BY sim, snapnum", args)
+
+    def latest(self, kind="PART"):
+        """The last snapshot of a kind for every simulation. Returns a dictionary of simulation name -> entry."""
+        rows = self._rows("SELECT * FROM snapshots WHERE kind = ? AND snapnum = (SELECT MAX(snapnum) FROM snapshots AS s2 WHERE s2.sim = snapshots.sim AND s2.kind = snapshots.kind)", [kind])
+        return {row["sim"]: row for row in rows}
@@ -0,0 +1,137 @@
+"""Module to choose the cheapest CLASS precision settings for massive neutrinos which meet a target accuracy.
+
+The default neutrino precision settings in cambfile take several minutes per cosmology.
+Often much looser settings are accurate enough. Here we run a short ladder of CLASS solves
+with progressively tighter neutrino settings, compare the total matter power and the neutrino
+power to a reference solve, and pick the cheapest setting which meets the target accuracy.
+The choice is cached by neutrino mass bucket and maximum k, so the rest of a suite reuses it."""
+import json
+import os
+import os.path
+import time
+import numpy as np
+
+#Ladder of neutrino precision settings, from loosest to tightest.
+#The fluid trigger is scaled by the neutrino mass, as in cambfile: lighter neutrinos need less time.
+PRECISION_LADDER = [
+    {'tol_ncdm_newtonian': 1e-3, 'tol_ncdm_synchronous': 1e-3, 'l_max_ncdm': 17, 'ncdm_fluid_trigger_tau_over_tau_k': 100.},
+    {'tol_ncdm_newtonian': 1e-4, 'tol_ncdm_synchronous': 1e-4, 'l_max_ncdm': 20, 'ncdm_fluid_trigger_tau_over_tau_k': 1000.},
+    {'tol_ncdm_newtonian': 1e-5, 'tol_ncdm_synchronous': 1e-4, 'l_max_ncdm': 30, 'ncdm_fluid_trigger_tau_over_tau_k': 10000.},
+    {'tol_ncdm_newtonian': 1e-5, 'tol_ncdm_synchronous': 1e-5, 'l_max_ncdm': 50, 'ncdm_fluid_trigger_tau_over_tau_k': 30000.},
+]
+
+#Default location of the cache of tuned settings, shared between suites.
+DEFAULT_CACHE = os.path.expanduser("~/.cache/SimulationRunner/class_precision.json")
+
+def _ladder_settings(rung, m_nu):
+    """Get the settings for one rung of the ladder, with the fluid trigger scaled by neutrino mass."""
+    settings = dict(PRECISION_LADDER[rung])
+    settings['ncdm_fluid_trigger_tau_over_tau_k'] *= m_nu / 0.4
+    return settings
+
+def class_solve(params, redshifts):
+    """Run CLASS and get the matter and neutrino power spectra at some redshifts.
+    Returns a dictionary of redshift -> (k, P_tot(k), P_nu(k))."""
+    import classylss.binding as CLASS
+    engine = CLASS.ClassEngine(params)
+    powspec = CLASS.Spectra(engine)
+    spectra = {}
+    for zz in redshifts:
+        trans = powspec.get_transfer(z=zz)
+        kk = trans['k'][:-1]
+        pk_lin = powspec.get_pklin(k=kk, z=zz)
+        #Neutrino power from the ratio of the neutrino and total transfer functions
+        pk_nu = pk_lin * (trans['d_ncdm[0]'][:-1]/trans['d_tot'][:-1])**2
+        spectra[zz] = (kk, pk_lin, pk_nu)
+    return spectra
+
+def power_error(spectra, reference):
+    """Maximum relative error in the total and neutrino power spectra, compared to a reference solve.
+    The spectra are compared at the k values of the reference."""
+    tot_err = 0.
+    nu_err = 0.
+    for (zz, (kref, pref, pnuref)) in reference.items():
+        (kk, pk, pknu) = spectra[zz]
+        ptot = np.exp(np.interp(np.log(kref), np.log(kk), np.log(pk)))
+        pnu = np.exp(np.interp(np.log(kref), np.log(kk), np.log(pknu)))
+        tot_err = max(tot_err, np.max(np.abs(ptot/pref - 1)))
+        nu_err = max(nu_err, np.max(np.abs(pnu/pnuref - 1)))
+    return tot_err, nu_err
+
+def cache_key(m_nu, maxk, nu_acc, bucket=0.02):
+    """Key for the cache of tuned settings: the neutrino mass, rounded to a bucket, the maximum k
+    and the neutrino accuracy of the reference solve."""
+    return "%.3f_%.4g_%.3g" % (bucket*np.round(m_nu/bucket), maxk, nu_acc)
+
+def _load_cache(cachefile):
+    """Load the cache of tuned settings."""
+    try:
+        with open(cachefile, 'r') as cfile:
+            return json.load(cfile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_cache(cachefile, key, entry):
+    """Add an entry to the cache of tuned settings. The file is replaced atomically,
+    and re-read first so that entries written by other suites in the meantime are kept."""
+    cachedir = os.path.dirname(cachefile)
+    if cachedir and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    cache = _load_cache(cachefile)
+    cache[key] = entry
+    tmpfile = cachefile+".tmp."+str(os.getpid())
+    with open(tmpfile, 'w') as cfile:
+        json.dump(cache, cfile, indent=1)
+    os.replace(tmpfile, cachefile)
+
+def tune_precision(params, m_nu, redshifts, target=1e-3, nu_target=1e-2, solver=class_solve):
+    """Find the cheapest rung of the precision ladder which matches a reference solve.
+    Arguments:
+        params - CLASS parameters, including the reference neutrino precision settings.
+        m_nu - total neutrino mass.
+        redshifts - redshifts at which to compare the power spectra.
+        target - maximum relative error in the total matter power.
+        nu_target - maximum relative error in the neutrino power.
+        solver - function which runs CLASS, with the signature of class_solve.
+    Returns a dictionary with the chosen settings, the errors achieved and the wall times of the solves.
+    If no rung meets the target, the reference settings are chosen.
+    A rung with the reference settings is not solved again: it is the reference."""
+    start = time.time()
+    reference = solver(params, redshifts)
+    ref_time = time.time() - start
+    ref_settings = {key: params[key] for key in PRECISION_LADDER[0] if key in params}
+    chosen = {'settings': ref_settings, 'tot_error': 0., 'nu_error': 0., 'time': ref_time, 'reference_time': ref_time, 'rung': -1}
+    #The rungs get more expensive as we go up the ladder, so the first which works is the cheapest.
+    for rung in range(len(PRECISION_LADDER)):
+        settings = _ladder_settings(rung, m_nu)
+        if sorted(settings) == sorted(ref_settings) and all([np.isclose(settings[key], ref_settings[key]) for key in settings]):
+            chosen = {'settings': settings, 'tot_error': 0., 'nu_error': 0., 'time': ref_time, 'reference_time': ref_time, 'rung': rung}
+            break
+        trial = dict(params)
+        trial.update(settings)
+        start = time.time()
+        spectra = solver(trial, redshifts)
+        wall = time.time() - start
+        (tot_err, nu_err) = power_error(spectra, reference)
+        if tot_err <= target and nu_err <= nu_target:
+            chosen = {'settings': settings, 'tot_error': float(tot_err), 'nu_error': float(nu_err), 'time': wall, 'reference_time': ref_time, 'rung': rung}
+            break
+    return chosen
+
+def tuned_precision(params, m_nu, maxk, redshifts, target=1e-3, nu_target=1e-2, cachefile=DEFAULT_CACHE, solver=class_solve, nu_acc=None):
+    """Get neutrino precision settings for CLASS which meet a target accuracy,
+    tuning them if there is nothing suitable in the cache.
+    Cached settings are reused if they were tuned for the same neutrino mass bucket, maximum k
+    and reference accuracy nu_acc (by default the tol_ncdm_synchronous of params),
+    and for an accuracy target at least as tight. Returns the settings dictionary."""
+    if nu_acc is None:
+        nu_acc = params['tol_ncdm_synchronous']
+    key = cache_key(m_nu, maxk, nu_acc)
+    entry = _load_cache(cachefile).get(key)
+    if entry is not None and entry['target'] <= target and entry['nu_target'] <= nu_target:
+        return entry['settings']
+    entry = tune_precision(params, m_nu, redshifts, target=target, nu_target=nu_target, solver=solver)
+    entry['target'] = target
+    entry['nu_target'] = nu_target
+    _save_cache(cachefile, key, entry)
+    return entry['settings']
@@ -1,5 +1,7 @@
 """Specialised module to contain functions to specialise the simulation run to different clusters"""
 import os.path
+import re
+import shlex
 
 class ClusterClass:
     """Generic class implementing some general defaults for cluster submissions."""
@@ -15,16 +17,48 @@ class ClusterClass:
         self.gadgetparam = param
         self.genicexe=genic
         self.genicparam=genicparam
+        #Fast storage to run MP-Gadget from, eg, a node-local disc ($TMPDIR) or a burst buffer ($DW_JOB_STRIPED).
+        #None runs in the simulation directory. Node-local storage is only correct for jobs on a single node.
+        self.scratch = None
+        #Number of parallel copies when staging the ICs in.
+        self.stage_threads = 8
+        #Seconds between copies of finished snapshots back to the simulation directory.
+        self.stage_sync = 600
+        #Cores (or hardware threads) per node, and the default (MPI tasks per node, OpenMP threads per task).
+        #Clusters which set these can have their layout tuned with layout.calibrate.
+        self.cores_per_node = None
+        self.layout = None
 
-    def generate_mpi_submit(self, outdir):
+    def ncores(self):
+        """Number of cores (or hardware threads) used by each MPI job."""
+        return self.nproc
+
+    def layouts(self):
+        """Candidate (MPI tasks per node, OpenMP threads per task) layouts which fill a node."""
+        if self.cores_per_node is None:
+            raise ValueError(type(self).__name__+" does not set cores_per_node, so its layout cannot be tuned")
+        return [(self.cores_per_node//threads, threads) for threads in range(1, self.cores_per_node+1) if self.cores_per_node % threads == 0]
+
+    def generate_mpi_submit(self, outdir, npart=None, separate_gas=True):
         """Generate a sample mpi_submit file.
+        If npart is given and a layout has been calibrated for this cluster and particle load, it is used
+        for this script only: the default layout of the cluster is left alone.
         The prefix argument is a string at the start of each line.
         It separates queueing system directives from normal comments"""
         name = os.path.basename(os.path.normpath(outdir))
-        with open(os.path.join(outdir, "mpi_submit"),'w') as mpis:
-            mpis.write("#!/bin/bash\n")
-            mpis.write(self._queue_directive(name, timelimit=self.timelimit, nproc=self.nproc))
-            mpis.write(self._mpi_program(command=self.gadgetexe+" "+self.gadgetparam))
+        default = self.layout
+        if npart is not None and self.cores_per_node is not None:
+            from . import layout
+            best = layout.best_layout(self, npart, separate_gas)
+            if best is not None:
+                self.layout = best
+        try:
+            with open(os.path.join(outdir, "mpi_submit"),'w') as mpis:
+                mpis.write("#!/bin/bash\n")
+                mpis.write(self._queue_directive(name, timelimit=self.timelimit, nproc=self.nproc))
+                mpis.write(self._staged_program(command=self.gadgetexe+" "+self.gadgetparam))
+        finally:
+            self.layout = default
 
     def generate_mpi_submit_genic(self, outdir, extracommand=None):
         """Generate a sample mpi_submit file for MP-GenIC.
@@ -38,11 +72,120 @@ class ClusterClass:
             if extracommand is not None:
                 mpis.write(extracommand+"\n")
 
+    def generate_mpi_submit_genic_batch(self, batchdir, simulations, packs=1, per_sim=0.25):
+        """Generate one submit file, batchdir/mpi_submit_genic_batch, which runs MP-GenIC for many simulations in one job.
+        simulations is a list of (simulation directory, command to check the ICs or None).
+        The simulations are split between packs lanes, which run at once on packs times the processors of one
+        MP-GenIC job, and each lane runs MP-GenIC in its simulations in turn on its own share of the processors,
+        given by _lane_program. The IC check of each simulation runs
+        in the background while the next MP-GenIC runs. Each result is appended to batchdir/genic_batch_status
+        as '<directory> genic|check ok|failed'. per_sim is the time in hours allowed for each MP-GenIC run."""
+        lanes = [simulations[ii::packs] for ii in range(packs) if simulations[ii::packs]]
+        with open(os.path.join(batchdir, "mpi_submit_genic_batch"),'w') as mpis:
+            mpis.write("#!/bin/bash\n")
+            mpis.write(self._queue_directive("genic_batch", timelimit=per_sim*max([len(ll) for ll in lanes]), nproc=self.nproc*len(lanes)))
+            mpis.write("SIMRUNNER_BATCHDIR=$(pwd)\n")
+            mpis.write("SIMRUNNER_STATUS=$SIMRUNNER_BATCHDIR/genic_batch_status\n")
+            for lane in range(len(lanes)):
+                #A single lane has the whole job.
+                if len(lanes) == 1:
+                    lines = self._mpi_program(command=self.genicexe+" "+self.genicparam).splitlines()
+                else:
+                    lines = self._lane_program(command=self.genicexe+" "+self.genicparam, lane=lane).splitlines()
+                launch = [ii for (ii, ll) in enumerate(lines) if re.search("mpirun|mpiexec|ibrun|srun", ll)][-1]
+                mpis.write("simrunner_genic_%d() {\n" % lane)
+                mpis.write("".join(["    "+ll+"\n" for ll in lines[:launch]]))
+                mpis.write('    cd "$1" || { echo "$1 genic failed" >> $SIMRUNNER_STATUS; return; }\n')
+                mpis.write("    if "+lines[launch]+"; then\n")
+                mpis.write('        echo "$1 genic ok" >> $SIMRUNNER_STATUS\n')
+                mpis.write('        if [ -n "$2" ]; then\n')
+                mpis.write('            (if eval "$2" > ic_check.log 2>&1; then echo "$1 check ok"; else echo "$1 check failed"; fi >> $SIMRUNNER_STATUS) &\n')
+                mpis.write("        fi\n    else\n")
+                mpis.write('        echo "$1 genic failed" >> $SIMRUNNER_STATUS\n    fi\n')
+                mpis.write("".join(["    "+ll+"\n" for ll in lines[launch+1:]]))
+                mpis.write("    cd $SIMRUNNER_BATCHDIR\n}\n")
+            #Wait for the background IC checks of the lane before it exits.
+            mpis.write('simrunner_lane() {\n    lane=$1\n    shift\n    while [ $# -gt 0 ]; do\n        simrunner_genic_$lane "$1" "$2"\n        shift 2\n    done\n    wait\n}\n')
+            for (ii, lane) in enumerate(lanes):
+                mpis.write("simrunner_lane %d " % ii+" ".join([shlex.quote(outdir)+" "+shlex.quote(check or "") for (outdir, check) in lane])+" &\n")
+            mpis.write("wait\n")
+
+    def _lane_program(self, command, lane):
+        """The MPI program for one lane of a batch job, which runs on its own nproc of the processors of the job.
+        On PBS each lane gets its own nproc lines of $PBS_NODEFILE as a hostfile."""
+        lines = self._mpi_program(command).splitlines(True)
+        launch = [ii for (ii, ll) in enumerate(lines) if re.search("mpirun|mpiexec|ibrun|srun", ll)][-1]
+        hosts = "$SIMRUNNER_BATCHDIR/hosts.%d" % lane
+        if "$PBS_NODEFILE" in lines[launch]:
+            lines[launch] = lines[launch].replace("$PBS_NODEFILE", hosts)
+        else:
+            lines[launch] = re.sub("(mpirun|mpiexec)", r"\1 -hostfile "+hosts, lines[launch], count=1)
+        lines.insert(launch, "sed -n '%d,%dp' $PBS_NODEFILE > %s\n" % (lane*self.nproc+1, (lane+1)*self.nproc, hosts))
+        return "".join(lines)
+
+    def _srun_lane_program(self, command, threads, setup=""):
+        """Lane program for Slurm: an exclusive job step on nproc/cores_per_node nodes of the job."""
+        nodes = self.ncores() // self.cores_per_node
+        qstring = setup+"export OMP_NUM_THREADS="+str(threads)+"\n"
+        qstring += "srun --exclusive --nodes=%d --ntasks=%d --cpus-per-task=%d %s\n" % (nodes, nodes*self.layout[0], threads, command)
+        return qstring
+
     def _mpi_program(self, command):
         """String for MPI program to execute"""
         qstring = "mpirun -np "+str(self.nproc)+" "+command+"\n"
         return qstring
 
+    def _staged_program(self, command):
+        """The MPI program, run from self.scratch if it is set.
+        Before the MPI launch line (so after any cd in _mpi_program), the files in the simulation directory
+        and the ICS and output directories are copied to scratch in parallel, and the program is run there.
+        Snapshots are copied back in the background as they are finished, and everything is copied back
+        when the job exits, even if it fails or is killed at the time limit. Scratch is only removed
+        if the final copy succeeded."""
+        program = self._mpi_program(command)
+        if self.scratch is None:
+            return program
+        lines = program.splitlines(True)
+        launch = [ii for (ii, ll) in enumerate(lines) if re.search("mpirun|mpiexec|ibrun|srun", ll)][-1]
+        stage = "#Run from fast scratch storage\n"
+        stage += "SIMRUNNER_RUNDIR=$(pwd)\n"
+        stage += "SIMRUNNER_SCRATCH="+self.scratch+"/simrunner-$(basename $SIMRUNNER_RUNDIR)-${SLURM_JOB_ID:-${PBS_JOBID:-$$}}\n"
+        stage += "mkdir -p $SIMRUNNER_SCRATCH/output || exit 1\n"
+        stage += "find . -maxdepth 1 -type f -exec cp -p {} $SIMRUNNER_SCRATCH/ \\; || exit 1\n"
+        stage += "for dd in ICS output; do [ -d $dd ] && find $dd -type f -print0; done | xargs -0 -r -P "+str(self.stage_threads)+" -n 64 cp -p --parents -t $SIMRUNNER_SCRATCH || exit 1\n"
+        stage += """simrunner_copy_back() {
+    #Until the run has finished, skip the newest snapshot, which may still be being written.
+    skip=""
+    if [ "$1" != "final" ]; then
+        skip=$(ls -d $SIMRUNNER_SCRATCH/output/PART_[0-9][0-9][0-9] 2>/dev/null | tail -n 1)
+        skip=${skip##*_}
+    fi
+    mkdir -p $SIMRUNNER_RUNDIR/output || return 1
+    for ff in $SIMRUNNER_SCRATCH/output/*; do
+        [ -e "$ff" ] || continue
+        case $(basename $ff) in PART_$skip|PIG_$skip) continue;; esac
+        cp -pRu $ff $SIMRUNNER_RUNDIR/output/ || return 1
+    done
+}
+simrunner_cleanup() {
+    pkill -P $SIMRUNNER_SYNC 2>/dev/null
+    kill $SIMRUNNER_SYNC 2>/dev/null
+    wait $SIMRUNNER_SYNC 2>/dev/null
+    cd $SIMRUNNER_RUNDIR
+    if simrunner_copy_back final; then
+        rm -rf $SIMRUNNER_SCRATCH
+    else
+        echo "Copy back failed: outputs are still in $SIMRUNNER_SCRATCH" >&2
+    fi
+}
+"""
+        stage += "(while sleep "+str(self.stage_sync)+"; do simrunner_copy_back; done) &\n"
+        stage += "SIMRUNNER_SYNC=$!\n"
+        stage += "trap simrunner_cleanup EXIT\n"
+        stage += "trap 'exit 143' TERM INT\n"
+        stage += "cd $SIMRUNNER_SCRATCH\n"
+        return "".join(lines[:launch]) + stage + "".join(lines[launch:])
+
     def timestring(self, timelimit):
         """Convert a fractional timelimit into a string"""
         hr = int(timelimit)
@@ -117,6 +260,8 @@ class MARCCClass(ClusterClass):
         assert nproc % 24 == 0
         super().__init__(*args, nproc=nproc,timelimit=timelimit, **kwargs)
         self.memory = 5000
+        self.cores_per_node = 24
+        self.layout = (24, 1)
 
     def _queue_directive(self, name, timelimit, nproc=48, prefix="#SBATCH"):
         """Generate mpi_submit with coma specific parts"""
@@ -126,9 +271,9 @@ class MARCCClass(ClusterClass):
         qstring += prefix+" --time="+self.timestring(timelimit)+"\n"
         qstring += prefix+" --nodes="+str(int(nproc/24))+"\n"
         #Number of tasks (processes) per node
-        qstring += prefix+" --ntasks-per-node=24\n"
+        qstring += prefix+" --ntasks-per-node="+str(self.layout[0])+"\n"
         #Number of cpus (threads) per task (process)
-        qstring += prefix+" --cpus-per-task=1\n"
+        qstring += prefix+" --cpus-per-task="+str(self.layout[1])+"\n"
         #Max 128 GB per node (24 cores)
         qstring += prefix+" --mem-per-cpu="+str(self.memory)+"\n"
         qstring += prefix+" --mail-type=end\n"
@@ -136,17 +281,20 @@ class MARCCClass(ClusterClass):
         return qstring
 
     def _mpi_program(self, command):
-        """String for MPI program to execute.
-        Note that this assumes you aren't using threads!"""
-        #Change to current directory
-        qstring = "export OMP_NUM_THREADS=1\n"
-        #This is for threads
-        #qstring += "export OMP_NUM_THREADS = $SLURM_CPUS_PER_TASK\n"
-        #Adjust for thread/proc balance per socket.
-        #qstring += "mpirun --map-by ppr:3:socket:PE=4 "+self.gadgetexe+" "+self.gadgetparam+"\n"
-        qstring += "mpirun --map-by core "+command+"\n"
+        """String for MPI program to execute, with self.layout[1] threads per task."""
+        qstring = "export OMP_NUM_THREADS="+str(self.layout[1])+"\n"
+        if self.layout[1] == 1:
+            qstring += "mpirun --map-by core "+command+"\n"
+        else:
+            #Give each task as many cores as it has threads.
+            qstring += "mpirun --map-by slot:PE="+str(self.layout[1])+" "+command+"\n"
         return qstring
 
+    def _lane_program(self, command, lane):
+        """Each lane of a batch job is a job step on its own nodes."""
+        _ = lane
+        return self._srun_lane_program(command, self.layout[1])
+
     def cluster_optimize(self):
         """Compiler optimisation options for a specific cluster.
         Only MP-Gadget pays attention to this."""
@@ -162,6 +310,8 @@ class BIOClass(ClusterClass):
         assert nproc % 32 == 0
         super().__init__(*args, nproc=nproc,timelimit=timelimit, **kwargs)
         self.memory = 4
+        self.cores_per_node = 32
+        self.layout = (32, 1)
 
     def _queue_directive(self, name, timelimit, nproc=256, prefix="#SBATCH"):
         """Generate mpi_submit with coma specific parts"""
@@ -171,9 +321,9 @@ class BIOClass(ClusterClass):
         qstring += prefix+" --time="+self.timestring(timelimit)+"\n"
         qstring += prefix+" --nodes="+str(int(nproc/32))+"\n"
         #Number of tasks (processes) per node
-        qstring += prefix+" --ntasks-per-node=32\n"
+        qstring += prefix+" --ntasks-per-node="+str(self.layout[0])+"\n"
         #Number of cpus (threads) per task (process)
-        qstring += prefix+" --cpus-per-task=1\n"
+        qstring += prefix+" --cpus-per-task="+str(self.layout[1])+"\n"
         #Max 128 GB per node (24 cores)
         qstring += prefix+" --mem-per-cpu=4G\n"
         qstring += prefix+" --mail-type=end\n"
@@ -181,17 +331,20 @@ class BIOClass(ClusterClass):
         return qstring
 
     def _mpi_program(self, command):
-        """String for MPI program to execute.
-        Note that this assumes you aren't using threads!"""
-        #Change to current directory
-        qstring = "export OMP_NUM_THREADS=1\n"
-        #This is for threads
-        #qstring += "export OMP_NUM_THREADS = $SLURM_CPUS_PER_TASK\n"
-        #Adjust for thread/proc balance per socket.
-        #qstring += "mpirun --map-by ppr:3:socket:PE=4 "+self.gadgetexe+" "+self.gadgetparam+"\n"
-        qstring += "mpirun --map-by core "+command+"\n"
+        """String for MPI program to execute, with self.layout[1] threads per task."""
+        qstring = "export OMP_NUM_THREADS="+str(self.layout[1])+"\n"
+        if self.layout[1] == 1:
+            qstring += "mpirun --map-by core "+command+"\n"
+        else:
+            #Give each task as many cores as it has threads.
+            qstring += "mpirun --map-by slot:PE="+str(self.layout[1])+" "+command+"\n"
         return qstring
 
+    def _lane_program(self, command, lane):
+        """Each lane of a batch job is a job step on its own nodes."""
+        _ = lane
+        return self._srun_lane_program(command, self.layout[1])
+
     def cluster_runtime(self):
         """Runtime options for cluster. Here memory."""
         return {'MaxMemSizePerNode': 4 * 32 * 950}
@@ -219,16 +372,25 @@ class StampedeClass(ClusterClass):
     Charged in node-hours, uses SLURM and icc."""
     def __init__(self, *args, nproc=2,timelimit=3,**kwargs):
         super().__init__(*args, nproc=nproc,timelimit=timelimit, **kwargs)
+        #Hardware threads: the hyperthreading is perhaps an extra 10% performance.
+        self.cores_per_node = 96
+        #Currently optimal is 2 processes per socket.
+        self.layout = (4, 24)
+
+    def ncores(self):
+        """nproc is the number of nodes here."""
+        return self.nproc*self.cores_per_node
 
-    def _queue_directive(self, name, timelimit, nproc=2, prefix="#SBATCH",ntasks=4):
+    def _queue_directive(self, name, timelimit, nproc=2, prefix="#SBATCH",ntasks=None):
         """Generate mpi_submit with stampede specific parts"""
         _ = timelimit
+        if ntasks is None:
+            ntasks = self.layout[0]
         qstring = prefix+" --partition=skx-normal\n"
         qstring += prefix+" --job-name="+name+"\n"
         qstring += prefix+" --time="+self.timestring(timelimit)+"\n"
         qstring += prefix+" --nodes=%d\n" % int(nproc)
-        #Number of tasks (processes) per node:
-        #currently optimal is 2 processes per socket.
+        #Number of tasks (processes) per node
         qstring += prefix+" --ntasks-per-node=%d\n" % int(ntasks)
         qstring += prefix+" --mail-type=end\n"
         qstring += prefix+" --mail-user="+self.email+"\n"
@@ -237,12 +399,18 @@ class StampedeClass(ClusterClass):
 
     def _mpi_program(self, command):
         """String for MPI program to execute."""
-        #Should be 96/ntasks-per-node. This uses the hyperthreading,
-        #which is perhaps an extra 10% performance.
-        qstring = "export OMP_NUM_THREADS=24\n"
+        #Should be 96/ntasks-per-node. This uses the hyperthreading.
+        qstring = "export OMP_NUM_THREADS="+str(self.layout[1])+"\n"
         qstring += "ibrun "+command+"\n"
         return qstring
 
+    def _lane_program(self, command, lane):
+        """Each lane of a batch job runs on its own nodes: ibrun starts its tasks at an offset into the host list."""
+        ntasks = self.nproc*self.layout[0]
+        qstring = "export OMP_NUM_THREADS="+str(self.layout[1])+"\n"
+        qstring += "ibrun -n %d -o %d %s\n" % (ntasks, lane*ntasks, command)
+        return qstring
+
     def generate_spectra_submit(self, outdir):
         """Generate a sample spectra_submit file, which generates artificial spectra.
         The prefix argument is a string at the start of each line.
@@ -291,3 +459,188 @@ class HypatiaClass(ClusterClass):
         qstring += ". /opt/torque/etc/openmpi-setup.sh\n"
         qstring += "mpirun -v -hostfile $PBS_NODEFILE -npernode "+str(self.nproc)+" "+command+"\n"
         return qstring
+
+class LocalClusterClass(ClusterClass):
+    """Subclass for running on a single many-core workstation, with localrunner.LocalRunner.
+    Jobs declare the cores, memory and time they need with #LOCAL directives,
+    so the runner can run several jobs at once and queue the rest.
+    The runner passes each job its cores in SIMRUNNER_CPUSET, which is used to pin the MPI tasks."""
+    def __init__(self, *args, nproc=8, timelimit=24, **kwargs):
+        super().__init__(*args, nproc=nproc, timelimit=timelimit, **kwargs)
+        self.memory = 2000
+        #One node: the whole job.
+        self.cores_per_node = nproc
+        self.layout = (nproc, 1)
+
+    def _queue_directive(self, name, timelimit, nproc=8, prefix="#LOCAL"):
+        """Generate the resource directives read by LocalRunner"""
+        qstring = prefix+" -J "+name+"\n"
+        qstring += prefix+" -n "+str(nproc)+"\n"
+        #Total memory for the job in MB
+        qstring += prefix+" --mem "+str(int(self.memory*nproc))+"\n"
+        qstring += prefix+" -t "+self.timestring(timelimit)+"\n"
+        return qstring
+
+    def _mpi_program(self, command):
+        """String for MPI program to execute, pinned to the cores given by the runner if there are any."""
+        (ntasks, threads) = self.layout
+        qstring = "export OMP_NUM_THREADS="+str(threads)+"\n"
+        if threads == 1:
+            qstring += "mpirun -np "+str(ntasks)+" ${SIMRUNNER_CPUSET:+--cpu-set $SIMRUNNER_CPUSET --bind-to core} "+command+"\n"
+        else:
+            qstring += "mpirun -np "+str(ntasks)+" --map-by slot:PE="+str(threads)+" ${SIMRUNNER_CPUSET:+--cpu-set $SIMRUNNER_CPUSET} "+command+"\n"
+        return qstring
+
+    def _lane_program(self, command, lane):
+        """Each lane of a batch job is pinned to its own nproc of the cores given by the runner."""
+        first = lane*self.nproc+1
+        qstring = "local SIMRUNNER_CPUSET=$(echo $SIMRUNNER_CPUSET | cut -d, -f%d-%d)\n" % (first, first+self.nproc-1)
+        return qstring+self._mpi_program(command)
+
+#Launch lines for ProfileClusterClass. Profiles may give their own as 'launch'.
+#{domain} is 'numa', 'socket' or 'node', and {tasks_per_domain} the MPI tasks on each.
+LAUNCHERS = {"openmpi": "mpirun -np {ntasks} --map-by ppr:{tasks_per_domain}:{domain}:PE={threads} --bind-to core {command}",
+             "srun": "srun --cpus-per-task={threads} --cpu-bind=cores {command}",
+             "ibrun": "ibrun {command}"}
+
+def load_profiles():
+    """Load the cluster profiles in clusters.json, and in any files listed in $SIMRUNNER_CLUSTER_PROFILES,
+    which may add machines or override the packaged profiles. Returns a dictionary of name -> profile."""
+    import json
+    profiles = {}
+    fnames = [os.path.join(os.path.dirname(__file__), "clusters.json")]
+    fnames += [ff for ff in os.environ.get("SIMRUNNER_CLUSTER_PROFILES", "").split(os.pathsep) if ff]
+    for fname in fnames:
+        with open(os.path.expanduser(fname), 'r') as pfile:
+            profiles.update(json.load(pfile))
+    return profiles
+
+PROFILES = load_profiles()
+
+class ProfileClusterClass(ClusterClass):
+    """Cluster described by a profile in clusters.json, rather than by code.
+    A profile gives the scheduler ('slurm' or 'pbs') and its partition/queue, account and mail settings,
+    the node topology (sockets, cores_per_socket, numa_per_socket, threads_per_core), the usable memory
+    per node in MB, the launcher (a key of LAUNCHERS, or a 'launch' template), any 'setup' lines,
+    the compiler flags, runtime options, and defaults for nproc, timelimit and the layout.
+    nproc is the number of cores, and is rounded up to whole nodes. By default there is one MPI task
+    per NUMA domain, with a thread on each of its cores. Each job asks for the whole memory of its nodes,
+    and the MPI tasks are bound to the cores of their NUMA domain or socket.
+    Each profile is also available as a subclass of this class named after it, eg, MARCCProfile."""
+    profile = None
+
+    def __init__(self, *args, nproc=None, timelimit=None, profile=None, **kwargs):
+        if profile is not None:
+            self.profile = profile
+        self.spec = PROFILES[self.profile]
+        cores_per_node = self.spec["sockets"]*self.spec["cores_per_socket"]*self.spec.get("threads_per_core", 1)
+        if nproc is None:
+            nproc = self.spec.get("nproc", cores_per_node)
+        #Whole nodes
+        nproc = -(-nproc // cores_per_node) * cores_per_node
+        super().__init__(*args, nproc=nproc, timelimit=timelimit or self.spec.get("timelimit", 24), **kwargs)
+        self.email = self.spec.get("email", self.email)
+        self.cores_per_node = cores_per_node
+        domains = self.spec["sockets"]*self.spec.get("numa_per_socket", 1)
+        self.layout = tuple(self.spec.get("layout", (domains, cores_per_node//domains)))
+        self.memory = self.spec["memory"] // self.layout[0]
+
+    def placement(self, nproc=None):
+        """Where the MPI tasks go: a dictionary with the number of nodes, tasks, tasks per node, threads per task,
+        the binding domain ('numa', 'socket' or 'node'), tasks per domain and memory per node."""
+        if nproc is None:
+            nproc = self.nproc
+        (tasks, threads) = self.layout
+        nodes = -(-nproc // self.cores_per_node)
+        sockets = self.spec["sockets"]
+        numa = sockets*self.spec.get("numa_per_socket", 1)
+        #Bind to the smallest domain which holds a whole number of tasks.
+        if numa > sockets and tasks % numa == 0:
+            (domain, per_domain) = ("numa", tasks//numa)
+        elif tasks % sockets == 0:
+            (domain, per_domain) = ("socket", tasks//sockets)
+        else:
+            (domain, per_domain) = ("node", tasks)
+        return {"nodes": nodes, "ntasks": nodes*tasks, "tasks_per_node": tasks, "threads": threads,
+                "domain": domain, "tasks_per_domain": per_domain, "memory": self.spec["memory"]}
+
+    def _queue_directive(self, name, timelimit, nproc=None, prefix=None):
+        """Queue directives for the scheduler of the profile, for whole nodes with all their memory."""
+        place = self.placement(nproc)
+        if self.spec["scheduler"] == "pbs":
+            prefix = prefix or "#PBS"
+            qstring = prefix+" -N "+name+"\n"
+            if "queue" in self.spec:
+                qstring += prefix+" -q "+self.spec["queue"]+"\n"
+            qstring += prefix+" -l nodes="+str(place["nodes"])+":ppn="+str(self.cores_per_node)+"\n"
+            qstring += prefix+" -l walltime="+self.timestring(timelimit)+"\n"
+            qstring += prefix+" -l mem="+str(place["memory"]*place["nodes"])+"mb\n"
+            if self.spec.get("mail"):
+                qstring += prefix+" -m bae\n"
+                qstring += prefix+" -M "+self.email+"\n"
+            #Pass environment to child processes
+            qstring += prefix+" -V\n"
+            return qstring
+        prefix = prefix or "#SBATCH"
+        qstring = ""
+        if "partition" in self.spec:
+            qstring += prefix+" --partition="+self.spec["partition"]+"\n"
+        qstring += prefix+" --job-name="+name+"\n"
+        qstring += prefix+" --time="+self.timestring(timelimit)+"\n"
+        qstring += prefix+" --nodes="+str(place["nodes"])+"\n"
+        qstring += prefix+" --ntasks-per-node="+str(place["tasks_per_node"])+"\n"
+        qstring += prefix+" --cpus-per-task="+str(place["threads"])+"\n"
+        #Memory per node
+        qstring += prefix+" --mem="+str(place["memory"])+"M\n"
+        if "account" in self.spec:
+            qstring += prefix+" -A "+self.spec["account"]+"\n"
+        if self.spec.get("mail"):
+            qstring += prefix+" --mail-type="+self.spec["mail"]+"\n"
+            qstring += prefix+" --mail-user="+self.email+"\n"
+        return qstring
+
+    def _mpi_program(self, command):
+        """String for MPI program to execute, with the threads of each task kept on its cores."""
+        place = self.placement()
+        qstring = "".join([line+"\n" for line in self.spec.get("setup", [])])
+        qstring += "export OMP_NUM_THREADS="+str(place["threads"])+"\n"
+        qstring += "export OMP_PLACES=cores OMP_PROC_BIND=close\n"
+        launch = self.spec.get("launch", LAUNCHERS.get(self.spec.get("launcher", "openmpi")))
+        qstring += launch.format(command=command, **place)+"\n"
+        return qstring
+
+    def _lane_program(self, command, lane):
+        """Each lane of a batch job runs on its own nodes: an ibrun offset, a Slurm job step, or a PBS hostfile."""
+        place = self.placement()
+        setup = "".join([line+"\n" for line in self.spec.get("setup", [])])
+        if self.spec.get("launcher") == "ibrun" and "launch" not in self.spec:
+            qstring = setup+"export OMP_NUM_THREADS="+str(place["threads"])+"\n"
+            return qstring+"ibrun -n %d -o %d %s\n" % (place["ntasks"], lane*place["ntasks"], command)
+        if self.spec["scheduler"] == "slurm":
+            return self._srun_lane_program(command, place["threads"], setup=setup+"export OMP_PLACES=cores OMP_PROC_BIND=close\n")
+        return super()._lane_program(command, lane)
+
+    def cluster_runtime(self):
+        """Runtime options for the cluster: those in the profile, and the memory of a node."""
+        runtime = {"MaxMemSizePerNode": self.spec["memory"]}
+        runtime.update(self.spec.get("runtime", {}))
+        return runtime
+
+    def cluster_optimize(self):
+        """Compiler optimisation options from the profile."""
+        return self.spec.get("optimize", super().cluster_optimize())
+
+def register_profile(name, spec):
+    """Add a profile, and make a subclass of ProfileClusterClass for it, named after it, at module level,
+    so it can be passed as cluster_class and found again from the name saved in SimulationICs.json.
+    Returns the new class."""
+    PROFILES[name] = spec
+    globals()[name] = type(name, (ProfileClusterClass,), {"profile": name, "__doc__": spec.get("description", name), "__module__": __name__})
+    return globals()[name]
+
+def _register_profiles():
+    """Make a class for each profile."""
+    for (name, spec) in list(PROFILES.items()):
+        register_profile(name, spec)
+
+_register_profiles()
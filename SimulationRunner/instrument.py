@@ -0,0 +1,111 @@
+"""Module to record the time and resources used by each stage of making a simulation.
+
+Each stage records wall time, CPU time (of this process and of child processes like MP-GenIC and make),
+peak resident memory and the size of the files written in the simulation directory.
+Events are appended as JSON lines to a file in the simulation directory,
+and can be aggregated over a whole suite to find which stages dominate."""
+import contextlib
+import glob
+import json
+import os
+import os.path
+import resource
+import time
+import numpy as np
+
+#Name of the file in each simulation directory to which timing events are appended.
+TIMINGS_FILE = "timings.jsonl"
+
+def _written_size(path, since):
+    """Total size in bytes of the files in a directory tree modified at or after a time.
+    Files rewritten in place are counted in full, and deleted files are not subtracted."""
+    total = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        for fname in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, fname))
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime >= since:
+                total += stat.st_size
+    return total
+
+class StageTimer(object):
+    """Time the stages of making a simulation.
+
+    Init parameters:
+    outdir - simulation directory. Events are appended to outdir/timings.jsonl,
+             and bytes written are measured as the size of the files in this directory modified during the stage.
+    callback - if not None, a function called with the event dictionary at the end of each stage.
+    """
+    def __init__(self, outdir, callback=None):
+        self.outdir = outdir
+        self.callback = callback
+        self.events = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager which records one stage. If the stage raises, it is recorded as failed."""
+        start = time.time()
+        wall = time.perf_counter()
+        cpu = os.times()
+        status = "failed"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self._record(name, status, start, time.perf_counter() - wall, cpu)
+
+    def _record(self, name, status, start, wall, cpu):
+        """Build the event for a stage and write it out."""
+        cpu_end = os.times()
+        #ru_maxrss is the peak over the lifetime of the process (in kB on Linux), so is an upper bound for the stage.
+        event = {"stage": name, "status": status, "outdir": self.outdir, "start": start, "wall": wall,
+                 "cpu": (cpu_end.user - cpu.user) + (cpu_end.system - cpu.system),
+                 "cpu_children": (cpu_end.children_user - cpu.children_user) + (cpu_end.children_system - cpu.children_system),
+                 "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 "maxrss_children_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                 "bytes_written": _written_size(self.outdir, start)}
+        self.events.append(event)
+        with open(os.path.join(self.outdir, TIMINGS_FILE), 'a') as tfile:
+            tfile.write(json.dumps(event)+"\n")
+        if self.callback is not None:
+            self.callback(event)
+
+def load_timings(simdir):
+    """Load the timing events recorded for a simulation."""
+    try:
+        with open(os.path.join(simdir, TIMINGS_FILE), 'r') as tfile:
+            return [json.loads(line) for line in tfile if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def aggregate_timings(rundir):
+    """Summarise the timing events of every simulation in a suite, by stage.
+    Returns a dictionary of stage -> dictionary with the number of events, total, mean, median and maximum wall time,
+    total CPU time (including child processes), the ratio of CPU to wall time (less than one for stages which
+    wait or are serial, so would benefit from running simulations in parallel), the fraction of the total wall time,
+    the total bytes written and the number of failures."""
+    events = []
+    for simdir in sorted(glob.glob(os.path.join(rundir, "*"+os.path.sep))):
+        events += load_timings(simdir)
+    total_wall = np.sum([ev["wall"] for ev in events])
+    summary = {}
+    for stage in sorted(set([ev["stage"] for ev in events])):
+        sevents = [ev for ev in events if ev["stage"] == stage]
+        walls = np.array([ev["wall"] for ev in sevents])
+        cpus = np.array([ev["cpu"] + ev["cpu_children"] for ev in sevents])
+        summary[stage] = {"count": len(sevents), "wall": np.sum(walls), "mean": np.mean(walls),
+                          "median": np.median(walls), "max": np.max(walls), "cpu": np.sum(cpus),
+                          "cpu_per_wall": np.sum(cpus)/np.sum(walls) if np.sum(walls) > 0 else 0.,
+                          "fraction": np.sum(walls)/total_wall if total_wall > 0 else 0.,
+                          "bytes_written": int(np.sum([ev["bytes_written"] for ev in sevents])),
+                          "failed": len([ev for ev in sevents if ev["status"] != "ok"])}
+    return summary
+
+def print_timings(rundir):
+    """Print a table of where the time goes in a suite, largest stage first."""
+    summary = aggregate_timings(rundir)
+    print("%-16s %6s %10s %10s %10s %8s %8s" % ("stage", "count", "wall (s)", "mean (s)", "max (s)", "cpu/wall", "frac"))
+    for (stage, ss) in sorted(summary.items(), key=lambda item: -item[1]["wall"]):
+        print("%-16s %6d %10.2f %10.3f %10.3f %8.2f %8.3f" % (stage, ss["count"], ss["wall"], ss["mean"], ss["max"], ss["cpu_per_wall"], ss["fraction"]))
@@ -0,0 +1,69 @@
+"""Module to thin the k grid of tabulated transfer functions and power spectra.
+
+CLASS is run with a very fine k sampling, which makes large text tables that MP-GenIC
+and the IC power spectrum checks must parse and interpolate. Most of these nodes are not
+needed to describe the smooth functions: here we find a subset of the nodes which reproduces
+every column to a given accuracy with cubic interpolation in log k."""
+import numpy as np
+import scipy.interpolate as interp
+
+def _scaled_columns(table, logcols):
+    """Transform the columns of a table so that an absolute error of tol in the transformed column
+    is the accuracy we want: relative error for columns in logcols, which are interpolated in log space,
+    and error relative to the largest absolute value for the others, which may change sign."""
+    scaled = np.array(table, dtype=np.float64)
+    for col in range(np.shape(scaled)[1]):
+        if col in logcols:
+            assert np.all(scaled[:,col] > 0)
+            scaled[:,col] = np.log(scaled[:,col])
+            continue
+        norm = np.max(np.abs(scaled[:,col]))
+        if norm > 0:
+            scaled[:,col] /= norm
+    return scaled
+
+def _interp_error(logk, scaled, nodes):
+    """Maximum error over all columns at every k, when interpolating from the nodes with a cubic in log k."""
+    spline = interp.interp1d(logk[nodes], scaled[nodes], kind='cubic', axis=0, assume_sorted=True)
+    return np.max(np.abs(spline(logk) - scaled), axis=1)
+
+def thin_kgrid(kk, table, tol, logcols=(), nstart=8):
+    """Find a small set of k nodes which reproduce every column of a table within tol,
+    using cubic interpolation in log k. The first and last k are always kept.
+
+    Starting from nstart nodes evenly spaced in index, we repeatedly add the midpoint of every
+    interval in which the interpolation error is larger than tol, until no interval needs refining.
+    This greedy refinement is not guaranteed to give the absolute minimum number of nodes,
+    but keeps nodes only where the functions have structure (eg, the BAO).
+
+    Arguments:
+        kk - sorted k values, shape (nk,)
+        table - values at each k, shape (nk, ncol)
+        tol - target interpolation accuracy
+        logcols - columns which are strictly positive and should be interpolated in log space,
+                  with a relative error target. Other columns have a target relative to their maximum absolute value.
+    Returns (indices of the kept nodes, maximum error achieved)."""
+    logk = np.log(kk)
+    assert np.all(np.diff(logk) > 0)
+    nk = np.size(logk)
+    scaled = _scaled_columns(np.reshape(table, (nk, -1)), logcols)
+    nodes = np.unique(np.round(np.linspace(0, nk-1, max(nstart, 4))).astype(int))
+    if np.size(nodes) >= nk:
+        return np.arange(nk), 0.
+    while True:
+        error = _interp_error(logk, scaled, nodes)
+        #Maximum error in each interval between nodes
+        interval_error = np.maximum.reduceat(error, nodes[:-1])
+        refine = np.where((interval_error > tol) * (np.diff(nodes) > 1))[0]
+        if np.size(refine) == 0:
+            return nodes, np.max(error)
+        nodes = np.union1d(nodes, (nodes[refine] + nodes[refine+1])//2)
+
+def thin_class_tables(transfer, pk, tol):
+    """Thin a CLASS transfer function table (first column k) and the matter power spectrum at the same k,
+    keeping the same nodes for both, as the IC power spectrum check assumes they share a k grid.
+    Returns (thinned transfer table, thinned power spectrum, maximum error achieved)."""
+    transfer = np.asarray(transfer)
+    table = np.column_stack([transfer[:,1:], pk])
+    (nodes, error) = thin_kgrid(transfer[:,0], table, tol, logcols=(np.shape(table)[1]-1,))
+    return transfer[nodes], np.asarray(pk)[nodes], error
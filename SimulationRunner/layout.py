@@ -0,0 +1,131 @@
+"""Module to choose the number of MPI tasks per node and OpenMP threads per task for MP-Gadget.
+
+The best split depends on the cluster, the number of particles and whether there are gas particles.
+calibrate writes a short MP-Gadget run from the ICs of a simulation for each candidate layout,
+limited by TimeLimitCPU, submits them and times the steps each completes from the
+'Step N, Time: a, ... Elapsed: t' lines of cpu.txt. The fastest layout is stored in a JSON file,
+keyed by the cluster class and its number of processors, the number of particles and separate_gas.
+ClusterClass.generate_mpi_submit then uses it for simulations with the same particle load."""
+import copy
+import json
+import os
+import os.path
+import re
+import time
+from . import paramfile
+
+#Subdirectory of the simulation for the calibration runs.
+CALIBRATION_DIR = "calibrate"
+
+def layout_file():
+    """File of calibrated layouts: $SIMRUNNER_LAYOUTS if set, otherwise in ~/.cache."""
+    fname = os.environ.get("SIMRUNNER_LAYOUTS")
+    if not fname:
+        fname = "~/.cache/SimulationRunner/layouts.json"
+    return os.path.expanduser(fname)
+
+def layout_key(cluster, npart, separate_gas):
+    """Key for a calibrated layout."""
+    return "%s-%d:%d:%s" % (type(cluster).__name__, cluster.nproc, npart, bool(separate_gas))
+
+def load_layouts(fname=None):
+    """All calibrated layouts, as a dictionary of key -> calibration result."""
+    try:
+        with open(fname or layout_file(), 'r') as lfile:
+            return json.load(lfile)
+    except FileNotFoundError:
+        return {}
+
+def best_layout(cluster, npart, separate_gas, fname=None):
+    """The calibrated (MPI tasks per node, OpenMP threads per task) for a cluster and particle load, or None."""
+    result = load_layouts(fname).get(layout_key(cluster, npart, separate_gas))
+    if result is None:
+        return None
+    return tuple(result["layout"])
+
+def save_layout(cluster, npart, separate_gas, result, fname=None):
+    """Store a calibration result. The file is replaced atomically, so readers never see a partial file."""
+    fname = fname or layout_file()
+    layouts = load_layouts(fname)
+    layouts[layout_key(cluster, npart, separate_gas)] = result
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    tmpfile = fname+".tmp."+str(os.getpid())
+    with open(tmpfile, 'w') as lfile:
+        json.dump(layouts, lfile, indent=1)
+    os.replace(tmpfile, fname)
+
+def parse_cpu_txt(fname):
+    """Read the step lines of an MP-Gadget cpu.txt. Returns a dictionary of step number -> (scale factor, elapsed seconds)."""
+    steps = {}
+    with open(fname, 'r') as cfile:
+        for line in cfile:
+            match = re.match(r"^Step\s+([0-9]+),\s*Time:\s*([-+0-9.eE]+).*Elapsed:\s*([-+0-9.eE]+)", line)
+            if match is not None:
+                steps[int(match.group(1))] = (float(match.group(2)), float(match.group(3)))
+    return steps
+
+def write_calibration(simdir, cluster, layouts=None, cpulimit=300, timelimit=0.5):
+    """Write a calibration run for each candidate layout, in simdir/calibrate/<tasks>x<threads>.
+    Each runs MP-Gadget from the simulation's ICs for cpulimit seconds, with the job script written by
+    a copy of the cluster class using that layout. Returns a list of (layout, run directory)."""
+    if layouts is None:
+        layouts = cluster.layouts()
+    template = paramfile.ParamTemplate(os.path.join(simdir, cluster.gadgetparam))
+    params = {"InitCondFile": os.path.abspath(os.path.join(simdir, template.defaults["InitCondFile"])),
+              "OutputDir": "output", "TimeLimitCPU": int(cpulimit), "SnapshotWithFOF": 0}
+    if "TreeCoolFile" in template.defaults:
+        params["TreeCoolFile"] = os.path.abspath(os.path.join(simdir, template.defaults["TreeCoolFile"]))
+    runs = []
+    for (tasks, threads) in layouts:
+        rundir = os.path.join(simdir, CALIBRATION_DIR, "%dx%d" % (tasks, threads))
+        os.makedirs(rundir, exist_ok=True)
+        template.write(os.path.join(rundir, cluster.gadgetparam), params)
+        binary = os.path.join(rundir, cluster.gadgetexe)
+        if os.path.exists(os.path.join(simdir, cluster.gadgetexe)) and not os.path.lexists(binary):
+            os.symlink(os.path.abspath(os.path.join(simdir, cluster.gadgetexe)), binary)
+        trial = copy.copy(cluster)
+        trial.layout = (tasks, threads)
+        trial.timelimit = timelimit
+        trial.scratch = None
+        trial.generate_mpi_submit(rundir)
+        runs.append(((tasks, threads), rundir))
+    return runs
+
+def collect(runs):
+    """Time per step of each calibration run, over the steps which every run completed (after the first, which includes setup).
+    Returns a dictionary of 'tasksxthreads' -> seconds per step, or None for runs which completed too few steps."""
+    steps = {}
+    for (lay, rundir) in runs:
+        try:
+            steps[lay] = parse_cpu_txt(os.path.join(rundir, "output", "cpu.txt"))
+        except FileNotFoundError:
+            steps[lay] = {}
+    done = [ss for ss in steps.values() if len(ss) > 2]
+    timings = {"%dx%d" % lay: None for lay in steps}
+    if not done:
+        return timings
+    first = max([min(ss) for ss in done]) + 1
+    last = min([max(ss) for ss in done])
+    for (lay, ss) in steps.items():
+        if first < last and first in ss and last in ss:
+            timings["%dx%d" % lay] = (ss[last][1] - ss[first][1]) / (last - first)
+    return timings
+
+def calibrate(simdir, cluster, npart, separate_gas, scheduler, layouts=None, poll=30., fname=None, **kwargs):
+    """Find the fastest layout for a simulation on a cluster by timing short runs of each candidate.
+    scheduler submits and monitors the runs, eg, orchestrator.SlurmScheduler or localrunner.LocalRunner.
+    Runs which are killed at their time limit still count, if they completed enough steps.
+    Other keyword arguments are passed to write_calibration.
+    The result is stored with save_layout and returned: a dictionary with the best layout and the time per step of each."""
+    runs = write_calibration(simdir, cluster, layouts=layouts, **kwargs)
+    jobs = [scheduler.submit("mpi_submit", rundir) for (_, rundir) in runs]
+    while any([scheduler.status(job) not in ("done", "failed") for job in jobs]):
+        time.sleep(poll)
+    timings = collect(runs)
+    timed = {lay: tt for (lay, tt) in timings.items() if tt is not None}
+    if not timed:
+        raise RuntimeError("No calibration run in "+os.path.join(simdir, CALIBRATION_DIR)+" completed enough steps")
+    best = min(timed, key=timed.get)
+    result = {"layout": [int(nn) for nn in best.split("x")], "step_time": timed[best], "timings": timings}
+    save_layout(cluster, npart, separate_gas, result, fname=fname)
+    return result
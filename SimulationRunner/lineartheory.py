@@ -0,0 +1,81 @@
+"""Module to store the linear theory output of CLASS for a simulation in one file, indexed by exact redshift.
+
+The per-redshift text files are named with a formatted redshift string, so nearby redshifts can
+share a file name and overwrite each other. This store keeps the transfer functions and linear
+matter power spectra for every requested redshift, keyed by the exact floating point redshift.
+It is an uncompressed npz file, and arrays are memory-mapped when read, so looking up the linear
+theory at one redshift only reads that redshift from disc."""
+import struct
+import zipfile
+import numpy as np
+
+def save_linear_theory(filename, redshifts, transfers, pks, columns):
+    """Save transfer functions and linear power spectra at a set of redshifts.
+    Arguments:
+        redshifts - list of redshifts
+        transfers - list of transfer function tables, one for each redshift, shape (nk, ncol).
+                    The first column is k in h/Mpc.
+        pks - list of linear matter power spectra, one for each redshift, evaluated at the k of the transfer table.
+        columns - names of the transfer function columns."""
+    redshifts = np.asarray(redshifts, dtype=np.float64)
+    assert np.size(np.unique(redshifts)) == np.size(redshifts)
+    transfers = np.array(transfers, dtype=np.float64)
+    pks = np.array(pks, dtype=np.float64)
+    assert np.shape(transfers)[:2] == np.shape(pks)
+    assert np.shape(transfers)[0] == np.size(redshifts)
+    #Uncompressed, so that the arrays can be memory-mapped.
+    np.savez(filename, redshifts=redshifts, transfer=transfers, pk=pks, columns=np.array(columns, dtype=str))
+
+def _memmap_npz(filename):
+    """Memory-map every array in an uncompressed npz file. Returns a dictionary of arrays."""
+    arrays = {}
+    with zipfile.ZipFile(filename) as zfile:
+        members = zfile.infolist()
+    with open(filename, 'rb') as fh:
+        for zinfo in members:
+            if zinfo.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(filename+" is compressed and cannot be memory-mapped")
+            #Skip the zip local file header to get to the npy file.
+            fh.seek(zinfo.header_offset)
+            local = fh.read(30)
+            (namelen, extralen) = struct.unpack('<HH', local[26:30])
+            fh.seek(zinfo.header_offset + 30 + namelen + extralen)
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                (shape, fortran, dtype) = np.lib.format.read_array_header_1_0(fh)
+            else:
+                (shape, fortran, dtype) = np.lib.format.read_array_header_2_0(fh)
+            name = zinfo.filename[:-4] if zinfo.filename.endswith(".npy") else zinfo.filename
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape, order='F' if fortran else 'C', offset=fh.tell())
+    return arrays
+
+class LinearTheory(object):
+    """Read the linear theory saved by save_linear_theory. Lookups are by exact redshift."""
+    def __init__(self, filename):
+        self.filename = filename
+        self._arrays = _memmap_npz(filename)
+        self.redshifts = np.array(self._arrays['redshifts'])
+        self.columns = [str(cc) for cc in self._arrays['columns']]
+
+    def _index(self, redshift):
+        """Find the index of a redshift, which must match exactly."""
+        ii = np.where(self.redshifts == redshift)[0]
+        if np.size(ii) == 0:
+            raise KeyError("Redshift "+str(redshift)+" not in "+self.filename+". Have: "+str(self.redshifts))
+        return ii[0]
+
+    def get_transfer(self, redshift):
+        """Get the transfer function table at a redshift, shape (nk, ncol). The first column is k."""
+        return self._arrays['transfer'][self._index(redshift)]
+
+    def get_column(self, redshift, column):
+        """Get a single named transfer function column (eg, 'd_tot') at a redshift."""
+        return self.get_transfer(redshift)[:, self.columns.index(column)]
+
+    def get_pklin(self, redshift):
+        """Get the linear matter power spectrum at a redshift. Returns (k, P(k))."""
+        ii = self._index(redshift)
+        return self._arrays['transfer'][ii, :, 0], self._arrays['pk'][ii]
@@ -0,0 +1,203 @@
+"""Module to run the job scripts of a suite on a single many-core machine, as a batch scheduler would.
+
+Job scripts (as written with clusters.LocalClusterClass) declare the cores, memory and time they need
+with #LOCAL directives:
+    #LOCAL -J name
+    #LOCAL -n 8
+    #LOCAL --mem 16000   (MB)
+    #LOCAL -t 24:0:00
+Jobs are started as soon as enough cores and memory are free, and the rest are queued.
+Each job is given a set of free cores in the SIMRUNNER_CPUSET environment variable,
+which the job script passes to mpirun to pin its tasks, so concurrent jobs do not compete for cores.
+
+A LocalRunner can be passed as the submit command to the functions in remake, and as the scheduler for the orchestrator."""
+import os
+import os.path
+import re
+import signal
+import subprocess
+import threading
+import time
+
+def _total_memory():
+    """Physical memory of the machine in MB."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024**2
+
+def kill_job(proc, grace=5.):
+    """Kill a job script and everything it started, such as the MPI tasks.
+    Jobs run in their own process group, which is sent SIGTERM, then SIGKILL if anything is left after grace seconds."""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        end = time.time() + grace
+        while time.time() < end:
+            proc.poll()
+            #Raises ProcessLookupError once every process in the group has gone.
+            os.killpg(proc.pid, 0)
+            time.sleep(0.05)
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+def parse_directives(script):
+    """Read the #LOCAL directives of a job script.
+    Returns a dictionary with the name, number of cores, memory in MB and time limit in seconds (None if not set)."""
+    res = {"name": os.path.basename(script), "nproc": 1, "memory": 0, "timelimit": None}
+    with open(script, 'r') as sfile:
+        for line in sfile:
+            match = re.match(r"#LOCAL\s+(-J|-n|--mem|-t)\s+(\S+)", line)
+            if match is None:
+                continue
+            (flag, val) = match.groups()
+            if flag == "-J":
+                res["name"] = val
+            elif flag == "-n":
+                res["nproc"] = int(val)
+            elif flag == "--mem":
+                res["memory"] = int(val)
+            else:
+                hms = [int(tt) for tt in val.split(":")]
+                res["timelimit"] = 3600*hms[0] + 60*hms[1] + hms[2]
+    return res
+
+class LocalJob(object):
+    """A job script and the resources it needs."""
+    def __init__(self, jobid, script, cwd):
+        self.jobid = jobid
+        self.script = script
+        self.cwd = cwd
+        res = parse_directives(os.path.join(cwd, script))
+        self.name = res["name"]
+        self.nproc = res["nproc"]
+        self.memory = res["memory"]
+        self.timelimit = res["timelimit"]
+        self.state = "pending"
+        self.cores = []
+        self.proc = None
+        self.start = None
+        #True while the job is being killed: its cores are not freed until everything it started has gone.
+        self.killing = False
+
+class LocalRunner(object):
+    """Run job scripts on this machine, as many at once as the cores and memory allow.
+
+    Init parameters:
+    cores - number of cores, or a list of core ids, to use. By default, every core this process may run on.
+    memory - memory to use in MB. By default, all the physical memory.
+    poll - seconds between checks for finished jobs.
+    grace - seconds a killed job has to exit after SIGTERM, before it is sent SIGKILL.
+    """
+    dependencies = False
+
+    def __init__(self, cores=None, memory=None, poll=1., grace=5.):
+        if cores is None:
+            cores = sorted(os.sched_getaffinity(0))
+        elif isinstance(cores, int):
+            cores = list(range(cores))
+        self.cores = list(cores)
+        self.memory = memory if memory is not None else _total_memory()
+        self.poll = poll
+        self.grace = grace
+        self._free = list(self.cores)
+        self._free_memory = self.memory
+        self._jobs = {}
+        self._queue = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, script, cwd, after=None):
+        """Queue a job script, to be run in cwd. Returns the job id."""
+        assert after is None
+        with self._lock:
+            jobid = str(len(self._jobs)+1)
+            job = LocalJob(jobid, script, cwd)
+            if job.nproc > len(self.cores) or job.memory > self.memory:
+                raise ValueError("Job "+script+" in "+cwd+" needs more than the whole machine: "+str(job.nproc)+" cores, "+str(job.memory)+" MB")
+            self._jobs[jobid] = job
+            self._queue.append(job)
+        self._schedule()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return jobid
+
+    def __call__(self, script, cwd):
+        """Submit a job. This lets a LocalRunner be used as the submit command in remake."""
+        return self.submit(script, cwd)
+
+    def status(self, jobid):
+        """One of 'pending', 'running', 'done' or 'failed'."""
+        self._schedule()
+        return self._jobs[jobid].state
+
+    def cancel(self, jobid):
+        """Remove a job from the queue, or kill it if it is running."""
+        with self._lock:
+            job = self._jobs[jobid]
+            if job.state == "pending":
+                self._queue.remove(job)
+                job.state = "failed"
+            if job.state != "running" or job.killing:
+                return
+            job.killing = True
+        #Without the lock, so the other jobs are scheduled while this one is killed.
+        self._kill(job)
+
+    def _kill(self, job):
+        """Kill a running job, and let it be reaped once everything it started has gone."""
+        kill_job(job.proc, self.grace)
+        with self._lock:
+            job.killing = False
+
+    def wait(self):
+        """Wait until every job has finished. Returns a dictionary of job id -> final state."""
+        while True:
+            self._schedule()
+            with self._lock:
+                if all([job.state in ("done", "failed") for job in self._jobs.values()]):
+                    return {jobid: job.state for (jobid, job) in self._jobs.items()}
+            time.sleep(self.poll)
+
+    def _loop(self):
+        """Background thread which starts queued jobs as resources are freed."""
+        while True:
+            self._schedule()
+            with self._lock:
+                if not self._queue and all([job.state != "running" for job in self._jobs.values()]):
+                    return
+            time.sleep(self.poll)
+
+    def _schedule(self):
+        """Reap finished jobs, kill jobs over their time limit, and start queued jobs which fit.
+        Queued jobs are started in order, but a smaller job may start before a larger one which does not fit yet."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.state != "running" or job.killing:
+                    continue
+                if job.timelimit is not None and time.time() - job.start > job.timelimit and job.proc.poll() is None:
+                    #Killed in the background, as it may take the grace time.
+                    job.killing = True
+                    threading.Thread(target=self._kill, args=(job,), daemon=True).start()
+                    continue
+                ret = job.proc.poll()
+                if ret is None:
+                    continue
+                job.state = "done" if ret == 0 else "failed"
+                self._free = sorted(self._free + job.cores)
+                self._free_memory += job.memory
+            for job in list(self._queue):
+                if job.nproc <= len(self._free) and job.memory <= self._free_memory:
+                    self._start(job)
+
+    def _start(self, job):
+        """Start a job on the lowest numbered free cores. Must hold the lock."""
+        (job.cores, self._free) = (self._free[:job.nproc], self._free[job.nproc:])
+        self._free_memory -= job.memory
+        self._queue.remove(job)
+        env = dict(os.environ)
+        env["SIMRUNNER_CPUSET"] = ",".join([str(cc) for cc in job.cores])
+        with open(os.path.join(job.cwd, job.script+".o"+job.jobid), 'w') as out:
+            #In a new session, so the job and its MPI tasks can be killed together.
+            job.proc = subprocess.Popen(["bash", job.script], cwd=job.cwd, env=env, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+        job.start = time.time()
+        job.state = "running"
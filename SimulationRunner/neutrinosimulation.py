@@ -2,21 +2,42 @@
 
 import numpy as np
 from . import simulationics
+from . import nubudget
 
 class NeutrinoPartICs(simulationics.SimulationICs):
-    """Specialise the initial conditions for particle neutrinos."""
+    """Specialise the initial conditions for particle neutrinos.
+    nu_budget_target - if not None, use the smallest neutrino particle grid whose shot noise is below this relative
+                error in the total power and nu_budget_nu_target in the neutrino power, estimated from the CLASS
+                linear theory. The choice and the reasons for it are saved as nu_budget."""
     __doc__ = __doc__+simulationics.SimulationICs.__doc__
-    def __init__(self, *, m_nu=0.1, separate_gas=False, **kwargs):
+    def __init__(self, *, m_nu=0.1, separate_gas=False, nu_budget_target=None, nu_budget_nu_target=1e-2, **kwargs):
         #Set neutrino mass
         #Note that omega0 does remains constant if we change m_nu.
         #This does mean that omegab/omegac will increase, but not by much.
         assert m_nu > 0
+        self.nu_budget_target = nu_budget_target
+        self.nu_budget_nu_target = nu_budget_nu_target
+        self.nu_budget = None
         super().__init__(m_nu = m_nu, separate_gas=separate_gas, **kwargs)
         self.separate_nu = True
 
+    def cambfile(self):
+        """Generate the IC power spectrum, then tune the neutrino particle grid from it."""
+        camb_output = super().cambfile()
+        if self.nu_budget_target is not None:
+            self.tune_nu_budget(camb_output)
+        return camb_output
+
+    def tune_nu_budget(self, camb_output="camb_linear/"):
+        """Choose the neutrino particle grid from the saved linear theory."""
+        self.nu_budget = nubudget.tune_budget(self.linear_theory(camb_output), self._neutrino_masses(), omega0=self.omega0, hubble=self.hubble,
+                                              box=self.box, npart=self.npart, redend=self.redend, target=self.nu_budget_target,
+                                              nu_target=self.nu_budget_nu_target, hybrid=False)
+        return self.nu_budget
+
     def _genicfile_child_options(self, config):
         """Set up particle neutrino parameters for GenIC"""
-        config['NgridNu'] = self.npart
+        config['NgridNu'] = self.npart if self.nu_budget is None else self.nu_budget["NgridNu"]
         #Degenerate neutrinos
         return config
 
@@ -28,18 +49,41 @@ class NeutrinoPartICs(simulationics.SimulationICs):
 
 class NeutrinoHybridICs(simulationics.SimulationICs):
     """Further specialise the NeutrinoPartICs class for semi-linear analytic massive neutrinos.
+    nu_budget_target - if not None, ignore npartnufac, vcrit and zz_transition and choose them from the CLASS linear theory,
+                so that the total power is accurate to this and the neutrino power to nu_budget_nu_target.
+                The choice and the reasons for it are saved as nu_budget.
     """
-    def __init__(self, *, npartnufac=0.5, vcrit=850, zz_transition = 1, **kwargs):
+    def __init__(self, *, npartnufac=0.5, vcrit=850, zz_transition = 1, nu_budget_target=None, nu_budget_nu_target=1e-2, **kwargs):
         self.npartnufac = npartnufac
         self.vcrit = vcrit
         self.separate_nu = True
         self.zz_transition = zz_transition
+        self.nu_budget_target = nu_budget_target
+        self.nu_budget_nu_target = nu_budget_nu_target
+        self.nu_budget = None
         super().__init__(**kwargs)
 
+    def cambfile(self):
+        """Generate the IC power spectrum, then tune the neutrino particles from it."""
+        camb_output = super().cambfile()
+        if self.nu_budget_target is not None:
+            self.tune_nu_budget(camb_output)
+        return camb_output
+
+    def tune_nu_budget(self, camb_output="camb_linear/"):
+        """Choose the neutrino particle grid, vcrit and the transition redshift from the saved linear theory."""
+        self.nu_budget = nubudget.tune_budget(self.linear_theory(camb_output), self._neutrino_masses(), omega0=self.omega0, hubble=self.hubble,
+                                              box=self.box, npart=self.npart, redend=self.redend, target=self.nu_budget_target,
+                                              nu_target=self.nu_budget_nu_target, hybrid=True)
+        self.npartnufac = self.nu_budget["NgridNu"]/self.npart
+        self.vcrit = self.nu_budget["vcrit"]
+        self.zz_transition = self.nu_budget["zz_transition"]
+        return self.nu_budget
+
     def _genicfile_child_options(self, config):
         """Set up hybrid neutrino parameters for GenIC."""
         #Degenerate neutrinos
-        config['NgridNu'] = int(self.npart*self.npartnufac)
+        config['NgridNu'] = int(self.npart*self.npartnufac) if self.nu_budget is None else self.nu_budget["NgridNu"]
         config['Max_nuvel'] = self.vcrit
         return config
 
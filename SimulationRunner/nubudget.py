@@ -0,0 +1,125 @@
+"""Module to choose the smallest neutrino particle load which meets a target accuracy, from linear theory.
+
+Neutrino particles are the largest memory cost of a neutrino simulation, and by default there are as many
+as dark matter particles. A neutrino with momentum q (in units of the neutrino temperature today) and mass m
+has a velocity of 50.26 q (1 eV / m) km/s, falling as 1/a. It free-streams out of structures smaller than
+its free-streaming scale, k_fs = sqrt(3/2) a H / v. Neutrinos with k_fs above the non-linear scale k_nl,
+where the linear dimensionless power is 1, fall into non-linear structures, which the linear response
+does not describe. So, for hybrid neutrinos:
+- vcrit is the velocity with k_fs = k_nl at the final redshift. Slower neutrinos become particles.
+- The transition redshift is the first at which these slow neutrinos, treated linearly, would change the total power
+  at k_nl by more than the target: 2 f_nu F(vcrit) |delta_nu / delta_tot|(k_nl), where F(vcrit) is the fraction
+  of the Fermi-Dirac distribution slower than vcrit.
+- The neutrino grid is the smallest whose shot noise, as a part of the neutrino density, is below nu_target
+  of the neutrino power at k_nl, and whose contribution to the total power is below target of the total power at k_nl.
+For simulations where every neutrino is a particle the same shot noise criterion is used, with the neutrino power
+at the free-streaming scale of the mean thermal velocity: smaller scales are smoothed out.
+The linear power spectra and transfer functions come from the CLASS linear theory store."""
+import math
+import numpy as np
+import scipy.integrate
+
+#Velocity today in km/s of a neutrino of mass 1 eV and momentum equal to the neutrino temperature, k T_nu0 / (m c).
+FD_VELOCITY = 50.26
+#Mean momentum of the Fermi-Dirac distribution, in units of the temperature.
+FD_MEAN_Q = 3.151
+#Normalisation of the Fermi-Dirac momentum distribution: int q^2 / (e^q + 1) dq = 3 zeta(3) / 2.
+_FD_NORM = 1.5*1.2020569031595942
+
+def fermi_dirac_fraction(qq):
+    """Fraction of neutrinos with momentum below qq (in units of the temperature)."""
+    if qq <= 0:
+        return 0.
+    return scipy.integrate.quad(lambda xx: xx**2/(math.exp(xx)+1), 0, qq)[0] / _FD_NORM
+
+def neutrino_velocity(qq, mass):
+    """Velocity today in km/s of a neutrino of mass in eV with momentum qq."""
+    return FD_VELOCITY * qq / mass
+
+def _hubble(aa, omega0):
+    """H(a)/H0 for flat LCDM."""
+    return math.sqrt(omega0/aa**3 + 1 - omega0)
+
+def free_streaming_k(velocity, aa, omega0):
+    """Comoving free-streaming wavenumber in h/Mpc at scale factor aa of a neutrino with velocity today in km/s."""
+    return math.sqrt(1.5) * 100 * aa**2 * _hubble(aa, omega0) / velocity
+
+def free_streaming_velocity(kk, aa, omega0):
+    """Velocity today in km/s of neutrinos whose free-streaming wavenumber at aa is kk."""
+    return math.sqrt(1.5) * 100 * aa**2 * _hubble(aa, omega0) / kk
+
+def nonlinear_k(kk, pk):
+    """Smallest k at which the dimensionless linear power k^3 P / 2 pi^2 reaches 1, or the largest k if it never does."""
+    delta2 = kk**3 * pk / (2*math.pi**2)
+    ii = np.where(delta2 >= 1)[0]
+    if np.size(ii) == 0:
+        return float(kk[-1])
+    if ii[0] == 0:
+        return float(kk[0])
+    (lo, hi) = (ii[0] - 1, ii[0])
+    return float(np.exp(np.interp(0, np.log(delta2[[lo, hi]]), np.log(kk[[lo, hi]]))))
+
+def particle_fraction(vcrit, masses):
+    """Fraction of the neutrino mass slower than vcrit, over the neutrino species."""
+    masses = [mm for mm in masses if mm > 0]
+    return sum([mm*fermi_dirac_fraction(vcrit*mm/FD_VELOCITY) for mm in masses]) / sum(masses)
+
+def _neutrino_ratio(linear, zz, kk):
+    """|delta_nu / delta_tot| at a redshift, interpolated to kk."""
+    ktab = linear.get_transfer(zz)[:, 0]
+    ratio = np.abs(linear.get_column(zz, 'd_ncdm[0]') / linear.get_column(zz, 'd_tot'))
+    return float(np.interp(np.log(kk), np.log(ktab), ratio))
+
+def tune_budget(linear, masses, omega0, hubble, box, npart, redend, target=1e-3, nu_target=1e-2, hybrid=True):
+    """Choose the neutrino particle grid, and for hybrid neutrinos vcrit and the transition redshift.
+    Arguments:
+        linear - lineartheory.LinearTheory for the simulation, which must include redend.
+        masses - the three neutrino masses in eV.
+        box - box size in Mpc/h. npart - cube root of the number of dark matter particles, the largest grid allowed.
+        target, nu_target - relative accuracy wanted in the total and neutrino power.
+    Returns a dictionary with NgridNu, vcrit, zz_transition, the fraction of neutrino mass in particles,
+    the scales and shot noise used, and a list of reasons for each choice."""
+    omeganu = sum(masses)/93.14/hubble**2
+    f_nu = omeganu/omega0
+    aend = 1./(1+redend)
+    (kk, pk) = linear.get_pklin(redend)
+    k_nl = nonlinear_k(kk, pk)
+    reasons = []
+    budget = {"target": target, "nu_target": nu_target, "k_nl": k_nl}
+    if hybrid:
+        vcrit = free_streaming_velocity(k_nl, aend, omega0)
+        frac = particle_fraction(vcrit, masses)
+        reasons.append("vcrit = %.0f km/s: slower neutrinos have free-streaming k above k_nl = %.3g h/Mpc at z=%g, so cluster non-linearly. They are %.3g of the neutrino mass." % (vcrit, k_nl, redend, frac))
+        zz_transition = float(redend)
+        for zz in sorted([zz for zz in linear.redshifts if zz >= redend], reverse=True):
+            (kz, pkz) = linear.get_pklin(zz)
+            knl_z = nonlinear_k(kz, pkz)
+            error = 2*f_nu*frac*_neutrino_ratio(linear, zz, knl_z)
+            if error > target:
+                zz_transition = float(zz)
+                reasons.append("zz_transition = %g: slow neutrinos treated linearly would change the total power at k_nl = %.3g h/Mpc by %.2g > %g." % (zz, knl_z, error, target))
+                break
+        else:
+            reasons.append("zz_transition = %g: slow neutrinos treated linearly change the total power by less than %g at every redshift." % (redend, target))
+        k_nu = k_nl
+        budget.update({"vcrit": vcrit, "zz_transition": zz_transition})
+    else:
+        frac = 1.
+        mean_velocity = neutrino_velocity(FD_MEAN_Q, sum(masses)/len(masses))
+        k_nu = min(free_streaming_k(mean_velocity, aend, omega0), k_nl)
+    #GenIC draws particle velocities below vcrit, so the particles are the fraction frac of the neutrino density,
+    #and their shot noise box^3/N enters the neutrino power multiplied by frac^2.
+    pk_nu = float(np.exp(np.interp(np.log(k_nu), np.log(kk), np.log(pk)))) * _neutrino_ratio(linear, redend, k_nu)**2
+    pk_tot = float(np.exp(np.interp(np.log(k_nl), np.log(kk), np.log(pk))))
+    nu_needed = frac**2 * box**3 / (nu_target * pk_nu)
+    tot_needed = (f_nu*frac)**2 * box**3 / (target * pk_tot)
+    needed = max(nu_needed, tot_needed)
+    ngrid = int(math.ceil(needed**(1./3) - 1e-9))
+    if ngrid > npart:
+        reasons.append("NgridNu = %d: the accuracy target needs %d, more than the dark matter grid." % (npart, ngrid))
+        ngrid = npart
+    else:
+        ngrid = max(ngrid, 2)
+        reasons.append("NgridNu = %d: shot noise below %g of P_nu at k = %.3g h/Mpc and %g of the total power at k_nl." % (ngrid, nu_target, k_nu, target))
+    budget.update({"NgridNu": ngrid, "particle_fraction": frac, "k_nu": k_nu, "shot_noise": frac**2*box**3/ngrid**3, "reasons": reasons})
+    return budget
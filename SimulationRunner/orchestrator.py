@@ -0,0 +1,254 @@
+"""Module to drive every simulation in a suite through the pipeline without manual intervention.
+
+Each simulation moves through the stages:
+    class - make_simulation: CLASS and the parameter files, run in this process.
+    genic - the mpi_submit_genic script: MP-GenIC and the IC power spectrum check.
+    gadget - the mpi_submit script: MP-Gadget.
+    analysis - an optional post-processing script.
+Each stage is started as soon as its predecessor finishes. If the scheduler supports job
+dependencies, the next job is submitted as soon as the current one is, so its queue wait overlaps
+with the running job. Each stage has a limit on the number of simulations in it at once,
+and failed stages are retried. Failed MP-Gadget runs are restarted from their last snapshot.
+An MP-Gadget job which stops (eg, at its time limit) after writing a new snapshot is resubmitted
+from it without counting as a retry, so only jobs which make no progress use up the retries.
+
+Schedulers are plain classes with submit, status and cancel methods. LocalScheduler runs the
+scripts as local processes, so the whole flow can be tested on one machine.
+localrunner.LocalRunner has the same interface, and also shares out the cores and memory of the machine."""
+import asyncio
+import os
+import os.path
+import subprocess
+from . import remake
+from . import localrunner
+
+#Stages which are run as jobs, in order, and the scripts which run them.
+JOB_STAGES = ("genic", "gadget", "analysis")
+
+class LocalScheduler(object):
+    """Run job scripts as local processes with bash. Does not support job dependencies."""
+    dependencies = False
+
+    def __init__(self, shell="bash"):
+        self.shell = shell
+        self._procs = {}
+
+    def submit(self, script, cwd, after=None):
+        """Start a script in a directory. Output goes to script.out. Returns a job id."""
+        assert after is None
+        with open(os.path.join(cwd, script+".out"), 'w') as out:
+            proc = subprocess.Popen([self.shell, script], cwd=cwd, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+        jobid = str(proc.pid)
+        self._procs[jobid] = proc
+        return jobid
+
+    def status(self, jobid):
+        """One of 'pending', 'running', 'done' or 'failed'."""
+        ret = self._procs[jobid].poll()
+        if ret is None:
+            return "running"
+        return "done" if ret == 0 else "failed"
+
+    def cancel(self, jobid):
+        """Kill a job and the processes it started."""
+        if self._procs[jobid].poll() is None:
+            localrunner.kill_job(self._procs[jobid])
+
+class SlurmScheduler(object):
+    """Submit jobs with sbatch, using afterok dependencies to chain stages."""
+    dependencies = True
+    #Slurm job states and what they mean for us. Anything else is a failure.
+    _STATES = {"PENDING": "pending", "CONFIGURING": "pending", "REQUEUED": "pending", "RESIZING": "pending",
+               "RUNNING": "running", "COMPLETING": "running", "SUSPENDED": "running", "COMPLETED": "done"}
+
+    def submit(self, script, cwd, after=None):
+        """Submit a script. Returns the job id."""
+        cmd = ["sbatch", "--parsable"]
+        if after is not None:
+            #If the dependency fails, cancel this job rather than leaving it pending forever.
+            cmd += ["--dependency=afterok:"+after, "--kill-on-invalid-dep=yes"]
+        output = subprocess.check_output(cmd+[script], cwd=cwd, universal_newlines=True)
+        return output.strip().split(";")[0]
+
+    def status(self, jobid):
+        """One of 'pending', 'running', 'done' or 'failed'."""
+        output = subprocess.check_output(["sacct", "-n", "-X", "-P", "-o", "State", "-j", jobid], universal_newlines=True)
+        if not output.strip():
+            #Not yet in the accounting database
+            return "pending"
+        state = output.split()[0]
+        return self._STATES.get(state, "failed")
+
+    def cancel(self, jobid):
+        """Cancel a job."""
+        subprocess.call(["scancel", jobid])
+
+class Orchestrator(object):
+    """Run a suite of simulations through the pipeline.
+
+    Init parameters:
+    sims - list of SimulationICs objects (anything with outdir, redend and make_simulation).
+    scheduler - scheduler for the job stages, eg, LocalScheduler or SlurmScheduler.
+    limits - dictionary of stage -> maximum number of simulations in that stage at once.
+    retries - number of times to retry a failed stage. MP-Gadget jobs which made progress are not counted.
+    analysis - script in each simulation directory to run after MP-Gadget, or None to skip the analysis stage.
+    make_kwargs - keyword arguments for make_simulation.
+    poll - seconds between checks of job status.
+    callback - if not None, called with (outdir, stage, status) on every change of state.
+    """
+    def __init__(self, sims, scheduler, limits=None, retries=2, analysis=None, make_kwargs=None, poll=30., retry_delay=0., callback=None):
+        self.sims = sims
+        self.scheduler = scheduler
+        self.limits = {"class": 4, "genic": 32, "gadget": 32, "analysis": 32}
+        if limits is not None:
+            self.limits.update(limits)
+        self.retries = retries
+        self.analysis = analysis
+        self.make_kwargs = make_kwargs or {}
+        self.poll = poll
+        self.retry_delay = retry_delay
+        self.callback = callback
+        #Current (stage, status) of each simulation, keyed by output directory.
+        self.states = {sim.outdir: ("class", "waiting") for sim in sims}
+        self._semaphores = {}
+
+    def _set_state(self, sim, stage, status):
+        """Record a change of state."""
+        self.states[sim.outdir] = (stage, status)
+        if self.callback is not None:
+            self.callback(sim.outdir, stage, status)
+
+    def _script(self, stage):
+        """The job script for a stage."""
+        return {"genic": "mpi_submit_genic", "gadget": "mpi_submit", "analysis": self.analysis}[stage]
+
+    def _complete(self, sim, stage):
+        """Check on disc whether a job stage has completed, so finished stages are not rerun."""
+        if stage == "genic":
+            return remake._ics_exist(sim.outdir)
+        if stage == "gadget":
+            return remake._check_single_status_snap(sim.outdir, "output") <= sim.redend + 0.01
+        return False
+
+    def _reached(self, sim, stage):
+        """Redshift of the last snapshot of MP-Gadget, which falls as the run makes progress.
+        Other stages make no partial progress."""
+        if stage == "gadget":
+            return remake._check_single_status_snap(sim.outdir, "output")
+        return 0
+
+    def _stages(self, sim):
+        """The job stages still to be run for a simulation."""
+        stages = [st for st in JOB_STAGES if st != "analysis" or self.analysis is not None]
+        while stages and stages[0] != "analysis" and self._complete(sim, stages[0]):
+            stages.pop(0)
+        return stages
+
+    async def _submit(self, sim, stage, attempt, after=None):
+        """Wait for a free slot in a stage and submit its job. Returns the job id."""
+        await self._semaphores[stage].acquire()
+        script = self._script(stage)
+        #Restart MP-Gadget from the last snapshot if a previous attempt wrote one.
+        if stage == "gadget" and attempt > 0:
+            try:
+                remake._find_snap(sim.outdir, "output")
+                (resub, found) = remake.write_restart_script(sim.outdir, restart=2)
+                if found:
+                    script = resub
+            except IOError:
+                pass
+        loop = asyncio.get_running_loop()
+        try:
+            jobid = await loop.run_in_executor(None, self.scheduler.submit, script, sim.outdir, after)
+        except Exception:
+            self._semaphores[stage].release()
+            raise
+        self._set_state(sim, stage, "submitted")
+        return jobid
+
+    async def _wait(self, sim, stage, jobid):
+        """Wait for a job to finish. Returns True if it succeeded and the stage is complete on disc."""
+        loop = asyncio.get_running_loop()
+        running = False
+        while True:
+            status = await loop.run_in_executor(None, self.scheduler.status, jobid)
+            if status == "running" and not running:
+                running = True
+                self._set_state(sim, stage, "running")
+            if status in ("done", "failed"):
+                break
+            await asyncio.sleep(self.poll)
+        if status == "done" and stage != "analysis":
+            return await loop.run_in_executor(None, self._complete, sim, stage)
+        return status == "done"
+
+    async def _run_class(self, sim):
+        """Run make_simulation. Returns True if it succeeded."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries+1):
+            async with self._semaphores["class"]:
+                self._set_state(sim, "class", "running")
+                try:
+                    await loop.run_in_executor(None, lambda: sim.make_simulation(**self.make_kwargs))
+                    return True
+                except Exception as err:
+                    print("make_simulation failed for", sim.outdir, ":", err)
+            if attempt < self.retries:
+                await asyncio.sleep(self.retry_delay)
+        return False
+
+    async def run_simulation(self, sim):
+        """Take one simulation through every stage. Returns True if it finished."""
+        #Skip the class stage if the job scripts are already written.
+        if not os.path.exists(os.path.join(sim.outdir, "mpi_submit")):
+            if not await self._run_class(sim):
+                self._set_state(sim, "class", "failed")
+                return False
+        stages = self._stages(sim)
+        attempts = {st: 0 for st in stages}
+        #Number of jobs resubmitted because they made progress, and the redshift reached when each job was submitted.
+        resumed = {st: 0 for st in stages}
+        reached = {}
+        jobs = {}
+        ii = 0
+        while ii < len(stages):
+            stage = stages[ii]
+            if stage not in jobs:
+                reached[stage] = self._reached(sim, stage)
+                jobs[stage] = await self._submit(sim, stage, attempts[stage]+resumed[stage])
+            #Chain the next stage behind this one, so it waits in the queue while this stage runs.
+            if self.scheduler.dependencies and ii+1 < len(stages) and stages[ii+1] not in jobs:
+                reached[stages[ii+1]] = self._reached(sim, stages[ii+1])
+                jobs[stages[ii+1]] = await self._submit(sim, stages[ii+1], attempts[stages[ii+1]]+resumed[stages[ii+1]], after=jobs[stage])
+            success = await self._wait(sim, stage, jobs.pop(stage))
+            self._semaphores[stage].release()
+            if success:
+                self._set_state(sim, stage, "done")
+                ii += 1
+                continue
+            #Cancel the chained job, which will never run.
+            if ii+1 < len(stages) and stages[ii+1] in jobs:
+                self.scheduler.cancel(jobs.pop(stages[ii+1]))
+                self._semaphores[stages[ii+1]].release()
+            if self._reached(sim, stage) < reached[stage]:
+                resumed[stage] += 1
+                self._set_state(sim, stage, "resuming")
+                continue
+            attempts[stage] += 1
+            if attempts[stage] > self.retries:
+                self._set_state(sim, stage, "failed")
+                return False
+            self._set_state(sim, stage, "retrying")
+            await asyncio.sleep(self.retry_delay)
+        self._set_state(sim, "finished", "done")
+        return True
+
+    async def run_async(self):
+        """Run every simulation concurrently. Returns a dictionary of outdir -> True if it finished."""
+        self._semaphores = {st: asyncio.Semaphore(lim) for (st, lim) in self.limits.items()}
+        results = await asyncio.gather(*[self.run_simulation(sim) for sim in self.sims])
+        return {sim.outdir: res for (sim, res) in zip(self.sims, results)}
+
+    def run(self):
+        """Run the suite to completion, blocking until every simulation has finished or failed."""
+        return asyncio.run(self.run_async())
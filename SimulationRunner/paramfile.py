@@ -0,0 +1,178 @@
+"""Module to write the flat 'key = value' parameter files read by MP-GenIC and MP-Gadget.
+
+A default parameter file is parsed once into a template, and the required keys are validated once.
+Parameter files for each simulation are then rendered by substituting values into the template,
+which is much faster than a configobj parse and write for every simulation in a large suite.
+The output is readable by configobj and gives the same values as a configobj round-trip.
+
+Files are only rewritten if their contents change. This preserves modification times,
+so regenerating a suite does not trigger needless rebuilds and resubmissions,
+and saves a metadata write per file on parallel filesystems."""
+import collections
+import os.path
+
+#Characters which force a value to be quoted, following configobj.
+_WSPACE_PLUS = ' \r\n\v\t\'"'
+
+def format_value(value):
+    """Format a value for a parameter file, quoting it in the same way as configobj."""
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return ','
+        if len(value) == 1:
+            return format_value(value[0])+','
+        return ', '.join([format_value(val) for val in value])
+    value = str(value)
+    if not value:
+        return '""'
+    if '\n' in value:
+        raise ValueError('Value "%s" cannot be written to a parameter file' % value)
+    if value[0] in _WSPACE_PLUS or value[-1] in _WSPACE_PLUS or ',' in value or '#' in value:
+        if "'" in value and '"' in value:
+            raise ValueError('Value "%s" cannot be safely quoted' % value)
+        if '"' in value:
+            return "'%s'" % value
+        return '"%s"' % value
+    return value
+
+def _split_value(raw):
+    """Split the right hand side of a parameter line into the value and any trailing comment.
+    Quotes are removed from the value."""
+    raw = raw.strip()
+    if raw[:1] in ('"', "'"):
+        end = raw.find(raw[0], 1)
+        if end < 0:
+            raise ValueError("Unterminated quote in: "+raw)
+        return raw[1:end], raw[end+1:]
+    hashpos = raw.find('#')
+    if hashpos < 0:
+        return raw, ''
+    return raw[:hashpos].rstrip(), ' '+raw[hashpos:]
+
+def parse_params(text):
+    """Parse the text of a flat parameter file. Returns a list of lines, a dictionary
+    of key -> (line number, trailing comment) and a dictionary of key -> value string."""
+    lines = text.splitlines()
+    keys = {}
+    values = {}
+    for (ii, line) in enumerate(lines):
+        sline = line.strip()
+        if not sline or sline[0] == '#':
+            continue
+        if sline[0] == '[' or '=' not in sline:
+            raise ValueError("Not a flat parameter file line: "+line)
+        (key, raw) = sline.split('=', 1)
+        key = key.strip()
+        (val, comment) = _split_value(raw)
+        keys[key] = (ii, comment)
+        values[key] = val
+    return lines, keys, values
+
+class ParamTemplate(object):
+    """A parameter file template, parsed once from a default parameter file.
+    Parameters which are set when rendering replace the default value on the same line.
+    Parameters not in the defaults are appended in the order they are given.
+
+    Init parameters:
+    filename - default parameter file. If None, the template is empty.
+    required - dictionary of keys which must have the given values in the default file.
+    """
+    def __init__(self, filename=None, required=None):
+        self.filename = filename
+        self._lines = []
+        self._keys = {}
+        self.defaults = {}
+        if filename is not None:
+            with open(filename, 'r') as pfile:
+                (self._lines, self._keys, self.defaults) = parse_params(pfile.read())
+        if required is not None:
+            self.validate(required)
+
+    def validate(self, required):
+        """Check that the default file has the required values for some keys."""
+        for (key, val) in required.items():
+            if self.defaults.get(key) != str(val):
+                raise ValueError("Parameter "+key+" is "+str(self.defaults.get(key))+" in "+str(self.filename)+", need "+str(val))
+
+    def render(self, params):
+        """Render the parameter file for a dictionary of parameters to a string."""
+        lines = list(self._lines)
+        extra = []
+        for (key, val) in params.items():
+            line = key+" = "+format_value(val)
+            try:
+                (ii, comment) = self._keys[key]
+                lines[ii] = line + comment
+            except KeyError:
+                extra.append(line)
+        return "\n".join(lines+extra)+"\n"
+
+    def render_batch(self, paramlist):
+        """Render the parameter files for a list of parameter dictionaries, eg, for every simulation in a suite."""
+        return [self.render(params) for params in paramlist]
+
+    def write(self, filename, params):
+        """Render a parameter file and write it to disc if it changed. Returns a ParamChange."""
+        return write_if_changed(filename, self.render(params))
+
+#Cache of templates, keyed by the default file and the required values.
+_TEMPLATES = {}
+
+def load_template(filename, required=None):
+    """Get a template for a default parameter file, parsing and validating it only the first time it is used."""
+    if filename is not None:
+        filename = os.path.realpath(filename)
+    key = (filename, tuple(sorted((required or {}).items())))
+    try:
+        return _TEMPLATES[key]
+    except KeyError:
+        pass
+    template = ParamTemplate(filename, required=required)
+    _TEMPLATES[key] = template
+    return template
+
+def write_batch(template, filenames, paramlist):
+    """Render and write the parameter files for many simulations in one call.
+    Returns a list of ParamChange."""
+    assert len(filenames) == len(paramlist)
+    return [write_if_changed(fname, text) for (fname, text) in zip(filenames, template.render_batch(paramlist))]
+
+#Record of a (possible) write of a parameter file.
+#status is one of 'created', 'changed' or 'unchanged'.
+#changed is a dictionary of key -> (old value, new value) for changed parameters.
+#Keys which were added or removed have None as the missing value.
+ParamChange = collections.namedtuple("ParamChange", ["filename", "status", "changed"])
+
+def diff_params(old, new):
+    """Find the parameters which differ between the texts of two parameter files."""
+    oldvals = parse_params(old)[2]
+    newvals = parse_params(new)[2]
+    changed = {}
+    for key in set(oldvals) | set(newvals):
+        if oldvals.get(key) != newvals.get(key):
+            changed[key] = (oldvals.get(key), newvals.get(key))
+    return changed
+
+def write_if_changed(filename, text, params=True):
+    """Write text to a file, only if the file does not already have exactly this content.
+    If params is True, the file is a flat parameter file and the changed parameters are reported.
+    Returns a ParamChange."""
+    try:
+        with open(filename, 'r') as pfile:
+            old = pfile.read()
+    except FileNotFoundError:
+        old = None
+    if old == text:
+        return ParamChange(filename, 'unchanged', {})
+    changed = {}
+    if old is not None and params:
+        try:
+            changed = diff_params(old, text)
+        except ValueError:
+            #Not a flat parameter file: just report that it changed.
+            pass
+    with open(filename, 'w') as pfile:
+        pfile.write(text)
+    if old is None:
+        return ParamChange(filename, 'created', changed)
+    return ParamChange(filename, 'changed', changed)
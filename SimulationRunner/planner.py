@@ -0,0 +1,195 @@
+"""Module to estimate what a proposed suite of simulations will cost before anything is submitted.
+
+For each simulation, the cost of MP-GenIC scales with the number of particles of each type (gas, dark matter, neutrinos),
+and the cost of MP-Gadget with the number of particles times the number of e-foldings of the scale factor simulated.
+Snapshot sizes are bytes per particle times the particle count, for each output in generate_times and the final snapshot,
+and a restart dump is the size of a snapshot. These give core-hours, the number of jobs and the core-hours requested
+from the queue, and, by scheduling the runs on a number of concurrent slots, the critical path and the peak storage.
+
+The default costs are rough. CostModel.calibrate rescales them from the telemetry of past runs:
+the MP-GenIC stage timings written by instrument.StageTimer, the step lines of MP-Gadget's cpu.txt
+and the sizes of the snapshots on disc."""
+import glob
+import heapq
+import math
+import os
+import os.path
+import re
+import numpy as np
+from . import instrument
+from . import catalogue
+from . import archive
+
+#Core-seconds per particle for MP-GenIC.
+GENIC_COST = {"gas": 2e-4, "dm": 2e-4, "nu": 2e-4}
+#Core-seconds per particle per e-folding of the scale factor for MP-Gadget.
+#Gas is much more expensive than dark matter; neutrinos are hot, so cluster little and take few short timesteps.
+GADGET_COST = {"gas": 0.1, "dm": 0.02, "nu": 0.005}
+#Bytes per particle in a snapshot: Position (3 f8), Velocity (3 f4), ID (u8), Mass (f4) and GroupID (u4),
+#and for gas the density, internal energy, electron and neutral fractions, smoothing length, star formation rate and metallicity.
+SNAPSHOT_BYTES = {"gas": 80, "dm": 52, "nu": 52}
+#Bytes per particle in the ICs: Position, Velocity, ID and Mass, and the internal energy of gas.
+IC_BYTES = {"gas": 52, "dm": 48, "nu": 48}
+
+def particle_counts(sim):
+    """Number of particles of each type in a simulation, from its GenIC parameters."""
+    config = sim._genicfile_child_options({'Ngrid': sim.npart, 'NgridNu': 0, 'ProduceGas': int(sim.separate_gas)})
+    return {"gas": sim.npart**3 if sim.separate_gas else 0, "dm": sim.npart**3, "nu": int(config['NgridNu'])**3}
+
+def header_counts(snapdir):
+    """Number of particles of each type in a BigFile snapshot. Stars and black holes were gas."""
+    npart = [int(nn) for nn in catalogue.read_header(snapdir)["TotNumPart"]]
+    npart += [0]*(6 - len(npart))
+    return {"gas": npart[0] + npart[4] + npart[5], "dm": npart[1], "nu": npart[2]}
+
+def gadget_core_seconds(cpufile):
+    """Core-seconds used by MP-Gadget, and the first and last scale factors reached, from the step lines
+    'Step N, Time: a, MPIs: m Threads: t Elapsed: s' of cpu.txt. Elapsed starts from zero again when
+    the run is restarted, so the last elapsed time of each run is counted. Returns None if there are no steps."""
+    total = 0.
+    first = None
+    prev = None
+    with open(cpufile, 'r') as cfile:
+        for line in cfile:
+            match = re.match(r"^Step\s+[0-9]+,\s*Time:\s*([-+0-9.eE]+),\s*MPIs:\s*([0-9]+)\s+Threads:\s*([0-9]+)\s+Elapsed:\s*([-+0-9.eE]+)", line)
+            if match is None:
+                continue
+            elapsed = float(match.group(4))
+            if prev is not None and elapsed < prev[0]:
+                total += prev[0]*prev[1]
+            prev = (elapsed, int(match.group(2))*int(match.group(3)))
+            if first is None:
+                first = float(match.group(1))
+            last = float(match.group(1))
+    if prev is None:
+        return None
+    return (total + prev[0]*prev[1], first, last)
+
+class CostModel(object):
+    """Cost of a simulation, in core-seconds and bytes per particle of each type.
+
+    Init parameters:
+    genic_cost, gadget_cost, snapshot_bytes, ic_bytes - dictionaries of particle type -> cost,
+        overriding the module defaults.
+    """
+    def __init__(self, genic_cost=None, gadget_cost=None, snapshot_bytes=None, ic_bytes=None):
+        self.genic_cost = dict(GENIC_COST, **(genic_cost or {}))
+        self.gadget_cost = dict(GADGET_COST, **(gadget_cost or {}))
+        self.snapshot_bytes = dict(SNAPSHOT_BYTES, **(snapshot_bytes or {}))
+        self.ic_bytes = dict(IC_BYTES, **(ic_bytes or {}))
+        #Factors applied to the costs, set by calibrate, and the number of runs each was measured from.
+        self.scale = {"genic": 1., "gadget": 1., "storage": 1.}
+        self.samples = {"genic": 0, "gadget": 0, "storage": 0}
+
+    def _weighted(self, cost, counts):
+        """Sum of cost per particle times number of particles."""
+        return float(sum([cost[ptype]*nn for (ptype, nn) in counts.items()]))
+
+    def calibrate(self, rundir):
+        """Rescale the costs to match past runs in rundir, one simulation per subdirectory.
+        Each factor is the median ratio of measured to modelled cost over the runs which have the telemetry,
+        and is left alone if there are none. Returns the scale factors."""
+        ratios = {"genic": [], "gadget": [], "storage": []}
+        for simdir in sorted(glob.glob(os.path.join(rundir, "*"))):
+            snaps = sorted(glob.glob(os.path.join(simdir, "output", "PART_[0-9][0-9][0-9]")))
+            icdirs = sorted(glob.glob(os.path.join(simdir, "ICS", "*")))
+            try:
+                counts = header_counts(snaps[-1] if snaps else icdirs[-1])
+            except (IndexError, IOError, KeyError):
+                continue
+            genic = [ev for ev in instrument.load_timings(simdir) if ev["stage"] == "genic" and ev["status"] == "ok"]
+            if genic:
+                ratios["genic"].append(genic[-1]["cpu_children"] / self._weighted(self.genic_cost, counts))
+            try:
+                gadget = gadget_core_seconds(os.path.join(simdir, "output", "cpu.txt"))
+            except FileNotFoundError:
+                gadget = None
+            if gadget is not None and gadget[2] > gadget[1]:
+                ratios["gadget"].append(gadget[0] / (self._weighted(self.gadget_cost, counts)*math.log(gadget[2]/gadget[1])))
+            #Archived snapshots only keep their header.
+            if snaps and not os.path.exists(os.path.join(snaps[-1], archive.ARCHIVE_MARKER)):
+                ratios["storage"].append(catalogue._disc_usage(snaps[-1]) / self._weighted(self.snapshot_bytes, counts))
+        for (kind, rr) in ratios.items():
+            if rr:
+                self.scale[kind] = float(np.median(rr))
+                self.samples[kind] = len(rr)
+        return self.scale
+
+    def estimate(self, sim, cluster=None):
+        """Estimate the cost of one simulation on a cluster (by default its own cluster class).
+        Returns a dictionary of core-hours, wall hours, jobs and bytes."""
+        if cluster is None:
+            cluster = sim._cluster
+        counts = particle_counts(sim)
+        cores = cluster.ncores()
+        genic = self.scale["genic"]*self._weighted(self.genic_cost, counts)/3600
+        gadget = self.scale["gadget"]*self._weighted(self.gadget_cost, counts)*math.log((1+sim.redshift)/(1+sim.redend))/3600
+        snapshot = self.scale["storage"]*self._weighted(self.snapshot_bytes, counts)
+        ics = self.scale["storage"]*self._weighted(self.ic_bytes, counts)
+        #One snapshot per output time, and one at TimeMax.
+        nsnap = len(sim.generate_times()) + 1
+        #MP-Gadget stops 5 minutes before the time limit to write a restart, then is resubmitted.
+        jobs = max(1, int(math.ceil(gadget/cores / (cluster.timelimit - 300./3600))))
+        return {"outdir": sim.outdir, "particles": counts, "cores": cores,
+                "genic_core_hours": genic, "gadget_core_hours": gadget, "genic_hours": genic/cores, "gadget_hours": gadget/cores,
+                "gadget_jobs": jobs, "requested_core_hours": cores*(0.5 + jobs*cluster.timelimit),
+                "ic_bytes": ics, "snapshot_bytes": snapshot, "snapshots": nsnap, "restart_bytes": snapshot,
+                "bytes": ics + (nsnap + 1)*snapshot}
+
+def _stored(run, time, compact):
+    """Bytes stored by a run at a time. The snapshots are assumed to be written at a constant rate."""
+    if time < run["ics_written"]:
+        return 0.
+    if time >= run["end"]:
+        return run["snapshot_bytes"] if compact else run["bytes"]
+    frac = (time - run["ics_written"]) / (run["end"] - run["ics_written"])
+    return run["ic_bytes"] + run["restart_bytes"] + frac*run["snapshots"]*run["snapshot_bytes"]
+
+def plan_suite(sims, cluster=None, model=None, telemetry=None, max_concurrent=None, queue_wait=0., compact=False):
+    """Estimate the cost of a suite of simulations without running anything.
+    sims - SimulationICs (or subclass) instances.
+    cluster - cluster class instance to run on. By default each simulation's own.
+    model - CostModel. If telemetry is a run directory of past simulations, the model is calibrated from it.
+    max_concurrent - number of simulations run at once. By default all of them.
+    queue_wait - hours each job waits in the queue.
+    compact - if True, finished simulations are assumed to be compacted by archive.compact_suite to their last snapshot.
+    Runs are started longest first in the next free slot. Returns a dictionary with the estimate for each run
+    (with its start and end in hours), the totals, the critical path (the run which finishes last),
+    and the peak storage and cores in use."""
+    if model is None:
+        model = CostModel()
+    if telemetry is not None:
+        model.calibrate(telemetry)
+    runs = [model.estimate(sim, cluster) for sim in sims]
+    slots = [0.]*min(max_concurrent or len(runs), len(runs))
+    for run in sorted(runs, key=lambda rr: -(rr["genic_hours"] + rr["gadget_hours"])):
+        start = heapq.heappop(slots)
+        run["start"] = start
+        run["ics_written"] = start + queue_wait + run["genic_hours"]
+        run["end"] = run["ics_written"] + run["gadget_jobs"]*queue_wait + run["gadget_hours"]
+        heapq.heappush(slots, run["end"])
+    totals = {kk: sum([rr[kk] for rr in runs]) for kk in ("genic_core_hours", "gadget_core_hours", "requested_core_hours", "bytes")}
+    totals["core_hours"] = totals["genic_core_hours"] + totals["gadget_core_hours"]
+    totals["jobs"] = sum([1 + rr["gadget_jobs"] for rr in runs])
+    plan = {"runs": runs, "totals": totals, "critical_path": None, "makespan_hours": 0., "peak_bytes": 0., "peak_cores": 0}
+    if not runs:
+        return plan
+    last = max(runs, key=lambda rr: rr["end"])
+    plan["critical_path"] = last["outdir"]
+    plan["makespan_hours"] = last["end"]
+    #Storage only falls when a run is compacted, so the peak is at a time when ICs are written or a run ends.
+    for time in sorted(set([rr["ics_written"] for rr in runs] + [rr["end"] for rr in runs])):
+        plan["peak_bytes"] = max(plan["peak_bytes"], sum([_stored(rr, time, compact) for rr in runs]))
+        plan["peak_cores"] = max(plan["peak_cores"], sum([rr["cores"] for rr in runs if rr["start"] <= time < rr["end"]]))
+    return plan
+
+def print_plan(plan):
+    """Print a table of the estimated cost of each run and of the suite."""
+    print("%-30s %12s %12s %8s %6s %10s" % ("simulation", "core-hours", "wall (hr)", "start", "jobs", "GB"))
+    for run in sorted(plan["runs"], key=lambda rr: rr["start"]):
+        print("%-30s %12.1f %12.2f %8.2f %6d %10.2f" % (os.path.basename(run["outdir"]), run["genic_core_hours"] + run["gadget_core_hours"],
+              run["genic_hours"] + run["gadget_hours"], run["start"], 1 + run["gadget_jobs"], run["bytes"]/1e9))
+    totals = plan["totals"]
+    print("Total: %.1f core-hours (%.1f requested) in %d jobs, %.2f GB" % (totals["core_hours"], totals["requested_core_hours"], totals["jobs"], totals["bytes"]/1e9))
+    print("Critical path: %s, finishing after %.2f hours" % (plan["critical_path"], plan["makespan_hours"]))
+    print("Peak storage: %.2f GB, peak cores: %d" % (plan["peak_bytes"]/1e9, plan["peak_cores"]))
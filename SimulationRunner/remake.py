@@ -1,6 +1,6 @@
 """This module rebuilds the Gadget binary for all runs in a directory.
-It must be very compatible, as it will run on the cluster.
-Requires python 2.6."""
+It will run on the cluster, so only imports the standard library at module level.
+Requires python 3."""
 
 from __future__ import print_function
 import glob
@@ -45,7 +45,6 @@ def rebuild(rundir, codedir, config_file="Config.sh", binary=["P-Gadget3",]):
                     raise OSError("File:",codeconf," exists, and is not symlink. Not deleting")
             #Make symlink
             os.symlink(cc, path.join(codedir,config_file))
-            #check_output is new in python 2.7, so not used.
             make_retcode = subprocess.call(["make", "-j4"], cwd=codedir)
             if make_retcode:
                 raise RuntimeError("make failed on ",cc)
@@ -68,16 +67,46 @@ def detect_submit():
     #Otherwise not sure what to do.
     raise ValueError("Could not find sbatch or qsub")
 
-def resub(rundir, script_file="mpi_submit", submit_command=None):
-    """Submit all jobs in the emulator to the queueing system"""
+def _submit(submit_command, script_file, cwd):
+    """Submit a job script. submit_command is either the name of a command, like sbatch,
+    or a callable taking the script and directory, like localrunner.LocalRunner.
+    Returns the job id, or None if the submission failed."""
+    if callable(submit_command):
+        return submit_command(script_file, cwd)
+    proc = subprocess.Popen([submit_command, script_file], cwd=cwd, stdout=subprocess.PIPE)
+    output = proc.communicate()[0].decode()
+    print(output, end="")
+    if proc.returncode:
+        return None
+    #sbatch prints 'Submitted batch job 1234', qsub prints '1234.server'.
+    match = re.search("([0-9]+)", output)
+    if match is None:
+        return None
+    return match.group(1)
+
+def _record(state, odir, stage, jobid, script_file):
+    """Record a submission in the suite state database, if there is one."""
+    if state is not None and jobid is not None:
+        state.record_submission(path.basename(path.normpath(odir)), stage, jobid, script_file)
+
+def resub(rundir, script_file="mpi_submit", submit_command=None, state=None):
+    """Submit all jobs in the emulator to the queueing system.
+    submit_command may be a command name or a callable, see _submit.
+    If state is a suitestate.SuiteState, the simulations are taken from it and the job ids are recorded in it."""
     #Find all subdirs with config files.
     if submit_command is None:
         submit_command = detect_submit()
     rundir = path.expanduser(rundir)
-    configs = glob.glob(path.join(path.join(rundir, "*"),script_file))
+    if state is not None:
+        state.refresh()
+        configs = [path.join(odir, script_file) for (odir, _, _, _) in state.status()]
+        configs = [cc for cc in configs if path.exists(cc)]
+    else:
+        configs = glob.glob(path.join(path.join(rundir, "*"),script_file))
     for cc in configs:
         cdir = path.dirname(cc)
-        subprocess.call([submit_command, script_file], cwd=cdir)
+        jobid = _submit(submit_command, script_file, cdir)
+        _record(state, cdir, "gadget", jobid, script_file)
 
 def _check_single_status(fname, regex):
     """Given a file, check whether it shows the
@@ -151,10 +180,21 @@ def _get_regex(odir, output_file):
         return output_txt, r"Step [0-9]*, Time: ([0-9]{1,3}\.?[0-9]*)"
     return output_txt, regex
 
-def check_status(rundir, output_file="output", endz=2, use_file=True, snap="PART_"):
+def check_status(rundir, output_file="output", endz=2, use_file=True, snap="PART_", state=None):
     """Get completeness status for every directory in the suite.
     Ultimately this should work out whether there
-    was an error or just a timeout."""
+    was an error or just a timeout.
+    If state is a suitestate.SuiteState, it is brought up to date and the redshifts are read from it,
+    which only looks at the simulations which changed since the last check. The state reads the redshift
+    from the header of the last output/PART_ snapshot, so other output_file, snap or use_file values cannot be used with it."""
+    if state is not None:
+        if (output_file, snap, use_file) != ("output", "PART_", True):
+            raise ValueError("A SuiteState reads output/PART_ snapshot headers: output_file, snap and use_file cannot be changed with state")
+        state.refresh()
+        rows = state.status()
+        if not rows:
+            raise IOError(rundir +" is empty.")
+        return [rr[0] for rr in rows], [rr[2] <= endz for rr in rows], [rr[2] for rr in rows]
     rundir = path.expanduser(rundir)
     odirs = glob.glob(path.join(rundir, "*"+os.path.sep))
     if not odirs:
@@ -186,59 +226,138 @@ def print_status(rundir, output_file="output", endz=2.01):
         else:
             print("COMPLETE")
 
-def resub_not_complete(rundir, output_file="output", endz=2.01, script_file="mpi_submit", resub_command=None, paramfile="mpgadget.param", restart=1, snap="PART_"):
+def write_restart_script(odir, output_file="output", script_file="mpi_submit", paramfile="mpgadget.param", restart=1, snap="PART_"):
+    """Write a copy of the script file, script_file+"_resub", which adds a RestartFlag
+    (and for restart=2 the last snapshot) to the MPI command line.
+    Returns the name of the new script and whether the MPI command line was found."""
+    rest = " "+str(restart)
+    if restart == 2:
+        snapnum = _find_snap(odir, output_file,snap=snap)
+        rest += " "+str(snapnum)
+    script_file_resub = script_file+"_resub"
+    found = False
+    with open(path.join(odir, script_file),'r') as ifile:
+        with open(path.join(odir, script_file_resub),'w') as ofile:
+            line = ifile.readline()
+            while line != '':
+                #Find the actual submission line and add a '1' after the paramfile.
+                if re.search("mpirun|mpiexec|ibrun|srun", line):
+                    nline = re.sub(paramfile, paramfile+rest,line)
+                    assert nline != line
+                    line = nline
+                    found = True
+                #Write each line straight through to the output by default.
+                ofile.write(line)
+                line = ifile.readline()
+    return script_file_resub, found
+
+def _verifier(rundir, verify):
+    """A verify.Verifier with its checksum cache in rundir, or None if verify is False.
+    Imported here as it needs numpy."""
+    if not verify:
+        return None
+    from . import verify as vv
+    return vv.Verifier(path.join(path.expanduser(rundir), ".verify_cache.sqlite"))
+
+def _corrupt(verifier, bigfile):
+    """Check a BigFile with a verifier, printing any problems. Returns True if it is corrupt."""
+    if verifier is None or not path.exists(bigfile):
+        return False
+    problems = verifier.verify(bigfile)
+    for pp in problems:
+        print("CORRUPT: ",pp)
+    return bool(problems)
+
+def resub_not_complete(rundir, output_file="output", endz=2.01, script_file="mpi_submit", resub_command=None, paramfile="mpgadget.param", restart=1, snap="PART_", state=None, verify=False):
     """Resubmit incomplete simulations to the queue.
-    We also edit the script file to add a RestartFlag"""
+    We also edit the script file to add a RestartFlag.
+    If state is a suitestate.SuiteState, the status is read from it and the resubmissions are recorded in it.
+    If verify is True, the snapshot (for restart=2) or the restart files (for restart=1) are checked
+    with verify.Verifier first, and simulations are not resubmitted if they are corrupt."""
     if resub_command is None:
         resub_command = detect_submit()
-    outputs, completes, _ = check_status(rundir, output_file, endz)
+    outputs, completes, _ = check_status(rundir, output_file, endz, state=state)
+    verifier = _verifier(rundir, verify)
     #Pathnames for incomplete simulations
     for odir,cc in zip(outputs,completes):
         if cc:
             continue
-        rest = " "+str(restart)
         if restart == 2:
-            snapnum = _find_snap(odir, output_file,snap=snap)
-            rest += " "+str(snapnum)
-        script_file_resub = script_file+"_resub"
-        found = False
-        with open(path.join(odir, script_file),'r') as ifile:
-            with open(path.join(odir, script_file_resub),'w') as ofile:
-                line = ifile.readline()
-                while line != '':
-                    #Find the actual submission line and add a '1' after the paramfile.
-                    if re.search("mpirun|mpiexec|ibrun", line):
-                        nline = re.sub(paramfile, paramfile+rest,line)
-                        assert nline != line
-                        line = nline
-                        found = True
-                    #Write each line straight through to the output by default.
-                    ofile.write(line)
-                    line = ifile.readline()
+            try:
+                restartfile = path.join(odir, output_file, snap+str(_find_snap(odir, output_file, snap=snap)).rjust(3,'0'))
+            except IOError:
+                restartfile = ""
+        else:
+            restartfile = path.join(odir, output_file, "RESTART")
+        if _corrupt(verifier, restartfile):
+            print("ERROR: corrupt restart state, not re-submitting: ",odir)
+            continue
+        (script_file_resub, found) = write_restart_script(odir, output_file=output_file, script_file=script_file, paramfile=paramfile, restart=restart, snap=snap)
         if found:
             print("Re-submitting: ",path.join(odir, script_file_resub))
-            subprocess.call([resub_command, script_file_resub], cwd=odir)
+            jobid = _submit(resub_command, script_file_resub, odir)
+            _record(state, odir, "gadget", jobid, script_file_resub)
         else:
             print("ERROR: no change, not re-submitting: ",path.join(odir, script_file_resub))
 
-def check_status_ics(rundir, icdir="ICS"):
-    """Get IC generation status for every directory in the suite."""
+def _ics_exist(odir, icdir="ICS"):
+    """Check whether a simulation directory has ICs."""
+    return bool(glob.glob(path.join(path.join(odir, icdir),"*/Header/attr-v2")))
+
+def _ics_intact(odir, icdir, verifier):
+    """Check that every IC file of a simulation passes the verifier."""
+    icfiles = [path.dirname(path.dirname(hh)) for hh in glob.glob(path.join(path.join(odir, icdir),"*/Header/attr-v2"))]
+    return not any([_corrupt(verifier, ic) for ic in icfiles])
+
+def check_status_ics(rundir, icdir="ICS", verify=False):
+    """Get IC generation status for every directory in the suite.
+    If verify is True, ICs which fail the checks in verify.Verifier count as not existing."""
     rundir = path.expanduser(rundir)
     odirs = glob.glob(path.join(rundir, "*"+os.path.sep))
     if not odirs:
         raise IOError(rundir +" is empty.")
-    icex = lambda odir: bool(glob.glob(path.join(path.join(odir, icdir),"*/Header/attr-v2")))
-    exists = [icex(cc) for cc in odirs]
+    exists = [_ics_exist(cc, icdir) for cc in odirs]
+    verifier = _verifier(rundir, verify)
+    if verifier is not None:
+        exists = [ee and _ics_intact(cc, icdir, verifier) for (cc, ee) in zip(odirs, exists)]
     return odirs, exists
 
-def resub_not_complete_genic(rundir, icdir="ICS", script_file="mpi_submit_genic", resub_command=None):
-    """Resubmit failed IC generations to the queue."""
+def genic_batch_status(batchdir, status_file="genic_batch_status"):
+    """Read the results of a batched IC generation written by clusters.ClusterClass.generate_mpi_submit_genic_batch.
+    Returns a dictionary of simulation directory -> dictionary of 'genic' and 'check' -> 'ok' or 'failed'.
+    Later lines replace earlier ones, so a batch which is run again updates the status."""
+    status = {}
+    try:
+        with open(path.join(batchdir, status_file), 'r') as sfile:
+            for line in sfile:
+                fields = line.strip().rsplit(" ", 2)
+                if len(fields) == 3:
+                    status.setdefault(fields[0], {})[fields[1]] = fields[2]
+    except FileNotFoundError:
+        pass
+    return status
+
+def resub_not_complete_genic(rundir, icdir="ICS", script_file="mpi_submit_genic", resub_command=None, state=None, verify=False):
+    """Resubmit failed IC generations to the queue.
+    If state is a suitestate.SuiteState, the IC status is read from it and the resubmissions are recorded in it.
+    The state database only knows about ICs in the ICS directory.
+    If verify is True, IC generations are also resubmitted if their ICs are corrupt."""
     if resub_command is None:
         resub_command = detect_submit()
-    outputs, completes = check_status_ics(rundir, icdir)
+    if state is not None:
+        state.refresh()
+        outputs = state.without_ics()
+        verifier = _verifier(rundir, verify)
+        if verifier is not None:
+            have_ics = [oo for (oo, _, _, _) in state.status() if oo not in outputs]
+            outputs += [oo for oo in have_ics if not _ics_intact(oo, icdir, verifier)]
+        completes = [False for _ in outputs]
+    else:
+        outputs, completes = check_status_ics(rundir, icdir, verify=verify)
     #Pathnames for incomplete simulations
     for odir,cc in zip(outputs,completes):
         if cc:
             continue
         print("Re-submitting: ",path.join(odir, script_file))
-        subprocess.call([resub_command, script_file], cwd=odir)
+        jobid = _submit(resub_command, script_file, odir)
+        _record(state, odir, "genic", jobid, script_file)
@@ -1,5 +1,8 @@
 """Class to generate simulation ICS, separated out for clarity."""
 from __future__ import print_function
+import io
+import functools
+import filecmp
 import os.path
 import math
 import subprocess
@@ -8,13 +11,18 @@ import shutil
 #To do crazy munging of types for the storage format
 import importlib
 import numpy as np
-import configobj
-import classylss
-import classylss.binding as CLASS
 from . import utils
 from . import clusters
 from . import read_uvb_tab
-from . import cambpower
+from . import paramfile
+from . import lineartheory
+from . import kgrid
+from . import classtune
+from . import instrument
+from . import build
+#configobj, classylss and cambpower (which needs nbodykit) are slow to import,
+#so they are imported in the functions which use them. This keeps constructing
+#SimulationICs objects cheap when we only want to inspect or regenerate parameter files.
 
 class SimulationICs(object):
     """
@@ -43,8 +51,16 @@ class SimulationICs(object):
     ns - Scalar spectral index
     m_nu - neutrino mass
     unitary - if true, do not scatter modes, but use a unitary gaussian amplitude.
+    kgrid_tol - if not None, thin the k grid of the CLASS tables read by MP-GenIC to the nodes needed
+                to reproduce them to this accuracy with cubic interpolation in log k.
+                The achieved accuracy is saved as kgrid_error.
+    headless_ic_check - if true, the check of the IC power spectrum saves its diagnostics to ICS/PK-IC-*.npz
+                instead of plotting them. Plot them later with cambpower.render_suite_ic_power.
+    nu_acc_target - if not None, and m_nu > 0, ignore nu_acc and use the cheapest CLASS neutrino precision settings
+                which give the total matter power to this relative accuracy. The neutrino power must be accurate
+                to nu_acc_nu_target. The tuned settings are cached and saved as nu_precision.
     """
-    def __init__(self, *, outdir, box, npart, seed = 9281110, redshift=99, redend=0, separate_gas=True, omega0=0.288, omegab=0.0472, hubble=0.7, scalar_amp=2.427e-9, ns=0.97, rscatter=False, m_nu=0, nu_hierarchy='degenerate', uvb="pu", cluster_class=clusters.StampedeClass, nu_acc=1e-5, unitary=True):
+    def __init__(self, *, outdir, box, npart, seed = 9281110, redshift=99, redend=0, separate_gas=True, omega0=0.288, omegab=0.0472, hubble=0.7, scalar_amp=2.427e-9, ns=0.97, rscatter=False, m_nu=0, nu_hierarchy='degenerate', uvb="pu", cluster_class=clusters.StampedeClass, nu_acc=1e-5, unitary=True, kgrid_tol=None, headless_ic_check=False, nu_acc_target=None, nu_acc_nu_target=1e-2):
         #Check that input is reasonable and set parameters
         #In Mpc/h
         assert box < 20000
@@ -68,8 +84,16 @@ class SimulationICs(object):
         assert ns > 0 and ns < 2
         self.ns = ns
         self.unitary = unitary
+        #Accuracy for thinning the CLASS k grid
+        self.kgrid_tol = kgrid_tol
+        #Save IC power diagnostics rather than plotting them on the compute node
+        self.headless_ic_check = headless_ic_check
         #Neutrino accuracy for CLASS
         self.nu_acc = nu_acc
+        #Target accuracy for tuning the neutrino precision, and the tuned settings
+        self.nu_acc_target = nu_acc_target
+        self.nu_acc_nu_target = nu_acc_nu_target
+        self.nu_precision = None
         #UVB? Only matters if gas
         self.uvb = uvb
         assert self.uvb == "hm" or self.uvb == "fg" or self.uvb == "sh" or self.uvb == "pu"
@@ -92,6 +116,7 @@ class SimulationICs(object):
         self.nu_hierarchy = nu_hierarchy
         self.outdir = outdir
         self._set_default_paths()
+        self.cluster_class = cluster_class
         self._cluster = cluster_class(gadget=self.gadgetexe, param=self.gadgetparam, genic=self.genicexe, genicparam=self.genicout)
         #For repeatability, we store git hashes of Gadget, GenIC, CAMB and ourselves
         #at time of running.
@@ -110,9 +135,24 @@ class SimulationICs(object):
         self.genicdefault = os.path.join(defaultpath,"mpgenic.ini")
         self.gadgetconfig = "Options.mk"
         self.gadget_dir = os.path.expanduser("~/codes/MP-Gadget/")
-
-    def cambfile(self):
-        """Generate the IC power spectrum using classylss."""
+        #Linear theory at every output redshift, within the CLASS output directory
+        self.linear_theory_file = "linear_theory.npz"
+
+    def _nu_precision_params(self):
+        """Default CLASS precision parameters for massive neutrinos, set by nu_acc."""
+        #Neutrino accuracy: Default pk_ref.pre has tol_ncdm_* = 1e-10,
+        #which takes 45 minutes (!) on my laptop.
+        #tol_ncdm_* = 1e-8 takes 20 minutes and is machine-accurate.
+        #Default parameters are fast but off by 2%.
+        #I chose 1e-5, which takes 6 minutes and is accurate to 1e-5
+        nuparams = {'tol_ncdm_newtonian': min(self.nu_acc,1e-5), 'tol_ncdm_synchronous': self.nu_acc, 'l_max_ncdm': 50}
+        #Does nothing unless ncdm_fluid_approximation = 2
+        #Spend less time on neutrino power for smaller neutrino mass
+        nuparams['ncdm_fluid_trigger_tau_over_tau_k'] = 30000.* (self.m_nu / 0.4)
+        return nuparams
+
+    def _class_params(self):
+        """Parameters for the CLASS solve, with the default neutrino precision."""
         #Load high precision defaults
         pre_params = {'tol_background_integration': 1e-9, 'tol_perturb_integration' : 1.e-7, 'tol_thermo_integration':1.e-5, 'k_per_decade_for_pk': 50,'k_bao_width': 8, 'k_per_decade_for_bao':  200, 'neglect_CMB_sources_below_visibility' : 1.e-30, 'transfer_neglect_late_source': 3000., 'l_max_g' : 50, 'l_max_ur':150, 'extra metric transfer functions': 'y'}
         #Set the neutrino density and subtract it from omega0
@@ -121,27 +161,17 @@ class SimulationICs(object):
         gparams = {'h':self.hubble, 'Omega_cdm':omcdm,'Omega_b': self.omegab, 'Omega_k':0, 'n_s': self.ns, 'A_s': self.scalar_amp}
         #Lambda is computed self-consistently
         gparams['Omega_fld'] = 0
-        numass = get_neutrino_masses(self.m_nu, self.nu_hierarchy)
+        numass = self._neutrino_masses()
         #Set up massive neutrinos
         if self.m_nu > 0:
             gparams['m_ncdm'] = '%.8f,%.8f,%.8f' % (numass[2], numass[1], numass[0])
             gparams['N_ncdm'] = 3
             gparams['N_ur'] = 0.00641
-            #Neutrino accuracy: Default pk_ref.pre has tol_ncdm_* = 1e-10,
-            #which takes 45 minutes (!) on my laptop.
-            #tol_ncdm_* = 1e-8 takes 20 minutes and is machine-accurate.
-            #Default parameters are fast but off by 2%.
-            #I chose 1e-5, which takes 6 minutes and is accurate to 1e-5
-            gparams['tol_ncdm_newtonian'] = min(self.nu_acc,1e-5)
-            gparams['tol_ncdm_synchronous'] = self.nu_acc
+            gparams.update(self._nu_precision_params())
             gparams['tol_ncdm_bg'] = 1e-10
-            gparams['l_max_ncdm'] = 50
             #This disables the fluid approximations, which make P_nu not match camb on small scales.
             #We need accurate P_nu to initialise our neutrino code.
             gparams['ncdm_fluid_approximation'] = 2
-            #Does nothing unless ncdm_fluid_approximation = 2
-            #Spend less time on neutrino power for smaller neutrino mass
-            gparams['ncdm_fluid_trigger_tau_over_tau_k'] = 30000.* (self.m_nu / 0.4)
         else:
             gparams['N_ur'] = 3.046
         #Initial cosmology
@@ -149,6 +179,18 @@ class SimulationICs(object):
         maxk = 2*math.pi/self.box*self.npart*8
         powerparams = {'output': 'dTk vTk mPk', 'P_k_max_h/Mpc' : maxk, "z_max_pk" : self.redshift+1}
         pre_params.update(powerparams)
+        return pre_params
+
+    def cambfile(self):
+        """Generate the IC power spectrum using classylss."""
+        import configobj
+        import classylss.binding as CLASS
+        pre_params = self._class_params()
+        maxk = pre_params['P_k_max_h/Mpc']
+        #Replace the default neutrino precision with the cheapest settings which meet the target accuracy.
+        if self.m_nu > 0 and self.nu_acc_target is not None:
+            self.nu_precision = classtune.tuned_precision(pre_params, self.m_nu, maxk, redshifts=[self.redshift, self.redend], target=self.nu_acc_target, nu_target=self.nu_acc_nu_target, nu_acc=self.nu_acc)
+            pre_params.update(self.nu_precision)
 
         #At which redshifts should we produce CAMB output: we want the start and end redshifts of the simulation,
         #but we also want some other values for checking purposes
@@ -170,20 +212,40 @@ class SimulationICs(object):
             os.mkdir(camb_outdir)
         except FileExistsError:
             pass
-        #Save directory
-        #Get and save the transfer functions
+        #Get the transfer functions at every redshift and save them, keyed by exact redshift.
+        #Only the IC redshift is saved as text files, as this is all MP-GenIC needs.
+        #The text file names use a formatted redshift which can collide for nearby redshifts.
+        zz_done = []
+        transfers = []
+        pks = []
         for zz in camb_zz:
+            if zz in zz_done:
+                continue
             trans = powspec.get_transfer(z=zz)
             #fp-roundoff
             trans['k'][-1] *= 0.9999
-            transferfile = os.path.join(camb_outdir, "ics_transfer_"+self._camb_zstr(zz)+".dat")
-            save_transfer(trans, transferfile)
             pk_lin = powspec.get_pklin(k=trans['k'], z=zz)
-            pkfile = os.path.join(camb_outdir, "ics_matterpow_"+self._camb_zstr(zz)+".dat")
-            np.savetxt(pkfile, np.vstack([trans['k'], pk_lin]).T)
-
+            zz_done.append(zz)
+            transfers.append(np.array([trans[name] for name in trans.dtype.names]).T)
+            pks.append(pk_lin)
+            if zz == self.redshift:
+                (trans_table, pk_table) = (transfers[-1], pk_lin)
+                #Optionally thin the k grid, to make the tables faster to read and interpolate.
+                if self.kgrid_tol is not None:
+                    (trans_table, pk_table, kgrid_error) = kgrid.thin_class_tables(trans_table, pk_table, self.kgrid_tol)
+                    self.kgrid_error = float(kgrid_error)
+                    self.kgrid_nodes = (np.size(pk_table), np.size(pk_lin))
+                transferfile = os.path.join(camb_outdir, "ics_transfer_"+self._camb_zstr(zz)+".dat")
+                save_transfer(trans_table, transferfile)
+                pkfile = os.path.join(camb_outdir, "ics_matterpow_"+self._camb_zstr(zz)+".dat")
+                np.savetxt(pkfile, np.vstack([trans_table[:,0], pk_table]).T)
+        lineartheory.save_linear_theory(os.path.join(camb_outdir, self.linear_theory_file), zz_done, transfers, pks, columns=trans.dtype.names)
         return camb_output
 
+    def linear_theory(self, camb_output="camb_linear/"):
+        """Get the saved CLASS linear theory for this simulation, which can be looked up by exact redshift."""
+        return lineartheory.LinearTheory(os.path.join(self.outdir, camb_output, self.linear_theory_file))
+
     def _camb_zstr(self,zz):
         """Get the formatted redshift for CAMB output files."""
         if zz > 10:
@@ -192,16 +254,12 @@ class SimulationICs(object):
             zstr = '%.1g' % zz
         return zstr
 
-    def genicfile(self, camb_output):
-        """Generate the GenIC parameter file"""
-        config = configobj.ConfigObj(self.genicdefault)
-        config.filename = os.path.join(self.outdir, self.genicout)
+    def _genic_params(self, camb_output):
+        """Compute the GenIC parameters, without writing anything.
+        Returns the path to the ICs and a dictionary of parameters which override the defaults in genicdefault."""
+        config = {}
         config['BoxSize'] = self.box*1000
         genicout = "ICS"
-        try:
-            os.mkdir(os.path.join(self.outdir, genicout))
-        except FileExistsError:
-            pass
         config['OutputDir'] = genicout
         #Is this enough information, or should I add a short hash?
         genicfile = str(self.box)+"_"+str(self.npart)+"_"+str(self.redshift)
@@ -227,19 +285,34 @@ class SimulationICs(object):
         zstr = self._camb_zstr(self.redshift)
         config['FileWithInputSpectrum'] = camb_output + "ics_matterpow_"+zstr+".dat"
         config['FileWithTransferFunction'] = camb_output + "ics_transfer_"+zstr+".dat"
-        numass = get_neutrino_masses(self.m_nu, self.nu_hierarchy)
+        numass = self._neutrino_masses()
         config['MNue'] = numass[2]
         config['MNum'] = numass[1]
         config['MNut'] = numass[0]
-        assert config['WhichSpectrum'] == '2'
-        assert config['RadiationOn'] == '1'
-        assert config['DifferentTransferFunctions'] == '1'
-        assert config['InputPowerRedshift'] == '-1'
         config['Seed'] = self.seed
         config = self._genicfile_child_options(config)
         config.update(self._cluster.cluster_runtime())
-        config.write()
-        return (os.path.join(genicout, genicfile), config.filename)
+        return (os.path.join(genicout, genicfile), config)
+
+    def _genic_template(self):
+        """Get the (cached) template for the GenIC parameter file.
+        The default file must ask for tabulated CLASS power spectra and transfer functions at the IC redshift."""
+        required = {'WhichSpectrum': 2, 'RadiationOn': 1, 'DifferentTransferFunctions': 1, 'InputPowerRedshift': -1}
+        return paramfile.load_template(self.genicdefault, required=required)
+
+    def genicfile(self, camb_output):
+        """Generate the GenIC parameter file"""
+        (genicout, change) = self._write_genicfile(camb_output)
+        return (genicout, change.filename)
+
+    def _write_genicfile(self, camb_output):
+        """Write the GenIC parameter file if it changed. Returns the path to the ICs and a ParamChange."""
+        (genicout, config) = self._genic_params(camb_output)
+        icdir = os.path.join(self.outdir, os.path.dirname(genicout))
+        if not os.path.isdir(icdir):
+            os.mkdir(icdir)
+        filename = os.path.join(self.outdir, self.genicout)
+        return (genicout, self._genic_template().write(filename, config))
 
     def _alter_power(self, camb_output):
         """Function to hook if you want to change the CAMB output power spectrum.
@@ -249,6 +322,11 @@ class SimulationICs(object):
         os.stat(camb_file)
         return
 
+    def _neutrino_masses(self):
+        """The three neutrino masses for this simulation.
+        These are needed by CLASS, GenIC and MP-Gadget, so are memoised and computed once."""
+        return _cached_neutrino_masses(self.m_nu, self.nu_hierarchy)
+
     def _genicfile_child_options(self, config):
         """Set extra parameters in child classes"""
         return config
@@ -262,7 +340,14 @@ class SimulationICs(object):
             #Some crazy nonsense to convert the module, name
             #string tuple we stored back into a python type.
             mod = importlib.import_module(self.__dict__[arr][0])
-            self.__dict__[arr] = getattr(mod, self.__dict__[arr][1])
+            name = self.__dict__[arr][1]
+            #Cluster profiles are stored with their spec, as they may come from a file only loaded where the suite was made.
+            if not hasattr(mod, name) and len(self.__dict__[arr]) == 3:
+                self.__dict__[arr] = clusters.register_profile(name, self.__dict__[arr][2])
+            elif not hasattr(mod, name):
+                raise AttributeError("Cannot find "+name+" in "+mod.__name__+": if it is a cluster profile, list its file in $SIMRUNNER_CLUSTER_PROFILES")
+            else:
+                self.__dict__[arr] = getattr(mod, name)
         self._really_types = []
 
     def txt_description(self):
@@ -281,6 +366,8 @@ class SimulationICs(object):
             #Convert types to string tuples
             if isinstance(val, type):
                 self.__dict__[nn] = (val.__module__, val.__name__)
+                if issubclass(val, clusters.ProfileClusterClass) and val.profile is not None:
+                    self.__dict__[nn] += (clusters.PROFILES[val.profile],)
                 self._really_types.append(nn)
         with open(os.path.join(self.outdir, "SimulationICs.json"), 'w') as jsout:
             json.dump(self.__dict__,jsout)
@@ -299,36 +386,35 @@ class SimulationICs(object):
     def gadget3config(self, prefix="OPT += -D"):
         """Generate a config Options file for Yu Feng's MP-Gadget.
         This code is configured via runtime options."""
+        return self._write_gadget3config(prefix=prefix).filename
+
+    def _write_gadget3config(self, prefix="OPT += -D"):
+        """Write the Options file if it changed, so that an unchanged configuration does not trigger a rebuild.
+        Returns a ParamChange."""
         g_config_filename = os.path.join(self.outdir, self.gadgetconfig)
-        with open(g_config_filename,'w') as config:
-            config.write("MPICC = mpicc\nMPICXX = mpic++\n")
-            optimize = self._cluster.cluster_optimize()
-            config.write("OPTIMIZE = "+optimize+"\n")
-            config.write("GSL_INCL = $(shell gsl-config --cflags)\nGSL_LIBS = $(shell gsl-config --libs)\n")
-            self._cluster.cluster_config_options(config, prefix)
-            self._gadget3_child_options(config, prefix)
-        return g_config_filename
+        config = io.StringIO()
+        config.write("MPICC = mpicc\nMPICXX = mpic++\n")
+        optimize = self._cluster.cluster_optimize()
+        config.write("OPTIMIZE = "+optimize+"\n")
+        config.write("GSL_INCL = $(shell gsl-config --cflags)\nGSL_LIBS = $(shell gsl-config --libs)\n")
+        self._cluster.cluster_config_options(config, prefix)
+        self._gadget3_child_options(config, prefix)
+        return paramfile.write_if_changed(g_config_filename, config.getvalue(), params=False)
 
     def _gadget3_child_options(self, _, __):
         """Gadget-3 compilation options for Config.sh which should be written by the child class
         This is MP-Gadget, so it is likely there are none."""
         return
 
-    def gadget3params(self, genicfileout):
-        """MP-Gadget parameter file. This *is* a configobj.
+    def _gadget3_params(self, genicfileout):
+        """Compute the MP-Gadget parameters, without writing anything.
         Note MP-Gadget supprts default arguments, so no need for a defaults file.
         Arguments:
             genicfileout - where the ICs are saved
         """
-        config = configobj.ConfigObj()
-        filename = os.path.join(self.outdir, self.gadgetparam)
-        config.filename = filename
+        config = {}
         config['InitCondFile'] = genicfileout
         config['OutputDir'] = "output"
-        try:
-            os.mkdir(os.path.join(self.outdir, "output"))
-        except FileExistsError:
-            pass
         config['TimeLimitCPU'] = int(60*60*self._cluster.timelimit-300)
         config['TimeMax'] = 1./(1+self.redend)
         config['Omega0'] = self.omega0
@@ -343,7 +429,7 @@ class SimulationICs(object):
             config['MassiveNuLinRespOn'] = 1
         else:
             config['MassiveNuLinRespOn'] = 0
-        numass = get_neutrino_masses(self.m_nu, self.nu_hierarchy)
+        numass = self._neutrino_masses()
         config['MNue'] = numass[2]
         config['MNum'] = numass[1]
         config['MNut'] = numass[0]
@@ -364,8 +450,6 @@ class SimulationICs(object):
         if self.separate_gas:
             config['CoolingOn'] = 1
             config['TreeCoolFile'] = "TREECOOL"
-            #Copy a TREECOOL file into the right place.
-            self._copy_uvb()
             config = self._sfr_params(config)
             config = self._feedback_params(config)
         else:
@@ -374,9 +458,36 @@ class SimulationICs(object):
         #Add other config parameters
         config = self._other_params(config)
         config.update(self._cluster.cluster_runtime())
-        config.write()
+        return config
+
+    def gadget3params(self, genicfileout):
+        """MP-Gadget parameter file. This is readable by configobj.
+        Arguments:
+            genicfileout - where the ICs are saved
+        """
+        self._write_gadget3params(genicfileout)
         return
 
+    def _write_gadget3params(self, genicfileout):
+        """Write the MP-Gadget parameter file if it changed. Returns a ParamChange."""
+        config = self._gadget3_params(genicfileout)
+        outputdir = os.path.join(self.outdir, config['OutputDir'])
+        if not os.path.isdir(outputdir):
+            os.mkdir(outputdir)
+        if self.separate_gas:
+            #Copy a TREECOOL file into the right place.
+            self._copy_uvb()
+        return paramfile.load_template(None).write(os.path.join(self.outdir, self.gadgetparam), config)
+
+    def regenerate_params(self, camb_output="camb_linear/"):
+        """Regenerate the GenIC and MP-Gadget parameter files and the MP-Gadget Options file
+        for an existing simulation, without re-running CLASS.
+        Files are only rewritten if their contents changed.
+        Returns a dictionary of ParamChange, keyed by file name."""
+        (genic_output, genic_change) = self._write_genicfile(camb_output)
+        changes = [genic_change, self._write_gadget3config(), self._write_gadget3params(genic_output)]
+        return {change.filename : change for change in changes}
+
     def _sfr_params(self, config):
         """Config parameters for the default Springel & Hernquist star formation model"""
         config['StarformationOn'] = 1
@@ -403,72 +514,111 @@ class SimulationICs(object):
     def _copy_uvb(self):
         """The UVB amplitude for Gadget is specified in a file named TREECOOL in the same directory as the gadget binary."""
         fuvb = read_uvb_tab.get_uvb_filename(self.uvb)
-        shutil.copy(fuvb, os.path.join(self.outdir,"TREECOOL"))
+        treecool = os.path.join(self.outdir,"TREECOOL")
+        #Do not touch an identical existing copy
+        if os.path.exists(treecool) and filecmp.cmp(fuvb, treecool, shallow=False):
+            return
+        shutil.copy(fuvb, treecool)
 
     def do_gadget_build(self, gadget_config):
-        """Make a gadget build and check it succeeded."""
-        conffile = os.path.join(self.gadget_dir, self.gadgetconfig)
-        if os.path.islink(conffile):
-            os.remove(conffile)
-        if os.path.exists(conffile):
-            os.rename(conffile, conffile+".backup")
-        os.symlink(gadget_config, conffile)
-        #Build gadget
-        gadget_binary = os.path.join(os.path.join(self.gadget_dir, "gadget"), self.gadgetexe)
-        try:
-            g_mtime = os.stat(gadget_binary).st_mtime
-        except FileNotFoundError:
-            g_mtime = -1
-        self.gadget_git = utils.get_git_hash(gadget_binary)
-        try:
-            self.make_output = subprocess.check_output(["make", "-j"], cwd=self.gadget_dir, universal_newlines=True, stderr=subprocess.STDOUT, shell=True)
-        except subprocess.CalledProcessError as e:
-            print(e.output)
-            raise
-        #Check that the last-changed time of the binary has actually changed..
-        assert g_mtime != os.stat(gadget_binary).st_mtime
+        """Make a gadget build and check it succeeded.
+        The build is done in a private copy of gadget_dir and cached, so concurrent builds are safe
+        and identical configurations are only compiled once."""
+        (artifact, make_output) = build.gadget_build(self.gadget_dir, gadget_config, self._cluster.cluster_optimize())
+        self.gadget_git = utils.get_git_hash(self.gadget_dir)
+        self.make_output = make_output if make_output is not None else "Cached build: "+artifact
+        gadget_binary = os.path.join(artifact, build.GADGET_BINARIES[0])
         shutil.copy(gadget_binary, os.path.join(os.path.dirname(gadget_config),self.gadgetexe))
 
     def generate_mpi_submit(self, genicout):
         """Generate a sample mpi_submit file.
         The prefix argument is a string at the start of each line.
         It separates queueing system directives from normal comments"""
-        self._cluster.generate_mpi_submit(self.outdir)
+        self._cluster.generate_mpi_submit(self.outdir, npart=self.npart, separate_gas=self.separate_gas)
         #Generate an mpi_submit for genic
-        zstr = self._camb_zstr(self.redshift)
-        check_ics = "python cambpower.py "+genicout+" --czstr "+zstr+" --mnu "+str(self.m_nu)
-        self._cluster.generate_mpi_submit_genic(self.outdir, extracommand=check_ics)
+        self._cluster.generate_mpi_submit_genic(self.outdir, extracommand=self.check_ics_command(genicout))
         #Copy the power spectrum routine
         shutil.copy(os.path.join(os.path.dirname(__file__),"cambpower.py"), os.path.join(self.outdir,"cambpower.py"))
 
-    def make_simulation(self, pkaccuracy=0.05, do_build=False):
-        """Wrapper function to make the simulation ICs."""
+    def check_ics_command(self, genicout):
+        """Shell command, run in the simulation directory, which checks the power spectrum of the ICs."""
+        zstr = self._camb_zstr(self.redshift)
+        check_ics = "python cambpower.py "+genicout+" --czstr "+zstr+" --mnu "+str(self.m_nu)
+        if self.headless_ic_check:
+            check_ics += " --headless"
+        return check_ics
+
+    def make_simulation(self, pkaccuracy=0.05, do_build=False, timing_callback=None):
+        """Wrapper function to make the simulation ICs.
+        The time and resources used by each stage are appended to timings.jsonl in the output directory,
+        and passed to timing_callback if it is not None."""
+        import classylss
+        timer = instrument.StageTimer(self.outdir, callback=timing_callback)
         #First generate the input files for CAMB
-        camb_output = self.cambfile()
+        with timer.stage("class"):
+            camb_output = self.cambfile()
         #Then run CAMB
         self.camb_git = classylss.__version__
         #Change the power spectrum file on disc if we want to do that
-        self._alter_power(os.path.join(self.outdir,camb_output))
+        with timer.stage("alter_power"):
+            self._alter_power(os.path.join(self.outdir,camb_output))
         #Now generate the GenIC parameters
-        (genic_output, genic_param) = self.genicfile(camb_output)
+        with timer.stage("genic_params"):
+            (genic_output, genic_param) = self.genicfile(camb_output)
         #Save a json of ourselves.
         self.txt_description()
         #Check that the ICs have the right power spectrum
         #Generate Gadget makefile
-        gadget_config = self.gadget3config()
-        #Symlink the new gadget config to the source directory
-        #Generate Gadget parameter file
-        self.gadget3params(genic_output)
-        #Generate mpi_submit file
-        self.generate_mpi_submit(genic_output)
+        with timer.stage("gadget_params"):
+            gadget_config = self.gadget3config()
+            #Symlink the new gadget config to the source directory
+            #Generate Gadget parameter file
+            self.gadget3params(genic_output)
+            #Generate mpi_submit file
+            self.generate_mpi_submit(genic_output)
         #Run MP-GenIC
         if do_build:
-            subprocess.check_call([os.path.join(os.path.join(self.gadget_dir, "genic"),self.genicexe), genic_param],cwd=self.outdir)
+            from . import cambpower
+            with timer.stage("genic"):
+                subprocess.check_call([os.path.join(os.path.join(self.gadget_dir, "genic"),self.genicexe), genic_param],cwd=self.outdir)
             zstr = self._camb_zstr(self.redshift)
-            cambpower.check_ic_power_spectra(genic_output, camb_zstr=zstr, m_nu=self.m_nu, outdir=self.outdir, accuracy=pkaccuracy)
-            self.do_gadget_build(gadget_config)
+            with timer.stage("ic_check"):
+                cambpower.check_ic_power_spectra(genic_output, camb_zstr=zstr, m_nu=self.m_nu, outdir=self.outdir, accuracy=pkaccuracy, headless=self.headless_ic_check)
+            with timer.stage("gadget_build"):
+                self.do_gadget_build(gadget_config)
         return gadget_config
 
+def generate_genic_batch(sims, batchdir, packs=1, per_sim=0.25, camb_output="camb_linear/"):
+    """Write one job, batchdir/mpi_submit_genic_batch, which makes and checks the ICs of many simulations,
+    rather than one short job per simulation. The simulations must already have their GenIC parameter files
+    (from make_simulation), and use the same cluster class, that of the first simulation.
+    packs simulations are run at once. Results are recorded in batchdir/genic_batch_status,
+    which can be read with remake.genic_batch_status."""
+    simulations = []
+    for sim in sims:
+        (genicout, _) = sim._genic_params(camb_output)
+        shutil.copy(os.path.join(os.path.dirname(__file__),"cambpower.py"), os.path.join(sim.outdir,"cambpower.py"))
+        simulations.append((sim.outdir, sim.check_ics_command(genicout)))
+    os.makedirs(batchdir, exist_ok=True)
+    sims[0]._cluster.generate_mpi_submit_genic_batch(batchdir, simulations, packs=packs, per_sim=per_sim)
+    return os.path.join(batchdir, "mpi_submit_genic_batch")
+
+def render_genicfiles(sims, camb_output="camb_linear/"):
+    """Render the GenIC parameter files for many simulations in one call, without writing them.
+    Each default file is parsed and validated only once.
+    Returns a list of parameter file contents, one for each simulation."""
+    return [sim._genic_template().render(sim._genic_params(camb_output)[1]) for sim in sims]
+
+def render_gadget3params(sims, genicfileouts):
+    """Render the MP-Gadget parameter files for many simulations in one call, without writing them."""
+    template = paramfile.load_template(None)
+    return template.render_batch([sim._gadget3_params(gg) for (sim, gg) in zip(sims, genicfileouts)])
+
+def regenerate_suite(sims, camb_output="camb_linear/"):
+    """Regenerate the parameter files for every simulation in a suite, rewriting only those which changed.
+    Returns a dictionary, keyed by simulation directory, of dictionaries of ParamChange keyed by file name."""
+    return {sim.outdir : sim.regenerate_params(camb_output) for sim in sims}
+
 def save_transfer(transfer, transferfile):
     """Save a transfer function. Note we save the CLASS FORMATTED transfer functions.
     The transfer functions differ from CAMB by:
@@ -486,32 +636,54 @@ t_tot stands for (sum_i [rho_i+p_i] theta_i)/(sum_i [rho_i+p_i]))(k,z)
 
 def get_neutrino_masses(total_mass, hierarchy):
     """Get the three neutrino masses, including the mass splittings.
-        Hierarchy is 'inverted' (two heavy), 'normal' (two light) or degenerate."""
+        Hierarchy is 'inverted' (two heavy), 'normal' (two light) or degenerate.
+        total_mass may be a scalar or an array of total masses, and hierarchy
+        a single string or an array of strings, one per mass.
+        Returns an array of shape (3,) for scalar inputs and (N, 3) for arrays."""
     #Neutrino mass splittings
     nu_M21 = 7.53e-5 #Particle data group 2016: +- 0.18e-5 eV2
     nu_M32n = 2.44e-3 #Particle data group: +- 0.06e-3 eV2
     nu_M32i = 2.51e-3 #Particle data group: +- 0.06e-3 eV2
 
-    if hierarchy == 'normal':
-        nu_M32 = nu_M32n
-        #If the total mass is below that allowed by the hierarchy,
-        #assign one active neutrino.
-        if total_mass < np.sqrt(nu_M32n) + np.sqrt(nu_M21):
-            return np.array([total_mass, 0, 0])
-    elif hierarchy == 'inverted':
-        nu_M32 = -nu_M32i
-        if total_mass < 2*np.sqrt(nu_M32i) - np.sqrt(nu_M21):
-            return np.array([total_mass/2., total_mass/2., 0])
-    #Hierarchy == 0 is 3 degenerate neutrinos
-    else:
-        return np.ones(3)*total_mass/3.
-
-    #DD is the summed masses of the two closest neutrinos
-    DD1 = 4 * total_mass/3. - 2/3.*np.sqrt(total_mass**2 + 3*nu_M32 + 1.5*nu_M21)
-    #Last term was neglected initially. This should be very well converged.
-    DD = 4 * total_mass/3. - 2/3.*np.sqrt(total_mass**2 + 3*nu_M32 + 1.5*nu_M21+0.75*nu_M21**2/DD1**2)
-    nu_masses = np.array([ total_mass - DD, 0.5*(DD + nu_M21/DD), 0.5*(DD - nu_M21/DD)])
-    assert np.isfinite(DD)
-    assert np.abs(DD1/DD -1) < 2e-2
-    assert np.all(nu_masses >= 0)
+    scalar = np.ndim(total_mass) == 0 and np.ndim(hierarchy) == 0
+    (total_mass, hierarchy) = np.broadcast_arrays(np.atleast_1d(np.asarray(total_mass, dtype=np.float64)), np.atleast_1d(hierarchy))
+    normal = hierarchy == 'normal'
+    inverted = hierarchy == 'inverted'
+    nu_masses = np.empty((np.size(total_mass), 3))
+    #Anything else is 3 degenerate neutrinos
+    degen = ~(normal | inverted)
+    nu_masses[degen] = total_mass[degen, np.newaxis]/3.
+    #If the total mass is below that allowed by the hierarchy,
+    #assign one active neutrino (normal) or two (inverted).
+    light = normal * (total_mass < np.sqrt(nu_M32n) + np.sqrt(nu_M21))
+    nu_masses[light] = 0
+    nu_masses[light, 0] = total_mass[light]
+    light_inv = inverted * (total_mass < 2*np.sqrt(nu_M32i) - np.sqrt(nu_M21))
+    nu_masses[light_inv] = 0
+    nu_masses[light_inv, 0] = total_mass[light_inv]/2.
+    nu_masses[light_inv, 1] = total_mass[light_inv]/2.
+    split = (normal | inverted) * ~light * ~light_inv
+    if np.any(split):
+        mass = total_mass[split]
+        nu_M32 = np.where(normal[split], nu_M32n, -nu_M32i)
+        #float_power calls pow() like the scalar x**2, rather than x*x as the array x**2 does.
+        #This keeps the results bit-for-bit identical to evaluating one mass at a time.
+        mass2 = np.float_power(mass, 2)
+        #DD is the summed masses of the two closest neutrinos
+        DD1 = 4 * mass/3. - 2/3.*np.sqrt(mass2 + 3*nu_M32 + 1.5*nu_M21)
+        #Last term was neglected initially. This should be very well converged.
+        DD = 4 * mass/3. - 2/3.*np.sqrt(mass2 + 3*nu_M32 + 1.5*nu_M21+0.75*nu_M21**2/np.float_power(DD1, 2))
+        nu_masses[split] = np.array([ mass - DD, 0.5*(DD + nu_M21/DD), 0.5*(DD - nu_M21/DD)]).T
+        assert np.all(np.isfinite(DD))
+        assert np.all(np.abs(DD1/DD -1) < 2e-2)
+        assert np.all(nu_masses[split] >= 0)
+    if scalar:
+        return nu_masses[0]
+    return nu_masses
+
+@functools.lru_cache(maxsize=None)
+def _cached_neutrino_masses(total_mass, hierarchy):
+    """Memoised neutrino masses for a single simulation. The returned array is read-only."""
+    nu_masses = get_neutrino_masses(total_mass, hierarchy)
+    nu_masses.setflags(write=False)
     return nu_masses
@@ -0,0 +1,149 @@
+"""Module for a persistent record of the state of every simulation in a suite.
+
+The functions in remake rediscover the suite with a glob on every call and keep no history.
+This stores, in an SQLite database in the run directory, each simulation's parameters
+(from SimulationICs.json), its stage, the last redshift it reached, the jobs submitted for it
+and how many attempts each stage has taken. The redshifts come from the incremental snapshot
+catalogue, so refreshing a large suite only looks at the runs which changed.
+
+The database uses write-ahead logging and takes the write lock at the start of each update,
+so several tools (eg, a status check and a resubmission) can use it at once."""
+import contextlib
+import json
+import os
+import os.path
+import sqlite3
+import time
+from . import catalogue
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sims (name TEXT PRIMARY KEY, outdir TEXT, params TEXT, stage TEXT,
+    redshift REAL, has_ics INTEGER, attempts INTEGER, updated REAL);
+CREATE INDEX IF NOT EXISTS sims_stage ON sims (stage);
+CREATE INDEX IF NOT EXISTS sims_redshift ON sims (redshift);
+CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, sim TEXT, stage TEXT, jobid TEXT,
+    script TEXT, submitted REAL);
+CREATE INDEX IF NOT EXISTS jobs_sim ON jobs (sim, stage);
+"""
+
+class SuiteState(object):
+    """State of the simulations in a run directory.
+    The stage of a simulation is one of 'created', 'ics', 'running' or 'complete'.
+
+    Init parameters:
+    rundir - directory containing the simulations, one per subdirectory.
+    dbfile - SQLite database file. By default, .suite_state.sqlite in rundir.
+    endz - redshift at which a simulation is complete.
+    """
+    def __init__(self, rundir, dbfile=None, endz=2.01):
+        self.rundir = os.path.realpath(os.path.expanduser(rundir))
+        if dbfile is None:
+            dbfile = os.path.join(self.rundir, ".suite_state.sqlite")
+        self.dbfile = dbfile
+        self.endz = endz
+        #Autocommit mode, so that transactions are started explicitly with BEGIN IMMEDIATE.
+        self._db = sqlite3.connect(dbfile, timeout=60, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._catalogue = None
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+        if self._catalogue is not None:
+            self._catalogue.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """A write transaction, which takes the database lock at the start, so read-modify-write is safe."""
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def register(self, outdir):
+        """Add a simulation directory to the suite, with the parameters in its SimulationICs.json if there is one."""
+        outdir = os.path.realpath(outdir)
+        try:
+            with open(os.path.join(outdir, "SimulationICs.json"), 'r') as jsin:
+                params = jsin.read()
+        except FileNotFoundError:
+            params = None
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO sims VALUES (?, ?, ?, 'created', 1100, 0, 0, ?)", (os.path.basename(outdir), outdir, params, time.time()))
+            db.execute("UPDATE sims SET params = ? WHERE name = ? AND params IS NULL", (params, os.path.basename(outdir)))
+
+    def refresh(self):
+        """Find new simulations and update the redshift and stage of every simulation from the snapshot catalogue.
+        Only directories which changed since the last refresh are looked at."""
+        known = set(self.names())
+        for entry in os.scandir(self.rundir):
+            if entry.is_dir() and not entry.name.startswith(".") and entry.name not in known:
+                self.register(entry.path)
+        if self._catalogue is None:
+            self._catalogue = catalogue.Catalogue(self.rundir)
+        self._catalogue.update()
+        latest = self._catalogue.latest("PART")
+        ics = self._catalogue.latest("ICS")
+        with self._transaction() as db:
+            for row in db.execute("SELECT name, redshift, has_ics, stage FROM sims").fetchall():
+                redshift = row["redshift"]
+                if row["name"] in latest and latest[row["name"]]["redshift"] is not None:
+                    redshift = latest[row["name"]]["redshift"]
+                has_ics = int(row["name"] in ics)
+                stage = row["stage"]
+                if redshift <= self.endz:
+                    stage = "complete"
+                elif row["name"] in latest:
+                    stage = "running"
+                elif has_ics:
+                    stage = "ics"
+                if (redshift, has_ics, stage) != (row["redshift"], row["has_ics"], row["stage"]):
+                    db.execute("UPDATE sims SET redshift = ?, has_ics = ?, stage = ?, updated = ? WHERE name = ?", (redshift, has_ics, stage, time.time(), row["name"]))
+
+    def record_submission(self, name, stage, jobid, script):
+        """Record that a job was submitted for a simulation, and count the attempt."""
+        with self._transaction() as db:
+            db.execute("INSERT INTO jobs (sim, stage, jobid, script, submitted) VALUES (?, ?, ?, ?, ?)", (name, stage, jobid, script, time.time()))
+            db.execute("UPDATE sims SET attempts = attempts + 1, updated = ? WHERE name = ?", (time.time(), name))
+
+    def names(self):
+        """Names of all the simulations in the suite."""
+        return [row["name"] for row in self._db.execute("SELECT name FROM sims ORDER BY name")]
+
+    def get(self, name):
+        """The state of one simulation as a dictionary, with its parameters decoded."""
+        row = self._db.execute("SELECT * FROM sims WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        row = dict(row)
+        if row["params"] is not None:
+            row["params"] = json.loads(row["params"])
+        return row
+
+    def status(self, stage=None):
+        """(outdir, stage, redshift, attempts) for every simulation, or those in one stage, sorted by name."""
+        query = "SELECT outdir, stage, redshift, attempts FROM sims"
+        args = ()
+        if stage is not None:
+            query += " WHERE stage = ?"
+            args = (stage,)
+        return [tuple(row) for row in self._db.execute(query+" ORDER BY name", args)]
+
+    def incomplete(self, endz=None):
+        """Output directories of simulations which have not reached endz (by default, the suite end redshift)."""
+        if endz is None:
+            endz = self.endz
+        return [row["outdir"] for row in self._db.execute("SELECT outdir FROM sims WHERE redshift > ? ORDER BY name", (endz,))]
+
+    def without_ics(self):
+        """Output directories of simulations which have no ICs."""
+        return [row["outdir"] for row in self._db.execute("SELECT outdir FROM sims WHERE has_ics = 0 ORDER BY name")]
+
+    def jobs(self, name):
+        """(stage, job id, script, submission time) for every job submitted for a simulation, oldest first."""
+        return [tuple(row) for row in self._db.execute("SELECT stage, jobid, script, submitted FROM jobs WHERE sim = ? ORDER BY id", (name,))]
@@ -0,0 +1,202 @@
+"""Module for a fast surrogate of the linear theory, trained on the CLASS output of existing simulations.
+
+Running CLASS for every point of a proposed emulator design is slow. Here we fit the log of the
+ratio of the linear power spectrum to that of a fiducial cosmology with a quadratic polynomial in the
+cosmological parameters, using the linear theory stores saved by SimulationICs.cambfile.
+Predicting P(k), sigma_8 and the growth function is then a matrix multiply, fast for thousands of points.
+
+The error is estimated from the leave-one-out residuals of the fit, inflated by the distance
+of the query point from the training set. Points with an estimated error above a tolerance can be
+solved with CLASS and added to the training set."""
+import json
+import os.path
+import shutil
+import tempfile
+import numpy as np
+from . import lineartheory
+
+#Cosmological parameters the surrogate depends on, in the order used for parameter arrays.
+PARAMS = ("ns", "scalar_amp", "omega0", "omegab", "hubble", "m_nu")
+
+def _param_array(params):
+    """Convert a dictionary of parameter values (or arrays of values) to an array of shape (npoints, nparams),
+    in the order of PARAMS. Arrays are passed through."""
+    if isinstance(params, dict):
+        params = np.column_stack([np.ravel(params[pp]) for pp in PARAMS])
+    return np.atleast_2d(np.asarray(params, dtype=np.float64))
+
+def _features(xx, degree):
+    """Polynomial features of scaled parameters: constant, linear and (if degree == 2) all quadratic terms."""
+    npts, npar = np.shape(xx)
+    feats = [np.ones(npts), ] + [xx[:, i] for i in range(npar)]
+    if degree == 2:
+        feats += [xx[:, i]*xx[:, j] for i in range(npar) for j in range(i, npar)]
+    return np.column_stack(feats)
+
+def load_simulation(simdir, redshifts, camb_output="camb_linear/"):
+    """Load the parameters and the linear theory of a simulation made by SimulationICs.
+    Returns (parameter array, k, power spectra at the requested redshifts with shape (nz, nk))."""
+    with open(os.path.join(simdir, "SimulationICs.json"), 'r') as jsin:
+        desc = json.load(jsin)
+    store = lineartheory.LinearTheory(os.path.join(simdir, camb_output, desc.get("linear_theory_file", "linear_theory.npz")))
+    kk = store.get_pklin(redshifts[0])[0]
+    pks = np.array([store.get_pklin(zz)[1] for zz in redshifts])
+    return np.array([desc[pp] for pp in PARAMS], dtype=np.float64), np.array(kk), pks
+
+def from_simulations(simdirs, redshifts=None, nk=200, camb_output="camb_linear/", degree=2):
+    """Build a surrogate from the linear theory of a set of simulations.
+    If redshifts is None, use every redshift which is in all the linear theory stores.
+    The power spectra are interpolated to nk log-spaced k values covered by every simulation."""
+    if redshifts is None:
+        stores = [lineartheory.LinearTheory(os.path.join(sd, camb_output, "linear_theory.npz")) for sd in simdirs]
+        redshifts = stores[0].redshifts
+        for store in stores[1:]:
+            redshifts = redshifts[np.isin(redshifts, store.redshifts)]
+        redshifts = np.sort(redshifts)
+    sims = [load_simulation(sd, redshifts, camb_output=camb_output) for sd in simdirs]
+    kmin = np.max([np.min(ss[1]) for ss in sims])
+    kmax = np.min([np.max(ss[1]) for ss in sims])
+    kk = np.logspace(np.log10(kmin), np.log10(kmax), nk)
+    params = np.array([ss[0] for ss in sims])
+    pks = np.array([[np.exp(np.interp(np.log(kk), np.log(ss[1]), np.log(pk))) for pk in ss[2]] for ss in sims])
+    return LinearSurrogate(params, redshifts, kk, pks, degree=degree)
+
+def class_solve(params, redshifts, kk):
+    """Compute the linear power spectrum with CLASS, using the same settings as SimulationICs.cambfile.
+    Arguments are a dictionary of parameters, the redshifts and the k values.
+    Returns the power spectra, shape (nz, nk)."""
+    import classylss.binding as CLASS
+    from . import simulationics
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sim = simulationics.SimulationICs(outdir=tmpdir, box=100, npart=128, **params)
+        pre_params = sim._class_params()
+        pre_params['P_k_max_h/Mpc'] = 1.01*np.max(kk)
+        pre_params['z_max_pk'] = np.max(redshifts)+1
+        powspec = CLASS.Spectra(CLASS.ClassEngine(pre_params))
+        return np.array([powspec.get_pklin(k=kk, z=zz) for zz in redshifts])
+    finally:
+        shutil.rmtree(tmpdir)
+
+class LinearSurrogate(object):
+    """Quadratic fit of the log ratio of the linear power spectrum to a fiducial cosmology.
+
+    Init parameters:
+    params - array of training parameters, shape (npoints, nparams), in the order of PARAMS.
+    redshifts - redshifts of the power spectra.
+    kk - k values of the power spectra, in h/Mpc.
+    pks - training power spectra, shape (npoints, nz, nk).
+    degree - degree of the polynomial. If there are too few points for a quadratic, a linear fit is used.
+    """
+    def __init__(self, params, redshifts, kk, pks, degree=2):
+        self.redshifts = np.asarray(redshifts, dtype=np.float64)
+        self.kk = np.asarray(kk, dtype=np.float64)
+        self.degree = degree
+        self.params = _param_array(params)
+        self.logpk = np.log(np.reshape(pks, (np.shape(self.params)[0], -1)))
+        self.fit()
+
+    def _scaled(self, params):
+        """Scale the parameters to order unity around the fiducial cosmology.
+        The power spectrum is linear in log A_s, so we fit in log A_s."""
+        xx = np.array(params)
+        xx[:, 1] = np.log(xx[:, 1])
+        return (xx - self._center)/self._scale
+
+    def fit(self):
+        """Fit the polynomial to the training set, and compute the leave-one-out errors."""
+        npts = np.shape(self.params)[0]
+        xx = np.array(self.params)
+        xx[:, 1] = np.log(xx[:, 1])
+        self._center = np.mean(xx, axis=0)
+        #Parameters which do not vary are not used.
+        self._scale = np.std(xx, axis=0)
+        self._fixed = self._scale == 0
+        self._scale[self._fixed] = np.inf
+        scaled = self._scaled(self.params)
+        #Fiducial cosmology is the training point nearest the centre.
+        self.fiducial = np.argmin(np.sum(scaled**2, axis=1))
+        self._degree = self.degree
+        if self.degree == 2 and npts <= np.shape(_features(scaled[:1], 2))[1]:
+            self._degree = 1
+        feats = _features(scaled, self._degree)
+        ratio = self.logpk - self.logpk[self.fiducial]
+        self._coeffs = np.linalg.lstsq(feats, ratio, rcond=None)[0]
+        #Leave-one-out residuals of a linear least squares fit are the residuals divided by 1 - leverage.
+        hat = feats @ np.linalg.pinv(feats)
+        leverage = np.minimum(np.diag(hat), 1-1e-6)
+        resid = (ratio - feats @ self._coeffs) / (1 - leverage)[:, None]
+        #Maximum relative error in P(k) for each training point, left out.
+        self.loo_error = np.max(np.abs(np.expm1(resid)), axis=1)
+        #Typical spacing of the training points.
+        dist = np.sqrt(np.sum((scaled[:, None, :] - scaled[None, :, :])**2, axis=-1))
+        dist[np.diag_indices(npts)] = np.inf
+        self._spacing = np.median(np.min(dist, axis=1)) if npts > 1 else 1.
+
+    def add_points(self, params, pks):
+        """Add new points to the training set and refit. pks has shape (npoints, nz, nk)."""
+        params = _param_array(params)
+        self.params = np.vstack([self.params, params])
+        self.logpk = np.vstack([self.logpk, np.log(np.reshape(pks, (np.shape(params)[0], -1)))])
+        self.fit()
+
+    def error(self, params):
+        """Estimated maximum relative error in P(k) for each point: the rms leave-one-out error,
+        growing with the distance to the nearest training point in units of the typical spacing.
+        The first term neglected by a quadratic fit is cubic, so the error grows as the cube of the distance.
+        The surrogate knows nothing about parameters which do not vary in the training set,
+        so points with a different value of one of them have an infinite error."""
+        params = _param_array(params)
+        scaled = self._scaled(params)
+        train = self._scaled(self.params)
+        dist = np.sqrt(np.min(np.sum((scaled[:, None, :] - train[None, :, :])**2, axis=-1), axis=1))
+        err = np.sqrt(np.mean(self.loo_error**2)) * (1 + dist / self._spacing)**(self._degree+1)
+        offset = ~np.isclose(params[:, self._fixed], self.params[0, self._fixed], rtol=1e-10, atol=0)
+        err[np.any(offset, axis=1)] = np.inf
+        return err
+
+    def predict_pk(self, params):
+        """Predict the linear power spectrum. Returns k and P(k), shape (npoints, nz, nk)."""
+        feats = _features(self._scaled(_param_array(params)), self._degree)
+        logpk = self.logpk[self.fiducial] + feats @ self._coeffs
+        return self.kk, np.reshape(np.exp(logpk), (-1, np.size(self.redshifts), np.size(self.kk)))
+
+    def sigma8(self, params, pks=None):
+        """Predict sigma_8 at the lowest redshift of the surrogate (usually z=0)."""
+        if pks is None:
+            pks = self.predict_pk(params)[1]
+        pk = pks[:, np.argmin(self.redshifts), :]
+        kr = self.kk * 8.
+        window = 3*(np.sin(kr) - kr*np.cos(kr))/kr**3
+        integrand = pk * self.kk**3 * window**2 / (2*np.pi**2)
+        #Trapezoid rule in log k
+        dlogk = np.diff(np.log(self.kk))
+        return np.sqrt(np.sum(0.5*(integrand[:, 1:] + integrand[:, :-1])*dlogk, axis=-1))
+
+    def growth(self, params, pks=None):
+        """Predict the growth function at every redshift, normalised to one at the lowest redshift,
+        from the power on the largest scale. Returns an array of shape (npoints, nz)."""
+        if pks is None:
+            pks = self.predict_pk(params)[1]
+        return np.sqrt(pks[:, :, 0] / pks[:, np.argmin(self.redshifts), 0][:, None])
+
+    def query(self, params, tol=None, solver=class_solve):
+        """Predict P(k), sigma_8 and growth for a set of points, with the estimated error.
+        If tol is not None, points with an estimated error above tol are computed with solver,
+        which has the signature of class_solve, and added to the training set.
+        Returns a dictionary with keys 'k', 'pk', 'sigma8', 'growth', 'error' and 'solved',
+        a boolean array which is True for points computed with the solver."""
+        params = _param_array(params)
+        err = self.error(params)
+        solved = np.zeros(np.shape(params)[0], dtype=bool)
+        if tol is not None and np.any(err > tol):
+            solved = err > tol
+            new = np.array([solver(dict(zip(PARAMS, pp)), self.redshifts, self.kk) for pp in params[solved]])
+            self.add_points(params[solved], new)
+            err = self.error(params)
+            #The solved points are now in the training set: their error is that of CLASS.
+            err[solved] = 0
+        (kk, pks) = self.predict_pk(params)
+        if np.any(solved):
+            pks[solved] = np.exp(np.reshape(self.logpk[-np.sum(solved):], (-1, np.size(self.redshifts), np.size(kk))))
+        return {'k': kk, 'pk': pks, 'sigma8': self.sigma8(params, pks), 'growth': self.growth(params, pks), 'error': err, 'solved': solved}
@@ -1,13 +1,37 @@
 """Module to store some utility functions."""
-import glob
 import os
 import os.path
 import subprocess
 
+#Cache of git hashes, keyed by repository root.
+#Resolving a hash needs a subprocess, which is slow on shared filesystems,
+#so only do it once per repository per process.
+_GIT_HASHES = {}
+
+def _find_git_root(path):
+    """Find the root of the git repository containing a directory,
+    by walking up the tree looking for a .git entry. Returns None if not in a repository."""
+    cur = path
+    while True:
+        if os.path.exists(os.path.join(cur, ".git")):
+            return cur
+        parent = os.path.dirname(cur)
+        if parent == cur:
+            return None
+        cur = parent
+
 def get_git_hash(path):
-    """Get the git hash of a file."""
+    """Get the git hash of a file. The result is memoised per repository root."""
     rpath = os.path.realpath(path)
     if not os.path.isdir(rpath):
         rpath = os.path.dirname(rpath)
-    commit_hash = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = rpath, universal_newlines=True)
+    root = _find_git_root(rpath)
+    if root is None:
+        root = rpath
+    try:
+        return _GIT_HASHES[root]
+    except KeyError:
+        pass
+    commit_hash = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd = root, universal_newlines=True)
+    _GIT_HASHES[root] = commit_hash
     return commit_hash
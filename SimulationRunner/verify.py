@@ -0,0 +1,193 @@
+"""Module to check that BigFile ICs and snapshots are complete and uncorrupted before a simulation is (re)started from them.
+
+Each block of a BigFile (eg, 1/Position) has a header file listing, for each of its data files,
+the number of rows and the checksum of the data (the sum of all the bytes, modulo 2^32).
+The number of particles of each type is in TotNumPart in the snapshot header. We check that:
+    - every block has a header and every data file it lists exists,
+    - each data file has the size implied by its number of rows and the block data type,
+    - the rows of each particle block add up to TotNumPart for that type,
+    - optionally, the checksum of each data file matches the block header.
+Checksums are computed in parallel worker processes, reading each file in fixed size chunks,
+and stored in an SQLite cache keyed by the file size and modification time, so unchanged files are not read again."""
+import os
+import os.path
+import re
+import sqlite3
+import multiprocessing
+import numpy as np
+from . import catalogue
+
+#Bytes read at once when computing a checksum. This bounds the memory used by each worker.
+CHUNKSIZE = 2**24
+
+def read_block_header(blockdir):
+    """Read the header of a BigFile block. Returns a dictionary with the dtype, nmemb (columns per row)
+    and files, a list of (data file, number of rows, checksum)."""
+    block = {"dtype": None, "nmemb": 1, "files": []}
+    with open(os.path.join(blockdir, "header"), 'r') as fh:
+        for line in fh:
+            match = re.match(r"^([0-9A-Fa-f]{6})\s*:\s*([0-9]+)\s*:\s*([0-9]+)", line)
+            if match is not None:
+                block["files"].append((os.path.join(blockdir, match.group(1)), int(match.group(2)), int(match.group(3))))
+            elif line.startswith("DTYPE:"):
+                block["dtype"] = line.split(":", 1)[1].strip()
+            elif line.startswith("NMEMB:"):
+                block["nmemb"] = int(line.split(":", 1)[1])
+    return block
+
+def file_checksum(fname, chunksize=CHUNKSIZE):
+    """The BigFile (sysv) checksum of a file: the sum of its bytes, modulo 2^32."""
+    total = 0
+    with open(fname, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunksize)
+            if not chunk:
+                break
+            total += int(np.frombuffer(chunk, dtype=np.uint8).sum(dtype=np.uint64))
+    return total % 2**32
+
+def _checksum_task(args):
+    """Worker for the process pool: (fname, chunksize) -> (fname, checksum)."""
+    (fname, chunksize) = args
+    return fname, file_checksum(fname, chunksize)
+
+def find_blocks(snapdir):
+    """Every block (directory with a header file) in a BigFile, as paths relative to the file, sorted."""
+    blocks = []
+    for (dirpath, _, filenames) in os.walk(snapdir):
+        if "header" in filenames:
+            blocks.append(os.path.relpath(dirpath, snapdir))
+    return sorted(blocks)
+
+def check_sizes(snapdir):
+    """Check that the blocks of a BigFile have all their data files, of the right size,
+    and that the particle blocks have TotNumPart rows.
+    Returns a list of problems (empty if there are none) and a list of (data file, expected checksum).
+    Snapshots compacted by archive.compact_suite only have their Header left, and were verified when archived."""
+    if os.path.exists(os.path.join(snapdir, "ARCHIVE")):
+        return [], []
+    try:
+        npart = catalogue.read_header(snapdir).get("TotNumPart")
+    except FileNotFoundError:
+        return ["No header in "+snapdir], []
+    problems = []
+    files = []
+    for block in find_blocks(snapdir):
+        if block == "Header":
+            continue
+        blockdir = os.path.join(snapdir, block)
+        try:
+            header = read_block_header(blockdir)
+        except (OSError, ValueError) as err:
+            problems.append("Unreadable block header in "+blockdir+": "+str(err))
+            continue
+        itemsize = np.dtype(header["dtype"]).itemsize * header["nmemb"]
+        rows = 0
+        for (fname, nrows, checksum) in header["files"]:
+            rows += nrows
+            try:
+                size = os.stat(fname).st_size
+            except FileNotFoundError:
+                problems.append("Missing data file "+fname)
+                continue
+            if size != nrows * itemsize:
+                problems.append("Data file "+fname+" has "+str(size)+" bytes, expected "+str(nrows * itemsize))
+                continue
+            files.append((fname, checksum))
+        #Particle blocks are in a directory named for the particle type.
+        ptype = block.split(os.path.sep)[0]
+        if npart is not None and ptype.isdigit() and int(ptype) < len(npart) and rows != int(npart[int(ptype)]):
+            problems.append("Block "+blockdir+" has "+str(rows)+" rows, expected TotNumPart="+str(int(npart[int(ptype)])))
+    return problems, files
+
+class Verifier(object):
+    """Check BigFile snapshots, caching the checksums of data files.
+
+    Init parameters:
+    cachefile - SQLite file for the checksum cache, or None to not cache.
+    nproc - number of worker processes for checksums. By default, the number of cores.
+    chunksize - bytes read at once by each worker.
+    """
+    def __init__(self, cachefile=None, nproc=None, chunksize=CHUNKSIZE):
+        self.nproc = nproc
+        self.chunksize = chunksize
+        self._db = None
+        if cachefile is not None:
+            self._db = sqlite3.connect(cachefile, timeout=60)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sums (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, checksum INTEGER)")
+
+    def close(self):
+        """Close the cache."""
+        if self._db is not None:
+            self._db.close()
+
+    def _cached(self, fname):
+        """The cached checksum of a file, or None if it is not cached or the file changed."""
+        if self._db is None:
+            return None
+        stat = os.stat(fname)
+        row = self._db.execute("SELECT size, mtime, checksum FROM sums WHERE path = ?", (fname,)).fetchone()
+        if row is None or row[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return row[2]
+
+    def _store(self, sums):
+        """Add computed checksums to the cache."""
+        if self._db is None:
+            return
+        with self._db:
+            for (fname, checksum) in sums.items():
+                stat = os.stat(fname)
+                self._db.execute("INSERT OR REPLACE INTO sums VALUES (?, ?, ?, ?)", (fname, stat.st_size, stat.st_mtime_ns, checksum))
+
+    def checksums(self, fnames):
+        """Checksums of a list of files, from the cache or computed in parallel. Returns a dictionary."""
+        sums = {}
+        todo = []
+        for fname in fnames:
+            cached = self._cached(fname)
+            if cached is None:
+                todo.append(fname)
+            else:
+                sums[fname] = cached
+        if len(todo) > 1 and self.nproc != 1:
+            with multiprocessing.Pool(self.nproc) as pool:
+                computed = dict(pool.imap_unordered(_checksum_task, [(ff, self.chunksize) for ff in todo]))
+        else:
+            computed = dict([_checksum_task((ff, self.chunksize)) for ff in todo])
+        self._store(computed)
+        sums.update(computed)
+        return sums
+
+    def verify(self, snapdir, checksum=True):
+        """Check a BigFile snapshot or IC file. Returns a list of problems, which is empty if it is intact."""
+        (problems, files) = check_sizes(snapdir)
+        if checksum and files:
+            sums = self.checksums([ff for (ff, _) in files])
+            for (fname, expected) in files:
+                if sums[fname] != expected:
+                    problems.append("Data file "+fname+" has checksum "+str(sums[fname])+", expected "+str(expected))
+        return problems
+
+def verify_suite(rundir, checksum=True, nproc=None, cachefile=None):
+    """Check every snapshot, FOF table and IC file in a suite.
+    The checksum cache is .verify_cache.sqlite in rundir by default.
+    Returns a dictionary of BigFile path -> list of problems, for those with problems."""
+    rundir = os.path.expanduser(rundir)
+    if cachefile is None:
+        cachefile = os.path.join(rundir, ".verify_cache.sqlite")
+    verifier = Verifier(cachefile, nproc=nproc)
+    bad = {}
+    for sim in sorted(os.listdir(rundir)):
+        for subdir in sorted(set([kk[1] for kk in catalogue.KINDS])):
+            path = os.path.join(rundir, sim, subdir)
+            if sim.startswith(".") or not os.path.isdir(path):
+                continue
+            regexes = [kk[2] for kk in catalogue.KINDS if kk[1] == subdir]
+            for name in sorted(os.listdir(path)):
+                if any([rr.match(name) for rr in regexes]) and os.path.isdir(os.path.join(path, name)):
+                    problems = verifier.verify(os.path.join(path, name), checksum=checksum)
+                    if problems:
+                        bad[os.path.join(path, name)] = problems
+    verifier.close()
+    return bad
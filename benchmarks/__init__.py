@@ -0,0 +1 @@
+"""Benchmarks for SimulationRunner, run with airspeed velocity (asv run)."""
@@ -0,0 +1,203 @@
+"""Benchmarks for the stages of the SimulationRunner pipeline.
+These all run offline, without MP-Gadget. The CLASS benchmark is skipped if classylss is not installed."""
+import importlib.util
+import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.interpolate as interp
+from SimulationRunner import simulationics
+from SimulationRunner import lyasimulation
+from SimulationRunner import cambpower
+from SimulationRunner import remake
+from SimulationRunner import catalogue
+
+TESTDATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "testdata")
+
+class TimeKnots:
+    """Changing the power spectrum with knots, as done by LymanAlphaKnotICs."""
+    def setup(self):
+        """Load the test power spectrum"""
+        self.matpow = np.loadtxt(os.path.join(TESTDATA, "ics_matterpow_99.dat"))
+        self.knotpos = np.array([0.475, 0.75, 1.19, 1.89])
+        self.knotval = np.array([1.2, 0.5, 1.2, 0.5])
+
+    def time_change_power_spectrum_knots(self):
+        """Multiply the power spectrum by the knots"""
+        lyasimulation.change_power_spectrum_knots(self.knotpos, self.knotval, self.matpow)
+
+class TimeModeRebin:
+    """Rebinning the IC power spectrum, with the fine k binning used by the IC check."""
+    params = [10000, 100000]
+    param_names = ["nk"]
+
+    def setup(self, nk):
+        """Make a power law power spectrum with the mode counts of a 3D grid."""
+        self.kk = np.linspace(1e-3, 10, nk)
+        self.modes = np.round(4*np.pi*(self.kk/self.kk[0])**2)
+        self.pk = self.kk**-1.5
+        self.pkc = interp.interp1d(self.kk, self.pk*1.01, kind='cubic')
+
+    def time_modecount_rebin(self, nk):
+        """Rebin one spectrum"""
+        cambpower.modecount_rebin(self.kk, self.pk, self.modes, self.pkc, ndesired=nk//100)
+
+    def time_modecount_rebin_batch(self, nk):
+        """Rebin three species sharing one k grid in one call"""
+        cambpower.modecount_rebin(self.kk, np.array([self.pk,]*3), self.modes, [self.pkc,]*3, ndesired=nk//100)
+
+def _write_class_files(outdir, nk=2000):
+    """Write CLASS-format matter power and transfer function files with smooth synthetic data."""
+    kk = np.logspace(-4, 2, nk)
+    matterpow = os.path.join(outdir, "ics_matterpow_99.dat")
+    np.savetxt(matterpow, np.vstack([kk, kk/(1+(kk/0.02)**2.5)]).T)
+    trans = np.array([kk,]+[1+ii/(1+kk) for ii in range(1, 22)]).T
+    transfer = os.path.join(outdir, "ics_transfer_99.dat")
+    simulationics.save_transfer(trans, transfer)
+    return matterpow, transfer
+
+class TimeCLASSPowerSpectrum:
+    """Loading CLASS output files and building interpolators for the IC check."""
+    def setup(self):
+        """Write the CLASS files"""
+        self.tmpdir = tempfile.mkdtemp()
+        (self.matterpow, self.transfer) = _write_class_files(self.tmpdir)
+
+    def teardown(self):
+        """Remove the CLASS files"""
+        shutil.rmtree(self.tmpdir)
+
+    def time_construct(self):
+        """Build the CLASSPowerSpectrum object"""
+        cambpower.CLASSPowerSpectrum(self.matterpow, self.transfer, omega0=0.288, omegab=0.0472, omeganu=0.01)
+
+class TimeNeutrinoMasses:
+    """Neutrino masses for many total masses, as needed for sampling emulator priors."""
+    params = ['degenerate', 'normal', 'inverted']
+    param_names = ["hierarchy"]
+
+    def setup(self, _):
+        """Generate the total masses"""
+        self.masses = np.linspace(0.1, 0.6, 1000)
+
+    def time_scalar(self, hierarchy):
+        """Call the scalar function for each mass"""
+        for mm in self.masses:
+            simulationics.get_neutrino_masses(mm, hierarchy)
+
+    def time_vector(self, hierarchy):
+        """Compute all the masses in one call"""
+        simulationics.get_neutrino_masses(self.masses, hierarchy)
+
+class TimeParamFiles:
+    """Rendering and writing GenIC and MP-Gadget parameter files for a suite."""
+    nsims = 100
+
+    def setup(self):
+        """Build the simulation objects"""
+        self.tmpdir = tempfile.mkdtemp()
+        self.sims = [simulationics.SimulationICs(outdir=os.path.join(self.tmpdir, str(i)), box=60, npart=128, hubble=0.65+0.001*i) for i in range(self.nsims)]
+        self.genicouts = ["ICS/60_128_99",]*self.nsims
+
+    def teardown(self):
+        """Remove the simulations"""
+        shutil.rmtree(self.tmpdir)
+
+    def time_render_genicfiles(self):
+        """Render all GenIC parameter files in memory"""
+        simulationics.render_genicfiles(self.sims)
+
+    def time_render_gadget3params(self):
+        """Render all MP-Gadget parameter files in memory"""
+        simulationics.render_gadget3params(self.sims, self.genicouts)
+
+    def time_write_params(self):
+        """Write all parameter files to disc, as make_simulation does."""
+        for (sim, gg) in zip(self.sims, self.genicouts):
+            sim.genicfile("camb_linear/")
+            sim.gadget3params(gg)
+
+    def time_regenerate_suite(self):
+        """Regenerate all the parameter files, most of which will be unchanged."""
+        simulationics.regenerate_suite(self.sims)
+
+def make_synthetic_suite(rundir, nsims, nsnaps=4, redshift=2.):
+    """Make a directory tree which looks like a suite of finished MP-Gadget runs,
+    with snapshot headers but no particle data."""
+    for ii in range(nsims):
+        for snap in range(nsnaps):
+            header = os.path.join(rundir, "sim%04d" % ii, "output", "PART_%03d" % snap, "Header")
+            os.makedirs(header)
+            time = 1./(1+redshift) * (snap+1)/nsnaps
+            with open(os.path.join(header, "attr-v2"), 'w') as hh:
+                hh.write("BoxSize <f8 1 0000000000407F40 #HUMANE [ 60000 ]\n")
+                hh.write("Time <f8 1 0000000000000000 #HUMANE [ %g ]\n" % time)
+
+class TimeCheckStatus:
+    """Finding the status of a suite of 1000 runs from their snapshots."""
+    nsims = 1000
+
+    def setup(self):
+        """Make the suite directory tree"""
+        self.tmpdir = tempfile.mkdtemp()
+        make_synthetic_suite(self.tmpdir, self.nsims)
+
+    def teardown(self):
+        """Remove the suite directory tree"""
+        shutil.rmtree(self.tmpdir)
+
+    def time_check_status(self):
+        """Check the status of every run"""
+        remake.check_status(self.tmpdir)
+
+class TimeCatalogue:
+    """Cataloguing the snapshots of a suite of 1000 runs, and querying the catalogue."""
+    nsims = 1000
+
+    def setup(self):
+        """Make the suite directory tree and an up to date catalogue"""
+        self.tmpdir = tempfile.mkdtemp()
+        make_synthetic_suite(self.tmpdir, self.nsims)
+        self.cat = catalogue.Catalogue(self.tmpdir, dbfile=os.path.join(self.tmpdir, ".prebuilt.sqlite"))
+        self.cat.update()
+
+    def teardown(self):
+        """Remove the suite directory tree"""
+        self.cat.close()
+        shutil.rmtree(self.tmpdir)
+
+    def time_build(self):
+        """Build a new catalogue from scratch"""
+        cat = catalogue.Catalogue(self.tmpdir, dbfile=os.path.join(self.tmpdir, ".new.sqlite"))
+        cat.update()
+        cat.close()
+        os.remove(os.path.join(self.tmpdir, ".new.sqlite"))
+
+    def time_update_unchanged(self):
+        """Bring an up to date catalogue up to date"""
+        self.cat.update()
+
+    def time_find_redshift(self):
+        """Find the z=2 snapshots of every run"""
+        self.cat.find(redshift=2., tol=0.01)
+
+class TimeCLASS:
+    """A CLASS solve with a small P_k_max. Skipped if classylss is not available."""
+    timeout = 600
+
+    def setup(self):
+        """Build the simulation object"""
+        #asv skips benchmarks whose setup raises NotImplementedError.
+        if importlib.util.find_spec("classylss") is None:
+            raise NotImplementedError("classylss not installed")
+        self.tmpdir = tempfile.mkdtemp()
+        #maxk = 2 pi/box * npart * 8 ~ 0.4 h/Mpc
+        self.sim = simulationics.SimulationICs(outdir=self.tmpdir, box=1000, npart=8)
+
+    def teardown(self):
+        """Remove the CLASS output"""
+        shutil.rmtree(self.tmpdir)
+
+    def time_cambfile(self):
+        """Run CLASS and save the output"""
+        self.sim.cambfile()
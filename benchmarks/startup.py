@@ -0,0 +1,39 @@
+"""Benchmarks for the cost of importing SimulationRunner and constructing SimulationICs objects.
+These are what dominate inspecting or regenerating parameter files for a large suite on a login node."""
+import os
+import shutil
+import tempfile
+from SimulationRunner import simulationics
+from SimulationRunner import utils
+
+def timeraw_import_simulationics():
+    """Time a cold import of simulationics in a fresh interpreter."""
+    return "from SimulationRunner import simulationics"
+
+def timeraw_import_cambpower():
+    """Time a cold import of cambpower in a fresh interpreter."""
+    return "from SimulationRunner import cambpower"
+
+class TimeConstruct:
+    """Construct many SimulationICs objects, as when building a suite."""
+    nsims = 500
+
+    def setup(self):
+        """Make a scratch directory for the simulations."""
+        self.tmpdir = tempfile.mkdtemp()
+        self.outdirs = [os.path.join(self.tmpdir, str(i)) for i in range(self.nsims)]
+
+    def teardown(self):
+        """Remove the scratch directory"""
+        shutil.rmtree(self.tmpdir)
+
+    def time_construct(self):
+        """Construct all the SimulationICs objects."""
+        for outdir in self.outdirs:
+            simulationics.SimulationICs(outdir=outdir, box=60, npart=128)
+
+    def time_construct_cold_git(self):
+        """Construct all the objects, starting with an empty git hash cache."""
+        utils._GIT_HASHES.clear()
+        for outdir in self.outdirs:
+            simulationics.SimulationICs(outdir=outdir, box=60, npart=128)
@@ -0,0 +1,60 @@
+"""Tests for the IC power spectrum checking module"""
+import numpy as np
+import scipy.interpolate as interp
+from SimulationRunner import cambpower
+
+def _loop_rebin(kk, pk, modes, pkc, minmodes=250, ndesired=200):
+    """The original mode-by-mode rebinning loop, to check the vectorised version against."""
+    logkk=np.log10(kk)
+    mdlogk = (np.max(logkk) - np.min(logkk))/ndesired
+    istart=iend=1
+    count=0
+    pk_div = pk /pkc(kk)
+    k_list=[kk[0]]
+    pk_list=[pk_div[0]]
+    targetlogk=mdlogk+logkk[istart]
+    while iend < np.size(logkk)-1:
+        count+=modes[iend]
+        iend+=1
+        if count >= minmodes and logkk[iend-1] >= targetlogk:
+            k_list.append(np.sum(modes[istart:iend]*kk[istart:iend])/count)
+            pk_list.append(np.sum(modes[istart:iend]*pk_div[istart:iend])/count)
+            istart=iend
+            targetlogk=mdlogk+logkk[istart]
+            count=0
+    k_list = np.array(k_list)
+    return (k_list, np.array(pk_list) * pkc(k_list))
+
+def test_modecount_rebin():
+    """Check the vectorised rebinning gives the same bins as the loop, for single and batched spectra."""
+    kk = np.linspace(1e-3, 10, 5000)
+    modes = np.round(4*np.pi*(kk/kk[0])**2)
+    modes[::7] = 0
+    pkc = interp.interp1d(kk, kk**-1.5, kind='cubic')
+    pk = kk**-1.5 * (1 + 0.05*np.sin(kk*30))
+    for (minmodes, ndesired) in ((250, 200), (1e6, 50), (1, 1000)):
+        (k_loop, pk_loop) = _loop_rebin(kk, pk, modes, pkc, minmodes=minmodes, ndesired=ndesired)
+        (k_vec, pk_vec) = cambpower.modecount_rebin(kk, pk, modes, pkc, minmodes=minmodes, ndesired=ndesired)
+        assert np.shape(k_loop) == np.shape(k_vec)
+        assert np.allclose(k_loop, k_vec, rtol=1e-12)
+        assert np.allclose(pk_loop, pk_vec, rtol=1e-12)
+        (k_batch, pk_batch) = cambpower.modecount_rebin(kk, np.array([pk, 2*pk]), modes, [pkc, pkc], minmodes=minmodes, ndesired=ndesired)
+        assert np.array_equal(k_batch, k_vec)
+        assert np.allclose(pk_batch[0], pk_vec, rtol=1e-12)
+        assert np.allclose(pk_batch[1], 2*pk_vec, rtol=1e-12)
+
+def test_headless_ic_power(tmpdir):
+    """Check that headless IC checks save the same error as the plotting check, and can be rendered later."""
+    kk = np.logspace(-2, 1, 100)
+    pk_camb = kk**-1.5
+    pk_ic = pk_camb * (1 + 0.01*np.sin(kk))
+    for sim in ("sim0", "sim1"):
+        tmpdir.mkdir(sim).mkdir("ICS")
+        error = cambpower.save_ic_power(kk, pk_ic, pk_camb, npart=64, sp=1, outdir=str(tmpdir.join(sim)))
+    diag = np.load(str(tmpdir.join("sim0", "ICS", "PK-IC-1.npz")))
+    assert np.array_equal(diag['error'], error)
+    assert np.array_equal(diag['pk_ic'], pk_ic)
+    assert np.array_equal(cambpower.plot_ic_power(kk, pk_ic, pk_camb, npart=64, sp=2, outdir=str(tmpdir.join("sim0"))), error)
+    rendered = cambpower.render_suite_ic_power(str(tmpdir), nproc=2)
+    assert len(rendered) == 2
+    assert tmpdir.join("sim1", "ICS", "PK-IC-1-diff.pdf").check()
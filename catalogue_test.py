@@ -0,0 +1,99 @@
+"""Tests for the snapshot catalogue"""
+import os
+import json
+import pytest
+from SimulationRunner import catalogue
+from SimulationRunner import suitestate
+from SimulationRunner import remake
+
+def _write_snapshot(snapdir, time, npart, ngroups=None):
+    """Write a BigFile header (and for FOF tables a group mass block header) without any particle data."""
+    os.makedirs(os.path.join(snapdir, "Header"))
+    with open(os.path.join(snapdir, "Header", "attr-v2"), 'w') as hh:
+        hh.write("BoxSize <f8 1 0000000000407F40 #HUMANE [ 60000 ]\n")
+        hh.write("Time <f8 1 000000000000D03F #HUMANE [ %g ]\n" % time)
+        hh.write("TotNumPart <u8 6 0 #HUMANE [ %s ]\n" % " ".join([str(nn) for nn in npart]))
+    if ngroups is not None:
+        os.makedirs(os.path.join(snapdir, "FOFGroups", "Mass"))
+        with open(os.path.join(snapdir, "FOFGroups", "Mass", "header"), 'w') as hh:
+            hh.write("DTYPE: <f4\nNMEMB: 1\nNFILE: 2\n")
+            hh.write("000000: %d : 0 : 0\n000001: %d : 0 : 0\n" % (ngroups//2, ngroups - ngroups//2))
+        with open(os.path.join(snapdir, "FOFGroups", "Mass", "000000"), 'wb') as dd:
+            dd.write(b"\0"*4*ngroups)
+
+def test_catalogue(tmpdir):
+    """Check that the catalogue finds and updates snapshots, FOF tables and ICs."""
+    rundir = str(tmpdir)
+    for sim in range(3):
+        simdir = os.path.join(rundir, "sim%d" % sim)
+        _write_snapshot(os.path.join(simdir, "ICS", "ics_99"), 0.01, [8, 8, 0, 0, 0, 0])
+        for snap in range(3):
+            _write_snapshot(os.path.join(simdir, "output", "PART_%03d" % snap), 0.25*(snap+1), [8, 8, 0, 0, 0, 0])
+        _write_snapshot(os.path.join(simdir, "output", "PIG_002"), 0.75, [0, 3, 0, 0, 0, 0], ngroups=5)
+    cat = catalogue.Catalogue(rundir)
+    assert cat.update() == 15
+    #Nothing changed, so nothing is parsed again.
+    assert cat.update() == 0
+    zthree = cat.find(redshift=3.)
+    assert [row["sim"] for row in zthree] == ["sim0", "sim1", "sim2"]
+    assert zthree[0]["snapnum"] == 0 and zthree[0]["npart"] == [8, 8, 0, 0, 0, 0] and zthree[0]["ntotal"] == 16
+    pig = cat.find(kind="PIG", sim="sim1")
+    assert len(pig) == 1 and pig[0]["ngroups"] == 5 and pig[0]["size"] > 20
+    assert abs(cat.find(kind="ICS")[0]["redshift"] - 99) < 1e-6
+    #A new snapshot, and a removed simulation
+    _write_snapshot(os.path.join(rundir, "sim0", "output", "PART_003"), 1., [8, 8, 0, 0, 0, 0])
+    os.rename(os.path.join(rundir, "sim2"), os.path.join(rundir, ".trash"))
+    os.makedirs(os.path.join(rundir, "sim1", "output", "PART_003"))
+    assert cat.update() == 6
+    #The header is written after the snapshot directory is made
+    _write_snapshot(os.path.join(rundir, "sim1", "output", "PART_003"), 1., [8, 8, 0, 0, 0, 0])
+    assert cat.update() == 1
+    latest = cat.latest()
+    assert sorted(latest) == ["sim0", "sim1"]
+    assert latest["sim0"]["snapnum"] == 3 and latest["sim0"]["redshift"] == 0
+    #The database persists
+    cat.close()
+    assert len(catalogue.Catalogue(rundir).find()) == 8
+
+def test_suite_state(tmpdir):
+    """Check that the suite state records parameters, redshifts and submissions, and is used by remake."""
+    rundir = str(tmpdir)
+    for sim in range(3):
+        simdir = os.path.join(rundir, "sim%d" % sim)
+        os.makedirs(simdir)
+        with open(os.path.join(simdir, "SimulationICs.json"), 'w') as jsout:
+            json.dump({"ns": 0.9 + 0.01*sim, "redend": 2}, jsout)
+        with open(os.path.join(simdir, "mpi_submit"), 'w') as script:
+            script.write("mpirun -np 4 MP-Gadget mpgadget.param\n")
+    _write_snapshot(os.path.join(rundir, "sim0", "ICS", "ics_99"), 0.01, [8, 8, 0, 0, 0, 0])
+    _write_snapshot(os.path.join(rundir, "sim0", "output", "PART_000"), 0.25, [8, 8, 0, 0, 0, 0])
+    _write_snapshot(os.path.join(rundir, "sim1", "ICS", "ics_99"), 0.01, [8, 8, 0, 0, 0, 0])
+    _write_snapshot(os.path.join(rundir, "sim1", "output", "PART_000"), 0.5, [8, 8, 0, 0, 0, 0])
+    state = suitestate.SuiteState(rundir)
+    (odirs, completes, redshifts) = remake.check_status(rundir, endz=2.01, state=state)
+    assert [os.path.basename(oo) for oo in odirs] == ["sim0", "sim1", "sim2"]
+    assert completes == [False, True, False]
+    assert redshifts[:2] == [3, 1]
+    #The state only knows about the snapshot headers in output/
+    with pytest.raises(ValueError):
+        remake.check_status(rundir, output_file="output2", state=state)
+    with pytest.raises(ValueError):
+        remake.check_status(rundir, use_file=False, state=state)
+    assert state.get("sim2")["params"]["ns"] == 0.92
+    assert [ss[:2] for ss in state.status()] == [(os.path.join(state.rundir, "sim0"), "running"), (os.path.join(state.rundir, "sim1"), "complete"), (os.path.join(state.rundir, "sim2"), "created")]
+    submitted = []
+    def submit(script, cwd):
+        """Pretend to submit a job"""
+        submitted.append((os.path.basename(cwd), script))
+        return str(len(submitted))
+    remake.resub_not_complete(rundir, state=state, resub_command=submit)
+    assert submitted == [("sim0", "mpi_submit_resub"), ("sim2", "mpi_submit_resub")]
+    remake.resub_not_complete_genic(rundir, state=state, resub_command=submit)
+    assert submitted[-1] == ("sim2", "mpi_submit_genic")
+    assert [jj[:3] for jj in state.jobs("sim0")] == [("gadget", "1", "mpi_submit_resub")]
+    #A second tool sees the same state.
+    state.close()
+    other = suitestate.SuiteState(rundir)
+    assert other.get("sim0")["attempts"] == 1 and other.get("sim2")["attempts"] == 2
+    assert other.incomplete() == [os.path.join(other.rundir, "sim0"), os.path.join(other.rundir, "sim2")]
+    assert other.without_ics() == [os.path.join(other.rundir, "sim2")]
@@ -1,11 +1,15 @@
 """Integration tests for the neutrinosimulation module"""
 
 import os
+import json
 import bigfile
 import numpy as np
 import configobj
 from SimulationRunner import simulationics
 from SimulationRunner import neutrinosimulation as nus
+from SimulationRunner import classtune
+from SimulationRunner import lineartheory
+from SimulationRunner import nubudget
 
 def test_neutrino_part():
     """Create a full simulation with particle neutrinos."""
@@ -84,3 +88,121 @@ def test_neutrino_mass_spec():
     assert np.abs(numass[0]+numass[1]+numass[2] - 0.11) < 1e-4
     assert np.abs(numass[0]**2 - numass[1]**2 + M32n) < 1e-4
     assert np.abs(numass[1]**2 - numass[2]**2 - M21) < 1e-4
+
+def test_neutrino_mass_vector():
+    """Check that evaluating many neutrino masses at once matches evaluating them one at a time, and the original values"""
+    masses = np.linspace(0.0, 1.0, 501)
+    masses = masses[(masses < 0.09) + (masses > 0.1)]
+    for hierarchy in ('degenerate', 'normal', 'inverted'):
+        numass = simulationics.get_neutrino_masses(masses, hierarchy)
+        assert np.shape(numass) == (np.size(masses), 3)
+        for (mm, nn) in zip(masses, numass):
+            assert np.array_equal(simulationics.get_neutrino_masses(float(mm), hierarchy), nn)
+    #Values from the original scalar implementation, including masses either side of the smallest sum each hierarchy allows.
+    expected = {'normal': {0.058: [0.058, 0.0, 0.0],
+                           0.059: [0.05014647163574726, 0.008679306044647162, 0.00017422231960557717],
+                           0.1: [0.05469449390474697, 0.023483777866571093, 0.021821728228681943],
+                           0.3: [0.10809513366356716, 0.09614862412844978, 0.09575624220798305]},
+                'inverted': {0.0915: [0.04575, 0.04575, 0.0],
+                             0.0995: [5.7354176185797634e-05, 0.05009993311166693, 0.049342712712147276],
+                             0.11: [0.008956750829146945, 0.05089423730630546, 0.050149011864547594],
+                             0.3: [0.09158177586636645, 0.10438975845777661, 0.10402846567585693]},
+                'degenerate': {0.0: [0.0, 0.0, 0.0], 0.3: [0.1, 0.1, 0.1]}}
+    for (hierarchy, values) in expected.items():
+        numass = simulationics.get_neutrino_masses(np.array(list(values.keys())), hierarchy)
+        assert np.allclose(numass, list(values.values()), rtol=1e-12, atol=1e-15)
+        for (mm, nn) in values.items():
+            assert np.allclose(simulationics.get_neutrino_masses(mm, hierarchy), nn, rtol=1e-12, atol=1e-15)
+    #Mixed hierarchies
+    hierarchies = np.array(['normal', 'inverted', 'degenerate'])
+    numass = simulationics.get_neutrino_masses([0.3, 0.3, 0.3], hierarchies)
+    for (hh, nn) in zip(hierarchies, numass):
+        assert np.array_equal(simulationics.get_neutrino_masses(0.3, hh), nn)
+
+def _stub_solver(calls):
+    """A fake CLASS solver whose error is set by tol_ncdm_synchronous and whose cost is set by l_max_ncdm."""
+    def solver(params, redshifts):
+        calls.append(params)
+        kk = np.logspace(-3, 1, 50)
+        err = params['tol_ncdm_synchronous']*100
+        pk = kk**-1.5 * (1+err)
+        return {zz: (kk, pk, pk*(1+10*err)) for zz in redshifts}
+    return solver
+
+def test_class_precision_tuning(tmpdir):
+    """Check that the precision tuning picks the cheapest settings which meet the accuracy target, and caches them."""
+    cachefile = str(tmpdir.join("class_precision.json"))
+    params = {'tol_ncdm_newtonian': 1e-7, 'tol_ncdm_synchronous': 1e-7, 'l_max_ncdm': 50, 'ncdm_fluid_trigger_tau_over_tau_k': 30000.}
+    calls = []
+    #Reference error is 1e-5, so rung 1 has relative error ~ 1e-2 in P and ~ 0.1 in P_nu.
+    tuned = classtune.tune_precision(params, 0.4, [99, 0], target=2e-2, nu_target=0.2, solver=_stub_solver(calls))
+    assert tuned['settings']['tol_ncdm_synchronous'] == 1e-4
+    assert tuned['tot_error'] <= 2e-2 and tuned['nu_error'] <= 0.2
+    #An unreachable target gives back the reference settings
+    tuned = classtune.tune_precision(params, 0.4, [99, 0], target=0, nu_target=0, solver=_stub_solver(calls))
+    assert tuned['rung'] == -1
+    assert tuned['settings'] == params
+    #The top rung is the default reference: it is not solved twice.
+    calls = []
+    reference = classtune._ladder_settings(len(classtune.PRECISION_LADDER)-1, 0.4)
+    tuned = classtune.tune_precision(reference, 0.4, [99, 0], target=0, nu_target=0, solver=_stub_solver(calls))
+    assert tuned['rung'] == len(classtune.PRECISION_LADDER)-1 and tuned['settings'] == reference
+    assert len(calls) == len(classtune.PRECISION_LADDER)
+    #Caching
+    calls = []
+    settings = classtune.tuned_precision(params, 0.41, 10., [99, 0], target=2e-2, nu_target=0.2, cachefile=cachefile, solver=_stub_solver(calls))
+    ncalls = len(calls)
+    assert ncalls > 1
+    #Same mass bucket and a looser target: reuse
+    assert classtune.tuned_precision(params, 0.40, 10., [99, 0], target=3e-2, nu_target=0.2, cachefile=cachefile, solver=_stub_solver(calls)) == settings
+    assert len(calls) == ncalls
+    #Tighter target or different maxk: retune
+    classtune.tuned_precision(params, 0.40, 20., [99, 0], target=2e-2, nu_target=0.2, cachefile=cachefile, solver=_stub_solver(calls))
+    assert len(calls) > ncalls
+    assert len(classtune._load_cache(cachefile)) == 2
+    #A different reference accuracy: retune
+    ncalls = len(calls)
+    classtune.tuned_precision(params, 0.40, 20., [99, 0], target=2e-2, nu_target=0.2, cachefile=cachefile, solver=_stub_solver(calls), nu_acc=1e-6)
+    assert len(calls) > ncalls
+    assert len(classtune._load_cache(cachefile)) == 3
+
+def _fake_linear_theory(filename, redshifts):
+    """Save a linear theory store with P(k) ~ k^-1.5, non-linear at k = 0.5 (1+z)^(4/3) h/Mpc, and neutrinos suppressed above k = 0.5 h/Mpc."""
+    kk = np.logspace(-3, 1, 200)
+    transfers = [np.array([kk, np.ones_like(kk), 1/(1+(kk/0.5)**2)]).T for zz in redshifts]
+    pks = [2*np.pi**2/0.5**1.5*kk**-1.5/(1+zz)**2 for zz in redshifts]
+    lineartheory.save_linear_theory(filename, redshifts, transfers, pks, columns=["k", "d_tot", "d_ncdm[0]"])
+
+def test_neutrino_budget(tmpdir):
+    """Check that the neutrino particle budget follows the accuracy targets and is saved with the simulation."""
+    assert np.abs(nubudget.fermi_dirac_fraction(50) - 1) < 1e-6
+    assert nubudget.fermi_dirac_fraction(nubudget.FD_MEAN_Q) < 0.6
+    filename = str(tmpdir.join("linear_theory.npz"))
+    _fake_linear_theory(filename, [99, 3, 1, 0])
+    linear = lineartheory.LinearTheory(filename)
+    masses = [0.1, 0.1, 0.1]
+    budget = nubudget.tune_budget(linear, masses, omega0=0.288, hubble=0.7, box=256, npart=256, redend=0, target=1e-3)
+    assert np.abs(budget["k_nl"]/0.5 - 1) < 1e-3
+    assert np.isclose(budget["vcrit"], nubudget.free_streaming_velocity(budget["k_nl"], 1, 0.288))
+    assert np.isclose(budget["particle_fraction"], nubudget.fermi_dirac_fraction(budget["vcrit"]*0.1/nubudget.FD_VELOCITY))
+    assert budget["zz_transition"] == 0 and 2 <= budget["NgridNu"] < 256
+    assert len(budget["reasons"]) == 3
+    #Tighter targets need more particles, made earlier.
+    tight = nubudget.tune_budget(linear, masses, omega0=0.288, hubble=0.7, box=256, npart=256, redend=0, target=3e-5, nu_target=1e-3)
+    assert tight["zz_transition"] == 1 and tight["NgridNu"] > budget["NgridNu"]
+    #All-particle neutrinos are not all needed either.
+    part = nubudget.tune_budget(linear, masses, omega0=0.288, hubble=0.7, box=256, npart=256, redend=0, hybrid=False)
+    assert part["particle_fraction"] == 1 and budget["NgridNu"] < part["NgridNu"] < 256
+    for (cls, kwargs) in ((nus.NeutrinoHybridICs, {}), (nus.NeutrinoPartICs, {"separate_gas": False})):
+        outdir = tmpdir.join(cls.__name__)
+        sim = cls(outdir=str(outdir), box=256, npart=256, m_nu=0.3, redshift=99, redend=0, nu_budget_target=3e-5, nu_budget_nu_target=1e-3, **kwargs)
+        _fake_linear_theory(str(outdir.mkdir("camb_linear").join(sim.linear_theory_file)), [99, 3, 1, 0])
+        budget = sim.tune_nu_budget()
+        config = sim._genicfile_child_options({})
+        assert config['NgridNu'] == budget["NgridNu"] < 256
+        if cls == nus.NeutrinoHybridICs:
+            assert config['Max_nuvel'] == budget["vcrit"] == sim._other_params({})['Vcrit']
+            assert sim._other_params({})['NuPartTime'] == 0.5
+        sim.txt_description()
+        with open(str(outdir.join("SimulationICs.json"))) as jsin:
+            assert json.load(jsin)["nu_budget"]["reasons"] == budget["reasons"]
@@ -0,0 +1,260 @@
+"""Tests for the suite orchestrator and the local job runner, using local processes in place of a batch scheduler"""
+import os
+import subprocess
+import threading
+import time
+import numpy as np
+import pytest
+from SimulationRunner import orchestrator
+from SimulationRunner import localrunner
+from SimulationRunner import clusters
+from SimulationRunner import remake
+from SimulationRunner import simulationics
+
+class FakeSimulation(object):
+    """Writes job scripts which pretend to be MP-GenIC and MP-Gadget."""
+    def __init__(self, outdir, genic_failures=0):
+        self.outdir = outdir
+        self.redend = 2
+        self.genic_failures = genic_failures
+        self.made = 0
+
+    def make_simulation(self):
+        """Write the job scripts. The GenIC script fails the first genic_failures times it is run."""
+        self.made += 1
+        os.makedirs(self.outdir, exist_ok=True)
+        with open(os.path.join(self.outdir, "mpi_submit_genic"), 'w') as script:
+            script.write("n=$(cat tries 2>/dev/null || echo 0); echo $((n+1)) > tries\n")
+            script.write("if [ $n -lt %d ]; then exit 1; fi\n" % self.genic_failures)
+            script.write("mkdir -p ICS/ics/Header && touch ICS/ics/Header/attr-v2\n")
+        with open(os.path.join(self.outdir, "mpi_submit"), 'w') as script:
+            script.write("mpirun() { return 0; }\n")
+            script.write("mkdir -p output/PART_000/Header\n")
+            script.write("echo 'Time <f8 1 0 #HUMANE [ 0.333333333 ]' > output/PART_000/Header/attr-v2\n")
+            script.write("mpirun -np 1 MP-Gadget mpgadget.param\n")
+        with open(os.path.join(self.outdir, "analysis"), 'w') as script:
+            script.write("touch analysed\n")
+
+def test_local_orchestrator(tmpdir):
+    """Run a small suite through every stage with local processes, including a transient GenIC failure."""
+    sims = [FakeSimulation(str(tmpdir.join("sim%d" % ii)), genic_failures=ii) for ii in range(4)]
+    events = []
+    orch = orchestrator.Orchestrator(sims, orchestrator.LocalScheduler(), limits={"genic": 2, "gadget": 2}, retries=2, analysis="analysis", poll=0.01, callback=lambda *ev: events.append(ev))
+    results = orch.run()
+    #The last simulation fails GenIC three times, more than the retries allowed.
+    assert [results[sim.outdir] for sim in sims] == [True, True, True, False]
+    assert orch.states[sims[3].outdir] == ("genic", "failed")
+    for sim in sims[:3]:
+        assert orch.states[sim.outdir] == ("finished", "done")
+        assert os.path.exists(os.path.join(sim.outdir, "analysed"))
+    assert (sims[2].outdir, "genic", "retrying") in events
+    #Running again skips the stages which are already done, apart from the analysis.
+    sims[3].genic_failures = 0
+    sims[3].make_simulation()
+    results = orch.run()
+    assert all(results.values())
+    assert [sim.made for sim in sims] == [1, 1, 1, 2]
+
+def test_gadget_progress(tmpdir, monkeypatch):
+    """Check that MP-Gadget jobs which stop after making progress are resumed without using up the retries,
+    and that only jobs which make no progress count as failures."""
+    bindir = tmpdir.mkdir("bin")
+    bindir.join("mpirun").write("#!/bin/bash\necho \"$@\" >> launches\n")
+    os.chmod(str(bindir.join("mpirun")), 0o755)
+    monkeypatch.setenv("PATH", str(bindir)+os.pathsep+os.environ["PATH"])
+    sims = [FakeSimulation(str(tmpdir.join("sim%d" % ii))) for ii in range(2)]
+    for (sim, stall) in zip(sims, (4, 2)):
+        sim.make_simulation()
+        #Each job writes one snapshot, then stops as if at the time limit, until the end or the run stalls.
+        with open(os.path.join(sim.outdir, "mpi_submit"), 'w') as script:
+            script.write("n=$(ls -d output/PART_* 2>/dev/null | wc -l)\ntimes=(0.1 0.2 0.25 0.333333333)\n")
+            script.write("mpirun -np 1 MP-Gadget mpgadget.param\n")
+            script.write("if [ $n -ge %d ]; then exit 1; fi\n" % stall)
+            script.write("mkdir -p output/PART_00$n/Header\n")
+            script.write("echo \"Time <f8 1 0 #HUMANE [ ${times[$n]} ]\" > output/PART_00$n/Header/attr-v2\n")
+            script.write("[ $n -eq 3 ]\n")
+    events = []
+    orch = orchestrator.Orchestrator(sims, orchestrator.LocalScheduler(), retries=1, poll=0.01, callback=lambda *ev: events.append(ev))
+    results = orch.run()
+    #Four jobs are needed, more than retries+1, but every job made progress.
+    assert results[sims[0].outdir]
+    launches = tmpdir.join("sim0", "launches").read().splitlines()
+    assert launches == ["-np 1 MP-Gadget mpgadget.param", "-np 1 MP-Gadget mpgadget.param 2 0",
+                        "-np 1 MP-Gadget mpgadget.param 2 1", "-np 1 MP-Gadget mpgadget.param 2 2"]
+    assert events.count((sims[0].outdir, "gadget", "resuming")) == 3
+    assert (sims[0].outdir, "gadget", "retrying") not in events
+    #The second simulation stalls after two snapshots: two more jobs with no progress use the retry and fail.
+    assert not results[sims[1].outdir]
+    assert len(tmpdir.join("sim1", "launches").read().splitlines()) == 4
+    assert orch.states[sims[1].outdir] == ("gadget", "failed")
+
+def test_local_runner(tmpdir):
+    """Check that the local runner runs jobs concurrently on disjoint cores, and queues jobs which do not fit."""
+    cluster = clusters.LocalClusterClass(nproc=2)
+    for ii in range(3):
+        simdir = tmpdir.mkdir("sim%d" % ii)
+        cluster.generate_mpi_submit(str(simdir))
+        assert "--cpu-set $SIMRUNNER_CPUSET" in simdir.join("mpi_submit").read()
+        #Replace the MPI command with one which records when and where it ran.
+        with open(str(simdir.join("mpi_submit")), 'w') as script:
+            script.write("#!/bin/bash\n"+cluster._queue_directive("sim%d" % ii, timelimit=1, nproc=2))
+            script.write("echo $SIMRUNNER_CPUSET > cpuset; date +%s.%N > start; sleep 0.3; date +%s.%N > end\n")
+    assert localrunner.parse_directives(str(tmpdir.join("sim0", "mpi_submit"))) == {"name": "sim0", "nproc": 2, "memory": 4000, "timelimit": 3600}
+    runner = localrunner.LocalRunner(cores=4, memory=8000, poll=0.01)
+    remake.resub(str(tmpdir), submit_command=runner)
+    assert set(runner.wait().values()) == {"done"}
+    cpusets = [tmpdir.join("sim%d" % ii, "cpuset").read().strip() for ii in range(3)]
+    times = [(float(tmpdir.join("sim%d" % ii, "start").read()), float(tmpdir.join("sim%d" % ii, "end").read())) for ii in range(3)]
+    #Two jobs fit at once, on different cores. The third waits for one of them to finish.
+    order = np.argsort([tt[0] for tt in times])
+    (first, second, third) = [times[oo] for oo in order]
+    assert second[0] < first[1]
+    assert third[0] >= min(first[1], second[1])
+    assert not set(cpusets[order[0]].split(",")) & set(cpusets[order[1]].split(","))
+    #A job which can never fit is refused
+    with pytest.raises(ValueError):
+        localrunner.LocalRunner(cores=1, memory=8000).submit("mpi_submit", str(tmpdir.join("sim0")))
+
+def _running(pid):
+    """Whether a process exists and is not a zombie."""
+    try:
+        with open("/proc/%d/stat" % pid, 'r') as stat:
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+def test_kill_job_tasks(tmpdir):
+    """Check that jobs killed at their time limit or cancelled take the processes they started with them."""
+    for ii in range(2):
+        simdir = tmpdir.mkdir("kill%d" % ii)
+        simdir.join("mpi_submit").write("#!/bin/bash\n#LOCAL -n 1\n#LOCAL -t 0:0:1\nsleep 60 &\necho $! > child\nwait\n")
+    runner = localrunner.LocalRunner(cores=1, memory=8000, poll=0.01)
+    runner.submit("mpi_submit", str(tmpdir.join("kill0")))
+    assert runner.wait() == {"1": "failed"}
+    assert not _running(int(tmpdir.join("kill0", "child").read()))
+    sched = orchestrator.LocalScheduler()
+    jobid = sched.submit("mpi_submit", str(tmpdir.join("kill1")))
+    while not tmpdir.join("kill1", "child").check() or not tmpdir.join("kill1", "child").read().strip():
+        time.sleep(0.01)
+    child = int(tmpdir.join("kill1", "child").read())
+    assert _running(child)
+    sched.cancel(jobid)
+    assert sched.status(jobid) == "failed"
+    assert not _running(child)
+    #A job which ignores SIGTERM is killed after the grace time, while the other jobs are still scheduled.
+    stubborn = tmpdir.mkdir("kill2")
+    stubborn.join("mpi_submit").write("#!/bin/bash\n#LOCAL -n 1\ntrap '' TERM\nsleep 60 &\necho $! > child\nwait\n")
+    runner = localrunner.LocalRunner(cores=2, memory=8000, poll=0.01, grace=1.)
+    jobid = runner.submit("mpi_submit", str(stubborn))
+    tmpdir.mkdir("kill3").join("mpi_submit").write("#!/bin/bash\n#LOCAL -n 1\nsleep 60\n")
+    other = runner.submit("mpi_submit", str(tmpdir.join("kill3")))
+    while not stubborn.join("child").check() or not stubborn.join("child").read().strip():
+        time.sleep(0.01)
+    cancel = threading.Thread(target=runner.cancel, args=(jobid,))
+    cancel.start()
+    time.sleep(0.2)
+    start = time.time()
+    assert runner.status(other) == "running"
+    assert time.time() - start < 0.5 and cancel.is_alive()
+    cancel.join()
+    assert not _running(int(stubborn.join("child").read()))
+    runner.cancel(other)
+    assert runner.wait() == {jobid: "failed", other: "failed"}
+
+def test_scratch_staging(tmpdir):
+    """Check that a staged job script runs from scratch, copies the outputs back even if MP-Gadget fails,
+    and removes scratch. mpirun is replaced by a script which pretends to be MP-Gadget."""
+    bindir = tmpdir.mkdir("bin")
+    bindir.join("mpirun").write("#!/bin/bash\npwd > ran_in\ncat ICS/ics/1/Position/000000 > output/cpu.txt\n"
+                                "mkdir -p output/PART_000/Header output/PART_001\ntouch output/PART_000/Header/attr-v2\nexit 3\n")
+    os.chmod(str(bindir.join("mpirun")), 0o755)
+    simdir = tmpdir.mkdir("sim")
+    simdir.mkdir("ICS").mkdir("ics").mkdir("1").mkdir("Position").join("000000").write("particles")
+    simdir.join("mpgadget.param").write("InitCondFile = ICS/ics\n")
+    scratch = tmpdir.mkdir("scratch")
+    cluster = clusters.LocalClusterClass(nproc=2)
+    cluster.scratch = str(scratch)
+    cluster.generate_mpi_submit(str(simdir))
+    #The restart script can still find the launch line.
+    assert remake.write_restart_script(str(simdir))[1]
+    env = dict(os.environ)
+    env["PATH"] = str(bindir)+os.pathsep+env["PATH"]
+    ret = subprocess.call(["bash", "mpi_submit"], cwd=str(simdir), env=env)
+    assert ret == 3
+    assert scratch.listdir() == []
+    assert simdir.join("output", "cpu.txt").read() == "particles"
+    assert simdir.join("output", "PART_000", "Header", "attr-v2").check()
+    assert simdir.join("output", "PART_001").check(dir=True)
+    #MP-Gadget ran in scratch, not in the simulation directory.
+    assert not simdir.join("ran_in").check()
+
+def test_layout_calibration(tmpdir, monkeypatch):
+    """Calibrate the layout of a local cluster with an mpirun which writes a synthetic cpu.txt,
+    in which two tasks of two threads is fastest, and check the job scripts then use it."""
+    from SimulationRunner import layout
+    monkeypatch.setenv("SIMRUNNER_LAYOUTS", str(tmpdir.join("layouts.json")))
+    bindir = tmpdir.mkdir("bin")
+    bindir.join("mpirun").write("#!/bin/bash\ngrep -q 'InitCondFile = /' mpgadget.param || exit 1\nmkdir -p output\n"
+                                "for step in 0 1 2 3 4 5; do echo \"Step $step, Time: 0.01, MPIs: $2 Threads: $OMP_NUM_THREADS Elapsed: $((1 + step*(1 + ($2-2)*($2-2))))\" >> output/cpu.txt; done\n")
+    os.chmod(str(bindir.join("mpirun")), 0o755)
+    monkeypatch.setenv("PATH", str(bindir)+os.pathsep+os.environ["PATH"])
+    simdir = tmpdir.mkdir("sim")
+    simdir.join("mpgadget.param").write("InitCondFile = ICS/ics\nOutputDir = output\nTimeLimitCPU = 86100\n")
+    cluster = clusters.LocalClusterClass(nproc=4)
+    assert cluster.layouts() == [(4, 1), (2, 2), (1, 4)]
+    assert layout.best_layout(cluster, 128, True) is None
+    result = layout.calibrate(str(simdir), cluster, 128, True, orchestrator.LocalScheduler(), poll=0.01)
+    assert result["layout"] == [2, 2]
+    assert result["timings"] == {"4x1": 5., "2x2": 1., "1x4": 2.}
+    assert "TimeLimitCPU = 300" in simdir.join("calibrate", "2x2", "mpgadget.param").read()
+    #Used for the same particle load, and not for another.
+    cluster.generate_mpi_submit(str(simdir), npart=128, separate_gas=True)
+    script = simdir.join("mpi_submit").read()
+    assert "OMP_NUM_THREADS=2" in script and "mpirun -np 2 --map-by slot:PE=2" in script
+    #MP-GenIC keeps the default layout.
+    assert cluster.layout == (4, 1)
+    cluster.generate_mpi_submit_genic(str(simdir))
+    assert "mpirun -np 4 " in simdir.join("mpi_submit_genic").read()
+    other = clusters.LocalClusterClass(nproc=4)
+    other.generate_mpi_submit(str(simdir), npart=256, separate_gas=True)
+    assert "mpirun -np 4 " in simdir.join("mpi_submit").read()
+
+def test_genic_batch(tmpdir):
+    """Check that a batched IC job makes the ICs of every simulation in packed lanes,
+    checks each while the next MP-GenIC runs, and records the result for each simulation."""
+    bindir = tmpdir.mkdir("bin")
+    bindir.join("mpirun").write("#!/bin/bash\nif [ $(basename $(pwd)) = sim1 ]; then exit 1; fi\n"
+                                "echo \"$@\" > launched\nmkdir -p ICS/ics\nsleep 0.3\ndate +%s.%N > genic_end\n")
+    bindir.join("python").write("#!/bin/bash\ndate +%s.%N > check_start\necho \"$@\" > checked\nsleep 0.3\n[ $(basename $(pwd)) != sim2 ]\n")
+    for exe in ("mpirun", "python"):
+        os.chmod(str(bindir.join(exe)), 0o755)
+    sims = [simulationics.SimulationICs(outdir=str(tmpdir.join("sim%d" % ii)), box=64, npart=32, redshift=99, cluster_class=clusters.LocalClusterClass) for ii in range(4)]
+    batchdir = str(tmpdir.join("batch"))
+    script = simulationics.generate_genic_batch(sims, batchdir, packs=2)
+    text = open(script).read()
+    #Two MP-GenIC runs of 8 cores at once, two after each other.
+    assert "#LOCAL -n 16\n" in text and "#LOCAL -t 0:30:00\n" in text
+    assert text.count("simrunner_lane 0 /") == 1 and text.count("simrunner_lane 1 /") == 1
+    env = dict(os.environ)
+    env["PATH"] = str(bindir)+os.pathsep+env["PATH"]
+    env["SIMRUNNER_CPUSET"] = ",".join([str(cc) for cc in range(16)])
+    assert subprocess.call(["bash", script], cwd=batchdir, env=env) == 0
+    status = remake.genic_batch_status(batchdir)
+    assert status == {sims[0].outdir: {"genic": "ok", "check": "ok"}, sims[1].outdir: {"genic": "failed"},
+                      sims[2].outdir: {"genic": "ok", "check": "failed"}, sims[3].outdir: {"genic": "ok", "check": "ok"}}
+    assert tmpdir.join("sim0", "checked").read().strip() == "cambpower.py ICS/64_32_99 --czstr 99 --mnu 0"
+    #sim0 and sim2 share a lane: the check of sim0 ran while MP-GenIC ran for sim2.
+    assert float(tmpdir.join("sim0", "check_start").read()) < float(tmpdir.join("sim2", "genic_end").read())
+    assert os.path.exists(os.path.join(sims[3].outdir, "cambpower.py"))
+    #Each lane is pinned to its own half of the cores of the job.
+    assert "--cpu-set 0,1,2,3,4,5,6,7 " in tmpdir.join("sim2", "launched").read()
+    assert "--cpu-set 8,9,10,11,12,13,14,15 " in tmpdir.join("sim3", "launched").read()
+    #On clusters the lanes run on different nodes.
+    for (cluster, lane0, lane1) in ((clusters.StampedeClass, "ibrun -n 8 -o 0 ", "ibrun -n 8 -o 8 "),
+                                    (clusters.MARCCClass, "srun --exclusive --nodes=2 --ntasks=48 ", None),
+                                    (clusters.HipatiaClass, "sed -n '1,256p' $PBS_NODEFILE", "sed -n '257,512p' $PBS_NODEFILE")):
+        lanedir = str(tmpdir.mkdir(cluster.__name__))
+        clus = cluster(gadget="MP-Gadget", genic="MP-GenIC")
+        clus.generate_mpi_submit_genic_batch(lanedir, [(sim.outdir, None) for sim in sims], packs=2)
+        text = open(os.path.join(lanedir, "mpi_submit_genic_batch")).read()
+        assert lane0 in text and (lane1 is None or lane1 in text)
@@ -0,0 +1,45 @@
+"""Tests for the parameter file templates"""
+import os
+import configobj
+import numpy as np
+import pytest
+from SimulationRunner import paramfile
+from SimulationRunner import simulationics
+
+def test_render_matches_configobj():
+    """Check that rendering a template gives the same values as a configobj round-trip."""
+    default = os.path.join(os.path.dirname(simulationics.__file__), "mpgenic.ini")
+    params = {'Ngrid': 256, 'Omega0': 0.288, 'MNue': np.float64(0.147144021962), 'FileWithInputSpectrum': "camb_linear/ics_matterpow_99.dat",
+              'OutputList': '0.1,0.2,0.3', 'NewKey': 'has # hash', 'Empty': ''}
+    template = paramfile.ParamTemplate(default)
+    rendered = configobj.ConfigObj(template.render(params).splitlines())
+    config = configobj.ConfigObj(default)
+    config.update(params)
+    #Write to a list of lines rather than overwriting the default file.
+    config.filename = None
+    roundtrip = configobj.ConfigObj(config.write())
+    assert rendered.dict() == roundtrip.dict()
+    #Batch rendering gives the same files
+    assert template.render_batch([params, params]) == [template.render(params),]*2
+
+def test_template_validation():
+    """Check that required values are validated once, when the template is loaded."""
+    default = os.path.join(os.path.dirname(simulationics.__file__), "mpgenic.ini")
+    template = paramfile.load_template(default, required={'WhichSpectrum': 2})
+    assert paramfile.load_template(default, required={'WhichSpectrum': 2}) is template
+    with pytest.raises(ValueError):
+        paramfile.load_template(default, required={'WhichSpectrum': 1})
+
+def test_write_if_changed(tmpdir):
+    """Check that unchanged files are not rewritten and that changes are reported."""
+    fname = str(tmpdir.join("test.param"))
+    template = paramfile.ParamTemplate()
+    change = template.write(fname, {'A': 1, 'B': 'x'})
+    assert change.status == 'created'
+    mtime = os.stat(fname).st_mtime_ns
+    change = template.write(fname, {'A': 1, 'B': 'x'})
+    assert change.status == 'unchanged'
+    assert os.stat(fname).st_mtime_ns == mtime
+    change = template.write(fname, {'A': 2, 'C': 'y'})
+    assert change.status == 'changed'
+    assert change.changed == {'A': ('1', '2'), 'B': ('x', None), 'C': (None, 'y')}
@@ -11,7 +11,7 @@ setup(
     description="Python script for generating Gadget simulation parameter files",
     packages = ['SimulationRunner'],
     requires=['numpy', 'h5py','scipy', 'nbodykit', 'camb'],
-    package_data = {'SimulationRunner': ['*.ini','*.param'],},
+    package_data = {'SimulationRunner': ['*.ini','*.param','*.json'],},
     classifiers = ["Development Status :: 4 - Beta",
                    "Intended Audience :: Developers",
                    "Intended Audience :: Science/Research",
@@ -2,8 +2,22 @@
 
 import os
 import re
+import json
+import subprocess
+import concurrent.futures
 import configobj
+import numpy as np
+import pytest
+import scipy.interpolate as interp
 from SimulationRunner import simulationics
+from SimulationRunner import lineartheory
+from SimulationRunner import kgrid
+from SimulationRunner import surrogate
+from SimulationRunner import instrument
+from SimulationRunner import build
+from SimulationRunner import utils
+from SimulationRunner import clusters
+from SimulationRunner import planner
 
 def test_full_integration():
     """Create a full simulation snapshot and check it corresponds to the saved results"""
@@ -29,3 +43,240 @@ def test_only_DM():
     assert Sim2.box == Sim.box
     assert Sim2.hubble == Sim.hubble
     #shutil.rmtree(outdir)
+
+def test_linear_theory_store(tmpdir):
+    """Check that linear theory is saved and looked up by exact redshift, even for redshifts with the same text file name."""
+    zz = [99, 4.2, 4.0, 3.8]
+    columns = ["k (h/Mpc)", "d_cdm", "d_tot"]
+    kk = np.logspace(-3, 1, 50)
+    transfers = [np.array([kk, kk*(i+1), kk*(i+2)]).T for i in range(len(zz))]
+    pks = [kk**-1*(i+1) for i in range(len(zz))]
+    fname = str(tmpdir.join("linear_theory.npz"))
+    lineartheory.save_linear_theory(fname, zz, transfers, pks, columns)
+    store = lineartheory.LinearTheory(fname)
+    for (i, z) in enumerate(zz):
+        assert np.array_equal(store.get_transfer(z), transfers[i])
+        (kz, pkz) = store.get_pklin(z)
+        assert np.array_equal(kz, kk)
+        assert np.array_equal(pkz, pks[i])
+    assert np.array_equal(store.get_column(4.0, "d_tot"), transfers[2][:,2])
+    with pytest.raises(KeyError):
+        store.get_pklin(4.1)
+
+def test_thin_kgrid():
+    """Check that thinning the k grid of a smooth table reproduces it to the requested accuracy."""
+    kk = np.logspace(-4, 2, 4000)
+    pk = kk/(1+(kk/0.02)**2.5)*(1+0.05*np.sin(kk/0.01)*np.exp(-(kk/0.3)**2))
+    transfer = np.column_stack([kk, 1/(1+kk**2), -np.cos(kk)/(1+kk), np.zeros_like(kk)])
+    for tol in (1e-3, 1e-5):
+        (trans2, pk2, error) = kgrid.thin_class_tables(transfer, pk, tol)
+        assert error <= tol
+        assert np.size(pk2) < np.size(pk)/4
+        assert trans2[0,0] == kk[0] and trans2[-1,0] == kk[-1]
+        pkint = interp.interp1d(np.log(trans2[:,0]), np.log(pk2), kind='cubic')
+        assert np.all(np.abs(np.exp(pkint(np.log(kk)))/pk - 1) < 1.01*tol)
+
+def _toy_power(params, redshifts, kk):
+    """A toy linear power spectrum with a smooth dependence on the cosmological parameters."""
+    (ns, amp, omega0, omegab, hubble, m_nu) = [params[pp] for pp in ("ns", "scalar_amp", "omega0", "omegab", "hubble", "m_nu")]
+    keq = 0.2 * omega0 * hubble
+    transfer = 1/(1 + (kk/keq)**2)*(1 - 0.5*omegab/omega0*np.sin(kk/0.06)*np.exp(-(kk/0.3)**2)) * (1 - 8*m_nu/omega0/93*kk/(kk+0.1))
+    return np.array([1e13*amp*(kk/0.05)**(ns-1)*kk*transfer**2/(1+zz)**2 for zz in redshifts])
+
+def _write_toy_sim(simdir, params, redshifts, kk):
+    """Write the SimulationICs.json and linear theory store for a toy simulation."""
+    os.makedirs(os.path.join(simdir, "camb_linear"))
+    with open(os.path.join(simdir, "SimulationICs.json"), 'w') as jsout:
+        json.dump(params, jsout)
+    pks = _toy_power(params, redshifts, kk)
+    lineartheory.save_linear_theory(os.path.join(simdir, "camb_linear", "linear_theory.npz"), redshifts, [kk[:, None],]*len(redshifts), pks, columns=['k'])
+
+def test_linear_surrogate(tmpdir):
+    """Check that the linear theory surrogate interpolates the training set and falls back to the solver."""
+    rng = np.random.RandomState(23)
+    kk = np.logspace(-3, 1, 300)
+    redshifts = [99, 2., 0.]
+    fid = {"ns": 0.97, "scalar_amp": 2.2e-9, "omega0": 0.3, "omegab": 0.048, "hubble": 0.68, "m_nu": 0.1}
+    simdirs = []
+    for ii in range(60):
+        params = {pp: fid[pp]*(1 + 0.05*(2*rng.rand()-1)) for pp in fid}
+        simdirs.append(str(tmpdir.join("sim%d" % ii)))
+        _write_toy_sim(simdirs[-1], params, redshifts, kk)
+    surr = surrogate.from_simulations(simdirs)
+    assert np.array_equal(surr.redshifts, [0., 2., 99])
+    query = {pp: fid[pp]*np.array([1., 1.02, 0.98]) for pp in fid}
+    result = surr.query(query)
+    for ii in range(3):
+        point = {pp: query[pp][ii] for pp in fid}
+        truth = _toy_power(point, surr.redshifts, surr.kk)
+        assert np.max(np.abs(result['pk'][ii]/truth - 1)) < 1e-3
+        assert np.max(np.abs(result['pk'][ii]/truth - 1)) < result['error'][ii]
+        assert np.all(np.abs(result['growth'][ii] - np.array([1., 1/3., 1/100.])) < 1e-3)
+    assert np.all(result['error'] < 1e-2)
+    assert np.all(result['sigma8'] > 0)
+    #A point far outside the training set is solved and added to the training set.
+    far = {pp: [fid[pp]*1.3] for pp in fid}
+    solved = []
+    def solver(params, zz, kvals):
+        solved.append(params)
+        return _toy_power(params, zz, kvals)
+    result = surr.query(far, tol=0.01, solver=solver)
+    assert result['solved'][0] and len(solved) == 1
+    assert np.shape(surr.params)[0] == 61
+    truth = _toy_power({pp: far[pp][0] for pp in fid}, surr.redshifts, surr.kk)
+    assert np.allclose(result['pk'][0], truth, rtol=1e-10)
+    #A surrogate trained on massless cosmologies knows nothing about the neutrino mass.
+    massless = []
+    for ii in range(40):
+        params = {pp: fid[pp]*(1 + 0.05*(2*rng.rand()-1)) for pp in fid}
+        params["m_nu"] = 0.
+        massless.append(str(tmpdir.join("massless%d" % ii)))
+        _write_toy_sim(massless[-1], params, redshifts, kk)
+    surr = surrogate.from_simulations(massless)
+    query = {pp: [fid[pp], fid[pp]] for pp in fid}
+    query["m_nu"] = [0., 0.1]
+    assert np.isfinite(surr.error(dict(fid, m_nu=0.)))
+    assert np.isinf(surr.error(dict(fid, m_nu=0.1)))
+    result = surr.query(query, tol=0.01, solver=solver)
+    assert list(result['solved']) == [False, True]
+
+def test_stage_timer(tmpdir):
+    """Check that stage timings are recorded, passed to the callback and aggregated over a suite."""
+    seen = []
+    for sim in ("sim0", "sim1"):
+        outdir = tmpdir.mkdir(sim)
+        timer = instrument.StageTimer(str(outdir), callback=seen.append)
+        with timer.stage("write"):
+            outdir.join("data").write("x"*1000)
+        with pytest.raises(ValueError):
+            with timer.stage("fail"):
+                raise ValueError
+        #A file rewritten in place is counted in full.
+        with timer.stage("rewrite"):
+            outdir.join("data").write("y"*1000)
+    tmpdir.join("notes.txt").write("Not a simulation")
+    events = instrument.load_timings(str(tmpdir.join("sim0")))
+    assert [ev["stage"] for ev in events] == ["write", "fail", "rewrite"]
+    assert events[0]["bytes_written"] == 1000
+    assert events[2]["bytes_written"] >= 1000
+    assert events[1]["status"] == "failed"
+    assert len(seen) == 6
+    summary = instrument.aggregate_timings(str(tmpdir))
+    assert summary["write"]["count"] == 2
+    assert summary["write"]["bytes_written"] == 2000
+    assert summary["fail"]["failed"] == 2
+    assert np.abs(summary["write"]["fraction"] + summary["fail"]["fraction"] + summary["rewrite"]["fraction"] - 1) < 1e-10
+
+def _fake_gadget_tree(srcdir):
+    """Make a git repository with a Makefile which 'builds' MP-Gadget by copying Options.mk."""
+    os.makedirs(os.path.join(srcdir, "gadget"))
+    with open(os.path.join(srcdir, "Makefile"), 'w') as mfile:
+        mfile.write("gadget/MP-Gadget: Options.mk\n\tsleep 0.2\n\tcp Options.mk gadget/MP-Gadget\n")
+    for cmd in (["init", "-q"], ["add", "Makefile"], ["-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "init"]):
+        subprocess.check_call(["git"] + cmd, cwd=srcdir)
+
+def test_gadget_build_cache(tmpdir):
+    """Check that concurrent builds of the same configuration compile once, in a private tree."""
+    srcdir = str(tmpdir.join("MP-Gadget"))
+    _fake_gadget_tree(srcdir)
+    cachedir = str(tmpdir.join("cache"))
+    configs = []
+    for (ii, opt) in enumerate(["-O2", "-O2", "-O3"]):
+        configs.append(str(tmpdir.join("Options%d.mk" % ii)))
+        with open(configs[-1], 'w') as cfile:
+            cfile.write("OPTIMIZE = "+opt+"\n")
+    with concurrent.futures.ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda cc: build.gadget_build(srcdir, cc, "opt", cachedir=cachedir), configs))
+    #The first two are identical, so only one of them ran make.
+    assert results[0][0] == results[1][0] != results[2][0]
+    assert (results[0][1] is None) != (results[1][1] is None)
+    assert results[2][1] is not None
+    with open(os.path.join(results[2][0], "gadget", "MP-Gadget")) as gfile:
+        assert gfile.read() == "OPTIMIZE = -O3\n"
+    #The source tree is untouched
+    assert not os.path.exists(os.path.join(srcdir, "Options.mk"))
+    assert not os.path.exists(os.path.join(srcdir, "gadget", "MP-Gadget"))
+    #A cached build is reused
+    assert build.gadget_build(srcdir, configs[0], "opt", cachedir=cachedir) == (results[0][0], None)
+    #A new commit changes the key, even though the git hash of the tree is memoised.
+    utils.get_git_hash(srcdir)
+    key = build.build_key(srcdir, "OPTIMIZE = -O2\n", "opt")
+    with open(os.path.join(srcdir, "gadget", "run.c"), 'w') as cfile:
+        cfile.write("int main() { return 0; }\n")
+    #So does an untracked source file.
+    untracked = build.build_key(srcdir, "OPTIMIZE = -O2\n", "opt")
+    assert untracked != key
+    for cmd in (["add", "gadget/run.c"], ["-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "run"]):
+        subprocess.check_call(["git"] + cmd, cwd=srcdir)
+    assert build.build_key(srcdir, "OPTIMIZE = -O2\n", "opt") not in (key, untracked)
+    assert build.gadget_build(srcdir, configs[0], "opt", cachedir=cachedir)[1] is not None
+
+def test_cluster_profiles(tmpdir, monkeypatch):
+    """Check the placement and binding computed from cluster profiles, and that profile classes survive SimulationICs.json."""
+    monkeypatch.setitem(clusters.PROFILES, "TestProfile", {"scheduler": "slurm", "partition": "compute", "sockets": 2, "cores_per_socket": 32,
+                                                          "numa_per_socket": 4, "memory": 250000, "launcher": "openmpi"})
+    cluster = clusters.ProfileClusterClass(profile="TestProfile", nproc=100)
+    #Rounded up to whole nodes, one task per NUMA domain.
+    assert cluster.nproc == 128 and cluster.layout == (8, 8)
+    assert cluster.placement() == {"nodes": 2, "ntasks": 16, "tasks_per_node": 8, "threads": 8, "domain": "numa", "tasks_per_domain": 1, "memory": 250000}
+    cluster.generate_mpi_submit(str(tmpdir))
+    script = tmpdir.join("mpi_submit").read()
+    for line in ("--nodes=2", "--ntasks-per-node=8", "--cpus-per-task=8", "--mem=250000M", "OMP_NUM_THREADS=8",
+                 "mpirun -np 16 --map-by ppr:1:numa:PE=8 --bind-to core MP-Gadget mpgadget.param"):
+        assert line in script
+    #A layout which does not fit the NUMA domains is bound to sockets.
+    cluster.layout = (2, 32)
+    assert cluster.placement()["domain"] == "socket"
+    assert cluster.cluster_runtime()["MaxMemSizePerNode"] == 250000
+    #The packaged profiles are module level classes.
+    Sim = simulationics.SimulationICs(outdir=str(tmpdir.join("sim")), box=256, npart=96, cluster_class=clusters.StampedeSKXProfile)
+    Sim.txt_description()
+    Sim2 = simulationics.SimulationICs(outdir=str(tmpdir.join("sim")), box=128, npart=128)
+    Sim2.load_txt_description()
+    assert Sim2.cluster_class is clusters.StampedeSKXProfile
+    assert "ibrun MP-Gadget" in clusters.StampedeSKXProfile()._mpi_program("MP-Gadget mpgadget.param")
+    #A profile from $SIMRUNNER_CLUSTER_PROFILES is saved with its spec, so it can be loaded where the file is not.
+    TestProfile = clusters.register_profile("TestProfile", clusters.PROFILES["TestProfile"])
+    Sim = simulationics.SimulationICs(outdir=str(tmpdir.join("sim")), box=256, npart=96, cluster_class=TestProfile)
+    Sim.txt_description()
+    del clusters.PROFILES["TestProfile"]
+    delattr(clusters, "TestProfile")
+    Sim2.load_txt_description()
+    assert Sim2.cluster_class.profile == "TestProfile"
+    assert Sim2.cluster_class(nproc=64).placement()["ntasks"] == 8
+    delattr(clusters, "TestProfile")
+
+def test_cost_planner(tmpdir):
+    """Check that costs scale with the particle load, that runs are scheduled and that telemetry rescales the costs."""
+    cluster = clusters.LocalClusterClass(nproc=4, timelimit=2)
+    sims = [simulationics.SimulationICs(outdir=str(tmpdir.join("dm")), box=64, npart=64, separate_gas=False, redshift=99, redend=0),
+            simulationics.SimulationICs(outdir=str(tmpdir.join("gas")), box=64, npart=64, redshift=99, redend=0),
+            simulationics.SimulationICs(outdir=str(tmpdir.join("small")), box=64, npart=32, redshift=99, redend=0)]
+    plan = planner.plan_suite(sims, cluster=cluster, max_concurrent=2)
+    (dm, gas, small) = plan["runs"]
+    assert gas["particles"] == {"gas": 64**3, "dm": 64**3, "nu": 0}
+    assert gas["gadget_core_hours"] > dm["gadget_core_hours"] > small["gadget_core_hours"]
+    assert gas["snapshots"] == len(sims[1].generate_times()) + 1
+    assert gas["bytes"] == gas["ic_bytes"] + (gas["snapshots"]+1)*gas["snapshot_bytes"]
+    assert gas["gadget_jobs"] == int(np.ceil(gas["gadget_hours"]/(2-300/3600.)))
+    #The two largest start at once and the smallest waits for a slot.
+    assert gas["start"] == dm["start"] == 0 and small["start"] == dm["end"]
+    assert plan["critical_path"] == gas["outdir"] and plan["makespan_hours"] == gas["end"] > small["end"]
+    assert plan["peak_cores"] == 8
+    assert np.isclose(plan["totals"]["bytes"], dm["bytes"] + gas["bytes"] + small["bytes"])
+    assert plan["peak_bytes"] == plan["totals"]["bytes"]
+    assert planner.plan_suite(sims, cluster=cluster, compact=True)["peak_bytes"] < plan["totals"]["bytes"]
+    #Past runs, twice as slow as the default model.
+    pastdir = tmpdir.mkdir("past")
+    past = pastdir.mkdir("sim0")
+    snap = past.mkdir("output").mkdir("PART_001")
+    snap.mkdir("Header").join("attr-v2").write("TotNumPart <u8 6 0 #HUMANE [ 0 1000 0 0 0 0 ]\n")
+    model = planner.CostModel()
+    gadget = 2*1000*model.gadget_cost["dm"]*np.log(2)
+    past.join("output", "cpu.txt").write("Step 0, Time: 0.25, MPIs: 2 Threads: 2 Elapsed: 0\nStep 1, Time: 0.3, MPIs: 2 Threads: 2 Elapsed: %g\n"
+                                         "Step 1, Time: 0.3, MPIs: 4 Threads: 1 Elapsed: 0\nStep 2, Time: 0.5, MPIs: 4 Threads: 1 Elapsed: %g\n" % (gadget/8, gadget/8))
+    past.join(instrument.TIMINGS_FILE).write(json.dumps({"stage": "genic", "status": "ok", "cpu_children": 2*1000*model.genic_cost["dm"]})+"\n")
+    calibrated = planner.plan_suite(sims, cluster=cluster, model=model, telemetry=str(pastdir))
+    assert np.allclose([model.scale["genic"], model.scale["gadget"]], 2)
+    assert model.samples == {"genic": 1, "gadget": 1, "storage": 1}
+    assert np.isclose(calibrated["runs"][0]["gadget_core_hours"], 2*dm["gadget_core_hours"])
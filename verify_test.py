@@ -0,0 +1,118 @@
+"""Tests for the BigFile integrity checks"""
+import os
+import tarfile
+import numpy as np
+from SimulationRunner import verify
+from SimulationRunner import remake
+from SimulationRunner import archive
+
+def _write_bigfile(bigdir, npart, nfile=2, time=0.25):
+    """Write a BigFile with a header and a Position block for each particle type."""
+    os.makedirs(os.path.join(bigdir, "Header"))
+    with open(os.path.join(bigdir, "Header", "attr-v2"), 'w') as hh:
+        hh.write("Time <f8 1 000000000000D03F #HUMANE [ %g ]\n" % time)
+        hh.write("TotNumPart <u8 6 0 #HUMANE [ %s ]\n" % " ".join([str(nn) for nn in npart]))
+    for (ptype, nn) in enumerate(npart):
+        if nn == 0:
+            continue
+        blockdir = os.path.join(bigdir, str(ptype), "Position")
+        os.makedirs(blockdir)
+        data = np.arange(3*nn, dtype="<f8").reshape(nn, 3)
+        lines = ["DTYPE: <f8\n", "NMEMB: 3\n", "NFILE: %d\n" % nfile]
+        for (ii, part) in enumerate(np.array_split(data, nfile)):
+            fname = "%06X" % ii
+            part.tofile(os.path.join(blockdir, fname))
+            checksum = int(np.frombuffer(part.tobytes(), dtype=np.uint8).sum()) % 2**32
+            lines.append("%s: %d : %d : 0\n" % (fname, len(part), checksum))
+        with open(os.path.join(blockdir, "header"), 'w') as hh:
+            hh.writelines(lines)
+
+def test_verify(tmpdir):
+    """Check that truncated, corrupted and short BigFiles are found, and that checksums are cached."""
+    rundir = str(tmpdir)
+    for sim in range(3):
+        _write_bigfile(os.path.join(rundir, "sim%d" % sim, "ICS", "ics_99"), [0, 100, 50, 0, 0, 0])
+        _write_bigfile(os.path.join(rundir, "sim%d" % sim, "output", "PART_000"), [0, 100, 50, 0, 0, 0])
+    cachefile = os.path.join(rundir, ".verify_cache.sqlite")
+    verifier = verify.Verifier(cachefile, nproc=2)
+    assert verifier.verify(os.path.join(rundir, "sim0", "ICS", "ics_99")) == []
+    #Truncated data file
+    with open(os.path.join(rundir, "sim0", "ICS", "ics_99", "1", "Position", "000001"), 'r+b') as dd:
+        dd.truncate(100)
+    #Same size, different contents
+    with open(os.path.join(rundir, "sim1", "output", "PART_000", "2", "Position", "000000"), 'r+b') as dd:
+        dd.write(b"\1"*8)
+    #Missing particles
+    _write_bigfile(os.path.join(rundir, "sim2", "output", "PART_001"), [0, 100, 50, 0, 0, 0])
+    with open(os.path.join(rundir, "sim2", "output", "PART_001", "Header", "attr-v2"), 'a') as hh:
+        hh.write("TotNumPart <u8 6 0 #HUMANE [ 0 128 50 0 0 0 ]\n")
+    bad = verify.verify_suite(rundir, nproc=2)
+    assert sorted(bad) == [os.path.join(rundir, "sim0", "ICS", "ics_99"), os.path.join(rundir, "sim1", "output", "PART_000"), os.path.join(rundir, "sim2", "output", "PART_001")]
+    assert "bytes" in bad[os.path.join(rundir, "sim0", "ICS", "ics_99")][0]
+    assert "checksum" in bad[os.path.join(rundir, "sim1", "output", "PART_000")][0]
+    assert "TotNumPart" in bad[os.path.join(rundir, "sim2", "output", "PART_001")][0]
+    #Sizes only: the corrupted contents are not found.
+    assert verifier.verify(os.path.join(rundir, "sim1", "output", "PART_000"), checksum=False) == []
+    #Unchanged files are not read again.
+    fname = os.path.join(rundir, "sim2", "ICS", "ics_99", "1", "Position", "000000")
+    assert verifier._cached(fname) is not None
+    os.utime(fname)
+    assert verifier._cached(fname) is None
+    #Corrupt ICs are regenerated and corrupt snapshots are not restarted from.
+    for sim in range(3):
+        with open(os.path.join(rundir, "sim%d" % sim, "mpi_submit"), 'w') as script:
+            script.write("mpirun -np 4 MP-Gadget mpgadget.param\n")
+    submitted = []
+    def submit(script, cwd):
+        """Pretend to submit a job"""
+        submitted.append((os.path.basename(os.path.normpath(cwd)), script))
+        return str(len(submitted))
+    remake.resub_not_complete_genic(rundir, resub_command=submit, verify=True)
+    assert submitted == [("sim0", "mpi_submit_genic")]
+    remake.resub_not_complete(rundir, resub_command=submit, restart=2, verify=True)
+    assert sorted(submitted[1:]) == [("sim0", "mpi_submit_resub")]
+
+def test_archive(tmpdir):
+    """Check that complete simulations are compacted, verified before deletion, and that compaction resumes."""
+    rundir = str(tmpdir)
+    for sim in range(2):
+        simdir = os.path.join(rundir, "sim%d" % sim)
+        _write_bigfile(os.path.join(simdir, "ICS", "ics_99"), [0, 100, 50, 0, 0, 0])
+        for snap in range(3):
+            _write_bigfile(os.path.join(simdir, "output", "PART_%03d" % snap), [0, 100, 50, 0, 0, 0], time=0.2*(snap+1))
+        _write_bigfile(os.path.join(simdir, "output", "PIG_001"), [0, 10, 0, 0, 0, 0])
+        for binary in ("MP-Gadget", "TREECOOL"):
+            with open(os.path.join(simdir, binary), 'w') as bb:
+                bb.write("binary")
+        with open(os.path.join(simdir, "output", "cpu.txt"), 'w') as cpu:
+            cpu.write("Step 10, Time: 0.6\n")
+    #sim1 has not finished.
+    os.rename(os.path.join(rundir, "sim1", "output", "PART_002"), os.path.join(rundir, "sim1", "output", "tmp"))
+    policy = archive.RetentionPolicy(keep_redshifts=[1.5])
+    plans = archive.compact_suite(rundir, policy=policy, dry_run=True, endz=1.2)
+    sim0 = os.path.join(rundir, "sim0")
+    assert list(plans) == [sim0]
+    assert plans[sim0] == (["output/PART_001", "output/PART_002", "output/PIG_001"], ["ICS/ics_99", "MP-Gadget", "TREECOOL", "output/PART_000"])
+    assert os.path.exists(os.path.join(sim0, "MP-Gadget"))
+    #An interrupted run which left a truncated archive.
+    with open(os.path.join(sim0, "output", "PART_002.tar.gz"), 'w') as bad:
+        bad.write("truncated")
+    manifests = archive.compact_suite(rundir, policy=policy, threads=2, endz=1.2)
+    manifest = manifests[sim0]
+    assert manifest["complete"] and manifest["codec"] == "gz"
+    assert all([aa["verified"] for aa in manifest["archives"].values()])
+    assert manifest["archives"]["output/PART_002"]["files"] == 7
+    assert sorted(os.listdir(os.path.join(sim0, "output"))) == ["PART_001", "PART_001.tar.gz", "PART_002", "PART_002.tar.gz", "PIG_001", "PIG_001.tar.gz", "cpu.txt"]
+    assert sorted(os.listdir(os.path.join(sim0, "output", "PART_002"))) == ["ARCHIVE", "Header"]
+    assert sorted(os.listdir(sim0)) == ["ICS", "archive_manifest.json", "output"]
+    assert sorted(os.listdir(os.path.join(rundir, "sim1", "output"))) == ["PART_000", "PART_001", "PIG_001", "cpu.txt", "tmp"]
+    #Still complete, and still intact as far as the verifier is concerned.
+    (odirs, completes, _) = remake.check_status(rundir, endz=1.2)
+    assert {os.path.basename(os.path.normpath(oo)): cc for (oo, cc) in zip(odirs, completes)} == {"sim0": True, "sim1": False}
+    assert verify.verify_suite(rundir) == {}
+    #The archive can be extracted again.
+    with tarfile.open(os.path.join(sim0, "output", "PART_002.tar.gz")) as tar:
+        tar.extractall(str(tmpdir.join("extract")))
+    assert verify.Verifier().verify(str(tmpdir.join("extract", "PART_002"))) == []
+    #Nothing more to do
+    assert archive.compact_suite(rundir, policy=policy, endz=1.2, dry_run=True) == {}